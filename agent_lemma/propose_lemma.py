@@ -8,6 +8,8 @@ from coqpyt.coq.lsp.structs import Goal
 
 from utils_coq import *
 from llm import LLM
+from budget import Budget
+from utils_prompt import pack
 from agent_lemma.prompt import *
 
 
@@ -19,7 +21,7 @@ def get_ids_from_goal(proof_file: ProofFile, proof_term: ProofTerm, goal: Goal)
     return definitions
 
 
-def get_lemmas_for_state(proof_file: ProofFile, proof_term: ProofTerm, helper_lemmas: dict[str, str], reuse_path: str = '') -> tuple[dict[str, dict], dict[str, Any]]:
+def get_lemmas_for_state(proof_file: ProofFile, proof_term: ProofTerm, helper_lemmas: dict[str, str], reuse_path: str = '', budget: Budget | None = None) -> tuple[dict[str, dict], dict[str, Any]]:
     if reuse_path:
         log_path = os.path.join(reuse_path, 'lemmas.json')
         if os.path.exists(log_path):
@@ -38,16 +40,15 @@ def get_lemmas_for_state(proof_file: ProofFile, proof_term: ProofTerm, helper_le
     goal_format = format_goal(goal)
     log['goal'] = goal_format 
 
-    definitions_set = {text for _, text in definitions.items()}
-    definitions_str = '\n\n'.join([text for text in definitions_set])
-    
-    if len(helper_lemmas) > 0:
-        lemmas_str = '\n\n'.join(helper_lemmas.values())
-        prompt = PROPOSE_LEMMAS_WITH_LEMMAS.format(definitions=definitions_str, proof_state=goal_format, lemmas=lemmas_str)
-    else:
-        prompt = PROPOSE_LEMMAS_WO_LEMMAS.format(definitions=definitions_str, proof_state=goal_format)
+    definitions_list = list(dict.fromkeys(definitions.values()))
+    template = PROPOSE_LEMMAS_WITH_LEMMAS if len(helper_lemmas) > 0 else PROPOSE_LEMMAS_WO_LEMMAS
+    fixed = template.format(definitions='', proof_state=goal_format, lemmas='')
+    packed, log['packing'] = pack(goal_format, fixed, {'definitions': definitions_list, 'lemmas': list(helper_lemmas.values())})
+    definitions_str = '\n\n'.join(packed['definitions'])
+    lemmas_str = '\n\n'.join(packed['lemmas'])
+    prompt = template.format(definitions=definitions_str, proof_state=goal_format, lemmas=lemmas_str)
 
-    llm = LLM()
+    llm = LLM(budget=budget)
     response = llm.query(prompt)[0]
 
     log['prompt'] = prompt
@@ -63,9 +64,7 @@ def parse_lemmas(coq_file: CoqFile, response: str) -> tuple[dict[str, str], dict
     compile_correct = {}
     compile_error = {}
     for block in blocks:
-        if 'Proof.' in block:
-            block = block[:block.find('Proof.')].strip()
-        block = remove_comments(block)
+        block = remove_comments(cut_at_proof(block))
         block = block.strip()
         codes = coq_file.parse_code('\n' + block)
         codes_text = [c.short_text for c in codes]
@@ -7,9 +7,10 @@ from coqpyt.coq.proof_file import ProofPop
 from agent_proof.agent import prove_theorem
 from agent_proof.gen_proof import get_proof_current_theorem
 from utils_coq import get_ids_in_step_recursive
+from budget import Budget
 
 
-def prove_lemmas(proof_file: ProofFile, original_proof_term: ProofTerm, lemmas_to_prove: dict[str, dict], helper_lemmas: dict[str, str], method: str = 'hammer_dsp') -> tuple[dict[str, str], list[str], dict[str, Any]]:
+def prove_lemmas(proof_file: ProofFile, original_proof_term: ProofTerm, lemmas_to_prove: dict[str, dict], helper_lemmas: dict[str, str], method: str = 'hammer_dsp', budget: Budget | None = None) -> tuple[dict[str, str], list[str], dict[str, Any]]:
     success_lemmas = {}
     failed_lemmas = []
     lemmas_log = {}
@@ -38,8 +39,8 @@ def prove_lemmas(proof_file: ProofFile, original_proof_term: ProofTerm, lemmas_t
         definitions_list = list(set(definitions.values()))
         helper_lemmas_list = list(helper_lemmas.values())
 
-        initial_proof_steps, log_initial_proof, conversation = get_proof_current_theorem(theorem_str, definitions_list, helper_lemmas_list)
-        success, log_prove, partial_proof_str, goal_str, error_tactic, error_msg = prove_theorem(proof_file, proof_term, initial_proof_steps, method=method)
+        initial_proof_steps, log_initial_proof, conversation = get_proof_current_theorem(theorem_str, definitions_list, helper_lemmas_list, budget=budget)
+        success, log_prove, partial_proof_str, goal_str, error_tactic, error_msg = prove_theorem(proof_file, proof_term, initial_proof_steps, method=method, budget=budget)
         log_initial_proof['execution'] = log_prove
         lemmas_log[name] = {
             'conversation': conversation,
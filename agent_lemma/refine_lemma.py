@@ -1,5 +1,6 @@
 from utils_coq import *
 from llm import LLM
+from budget import Budget
 from agent_lemma.prompt import *
 
 from agent_lemma.prompt import REFINE_LEMMAS
@@ -31,19 +32,22 @@ def parse_refine_lemmas(coq_file: CoqFile, response: str) -> tuple[str, str]:
         return name, block
 
 
-def refine_lemma(theorem: str, proof_state: str, definitions: list[str], lemmas: list[str], lemmas_to_refine: dict[str, str]) -> tuple[list[tuple[str, str]], list[dict]]:
+def refine_lemma(coq_file: CoqFile, theorem: str, proof_state: str, definitions: list[str], lemmas: list[str], lemmas_to_refine: dict[str, str], budget: Budget | None = None) -> tuple[list[tuple[str, str]], list[dict]]:
     lemmas_str = '\n\n'.join(lemmas)
     definitions_str = '\n\n'.join(definitions)
 
     refined_lemmas = []
+    conversation = []
     for name, lemma in lemmas_to_refine.items():
-        llm = LLM()
+        llm = LLM(budget=budget)
         prompt = REFINE_LEMMAS.format(theorem=theorem, proof_state=proof_state, definitions=definitions_str, lemmas=lemmas_str, lemma_to_refine=lemma)
         response = llm.query(prompt)[0]
-        name, refined_lemma = parse_refine_lemmas(response, lemmas_to_refine)
-        refined_lemmas.append((name, refined_lemma))
+        refined = parse_refine_lemmas(coq_file, response)
+        if refined:
+            refined_lemmas.append(refined)
+        conversation += llm.conversation
 
-    return refined_lemmas, llm.conversation
+    return refined_lemmas, conversation
 
 
 def preprocess_lemma(proof_file: ProofFile, original_proof_term: ProofTerm, lemma: str) -> tuple[bool, ProofTerm, list[Step]]:
@@ -70,7 +74,7 @@ def preprocess_lemma(proof_file: ProofFile, original_proof_term: ProofTerm, lemm
     assert False
 
 
-def validate_lemmas(proof_file: ProofFile, original_proof_term: ProofTerm, lemmas: list[tuple[str, str]]) -> tuple[dict[str, str], list[str], dict]:
+def validate_lemmas(proof_file: ProofFile, original_proof_term: ProofTerm, lemmas: list[tuple[str, str]], budget: Budget | None = None) -> tuple[dict[str, str], list[str], dict]:
     log = {}
     success_lemmas = {}
     failed_lemmas = []
@@ -84,7 +88,7 @@ def validate_lemmas(proof_file: ProofFile, original_proof_term: ProofTerm, lemma
             failed_lemmas.append(name)
             continue
 
-        success, log_prove, partial_proof_str, goal_str, error_tactic, error_msg = prove_theorem(proof_file, proof_term, initial_proof_steps)
+        success, log_prove, partial_proof_str, goal_str, error_tactic, error_msg = prove_theorem(proof_file, proof_term, initial_proof_steps, budget=budget)
         log[name] = log_prove
 
         if success:
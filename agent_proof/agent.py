@@ -1,24 +1,31 @@
-from agent_proof.gen_proof import get_proof_current_theorem, regenerate_proof
-from agent_proof.proof import prove, prove_backtrack, prove_hammer_first
+from agent_proof.gen_proof import get_proof_current_theorem, regenerate_proof, stream_regenerate_proof, build_regenerate_prompt, sample_proofs, Candidates
+from agent_proof.stream import Streaming
+from agent_proof.speculate import Speculation, HammerRace, prove_speculative
+from utils import extract_code_blocks
+from agent_proof.proof import prove, prove_backtrack, prove_hammer_first, replay_proof
 from utils_coq import parse_response_proof
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from budget import Budget, BudgetExceeded
+from checkpoint import SideSessions
 from typing import Any
 from coqpyt.coq.proof_file import ProofFile
 from coqpyt.coq.structs import ProofTerm, Step
 from coqpyt.coq.changes import ProofPop
 
 
-def prove_theorem(proof_file: ProofFile, proof_term: ProofTerm, steps: list[Step], method: str = 'hammer_dsp') -> tuple[bool, dict[str, Any], str, str, str, str]:
+def prove_theorem(proof_file: ProofFile, proof_term: ProofTerm, steps: list[Step], method: str = 'hammer_dsp', budget: Budget | None = None, cancel: threading.Event | None = None) -> tuple[bool, dict[str, Any], str, str, str, str]:
     # clear the existing proof, if 
     if len(proof_term.steps) > 0:   
         changes_clear = [ProofPop() for _ in range(len(proof_term.steps))]
         proof_file.change_proof(proof_term, changes_clear)
 
     if method == 'palm':
-        success, log_prove = prove_backtrack(proof_file, proof_term, steps)
+        success, log_prove = prove_backtrack(proof_file, proof_term, steps, budget, cancel)
     elif method == 'hammer_dsp':
-        success, log_prove = prove_hammer_first(proof_file, proof_term, steps)
+        success, log_prove = prove_hammer_first(proof_file, proof_term, steps, budget, cancel)
     elif method == 'dsp':
-        success, log_prove = prove(proof_file, proof_term, steps)
+        success, log_prove = prove(proof_file, proof_term, steps, budget, cancel)
     else:
         raise ValueError(f'Invalid method: {method}')
 
@@ -39,29 +46,119 @@ def prove_theorem(proof_file: ProofFile, proof_term: ProofTerm, steps: list[Step
     return success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg
 
 
-def prove_theorem_raw_response(proof_file: ProofFile, proof_term: ProofTerm, raw_response: str, method: str = 'hammer_dsp') -> tuple[bool, str, str, str, str, str, list[dict], dict[str, Any], dict[str, Any]]:
+def prove_theorem_raw_response(proof_file: ProofFile, proof_term: ProofTerm, raw_response: str, method: str = 'hammer_dsp', budget: Budget | None = None) -> tuple[bool, str, str, str, str, str, list[dict], dict[str, Any], dict[str, Any]]:
     steps = parse_response_proof(raw_response)
     full_proof_str = ''.join([s.text for s in steps])
-    success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_theorem(proof_file, proof_term, steps, method)
+    success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_theorem(proof_file, proof_term, steps, method, budget)
     return success, full_proof_str, partial_proof_str, stuck_state, error_tactic, error_msg, log_prove
 
 
-def prove_theorem_initial(proof_file: ProofFile, proof_term: ProofTerm, theorem: str, definitions: dict[str, str] | list[str], reuse_path: str = '', method: str = 'hammer_dsp') -> tuple[bool, str, str, str, str, str, list[dict], dict[str, Any], dict[str, Any]]:
-    steps, log_proof_gen, conversation = get_proof_current_theorem(theorem, definitions, [], reuse_path)
+def prove_theorem_initial(proof_file: ProofFile, proof_term: ProofTerm, theorem: str, definitions: dict[str, str] | list[str], reuse_path: str = '', method: str = 'hammer_dsp', budget: Budget | None = None) -> tuple[bool, str, str, str, str, str, list[dict], dict[str, Any], dict[str, Any]]:
+    steps, log_proof_gen, conversation = get_proof_current_theorem(theorem, definitions, [], reuse_path, budget)
     full_proof_str = ''.join([s.text for s in steps])
-    success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_theorem(proof_file, proof_term, steps, method)
+    success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_theorem(proof_file, proof_term, steps, method, budget)
     return success, full_proof_str, partial_proof_str, stuck_state, error_tactic, error_msg, conversation, log_proof_gen, log_prove
 
 
-def prove_theorem_initial_w_lemmas(proof_file: ProofFile, proof_term: ProofTerm, theorem: str, definitions: dict[str, str] | list[str], lemmas: list[str], reuse_path: str = '', method: str = 'hammer_dsp') -> tuple[bool, str, str, str, str, str, list[dict], dict[str, Any], dict[str, Any]]:
-    steps, log_proof_gen, conversation = get_proof_current_theorem(theorem, definitions, lemmas, reuse_path)
+def prove_theorem_initial_w_lemmas(proof_file: ProofFile, proof_term: ProofTerm, theorem: str, definitions: dict[str, str] | list[str], lemmas: list[str], reuse_path: str = '', method: str = 'hammer_dsp', budget: Budget | None = None) -> tuple[bool, str, str, str, str, str, list[dict], dict[str, Any], dict[str, Any]]:
+    steps, log_proof_gen, conversation = get_proof_current_theorem(theorem, definitions, lemmas, reuse_path, budget)
     full_proof_str = ''.join([s.text for s in steps])
-    success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_theorem(proof_file, proof_term, steps, method)
+    success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_theorem(proof_file, proof_term, steps, method, budget)
     return success, full_proof_str, partial_proof_str, stuck_state, error_tactic, error_msg, conversation, log_proof_gen, log_prove
 
 
-def prove_theorem_regenerate(proof_file: ProofFile, proof_term: ProofTerm, proof_state: str, theorem: str, error_tactic: str, error_msg: str, partial_proof: str, definitions: dict[str, str] | list[str], lemmas: dict[str, str] | list[str], similar_proof: str, method: str = 'hammer_dsp') -> tuple[bool, str, str, str, str, str, list[dict], dict[str, Any], dict[str, Any]]:
-    steps, log, conversation = regenerate_proof(theorem, partial_proof, proof_state, error_tactic, error_msg, definitions, lemmas, similar_proof)
+def prove_theorem_regenerate(proof_file: ProofFile, proof_term: ProofTerm, proof_state: str, theorem: str, error_tactic: str, error_msg: str, partial_proof: str, definitions: dict[str, str] | list[str], lemmas: dict[str, str] | list[str], similar_proof: str, method: str = 'hammer_dsp', budget: Budget | None = None, sessions: SideSessions | None = None) -> tuple[bool, str, str, str, str, str, list[dict], dict[str, Any], dict[str, Any]]:
+    if sessions is not None and Candidates.k > 1:
+        prompt, packing = build_regenerate_prompt(theorem, partial_proof, proof_state, error_tactic, error_msg, definitions, lemmas, similar_proof)
+        candidates, log, conversation = sample_proofs(prompt, Candidates.k, Candidates.temp, budget)
+        log['packing'] = packing
+        if candidates:
+            success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_candidates(proof_file, proof_term, candidates, sessions, method, budget)
+            full_proof_str = ''.join([s.text for s in candidates[log_prove['candidate']]])
+            return success, full_proof_str, partial_proof_str, stuck_state, error_tactic, error_msg, conversation, log, log_prove
+        steps = []
+    elif sessions is not None and Speculation.enabled and method == 'hammer_dsp':
+        # the hammer runs in a side session instead of before the check, the proof
+        # is always streamed so that a hammer proof also stops its generation
+        def attempt(race: HammerRace) -> tuple | None:
+            return race.check(lambda: prove_theorem_stream(proof_file, proof_term, proof_state, theorem, error_tactic, error_msg, partial_proof, definitions, lemmas, similar_proof, 'dsp', budget, race.cancel))
+        return prove_speculative(proof_file, proof_term, sessions, budget, attempt)
+    elif Streaming.enabled:
+        return prove_theorem_stream(proof_file, proof_term, proof_state, theorem, error_tactic, error_msg, partial_proof, definitions, lemmas, similar_proof, method, budget)
+    else:
+        steps, log, conversation = regenerate_proof(theorem, partial_proof, proof_state, error_tactic, error_msg, definitions, lemmas, similar_proof, budget)
     full_proof_str = ''.join([s.text for s in steps])
-    success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_theorem(proof_file, proof_term, steps, method)
+    success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_theorem(proof_file, proof_term, steps, method, budget)
     return success, full_proof_str, partial_proof_str, stuck_state, error_tactic, error_msg, conversation, log, log_prove
+
+
+def prove_theorem_stream(proof_file: ProofFile, proof_term: ProofTerm, proof_state: str, theorem: str, error_tactic: str, error_msg: str, partial_proof: str, definitions: dict[str, str] | list[str], lemmas: dict[str, str] | list[str], similar_proof: str, method: str = 'hammer_dsp', budget: Budget | None = None, cancel: threading.Event | None = None) -> tuple[bool, str, str, str, str, str, list[dict], dict[str, Any], dict[str, Any]]:
+    """
+    Check the regenerated proof while it is generated. The generation stops as
+    soon as the check has an outcome, e.g. at the first error that cannot be
+    repaired, or once the proof is closed.
+    """
+    steps, log, llm = stream_regenerate_proof(theorem, partial_proof, proof_state, error_tactic, error_msg, definitions, lemmas, similar_proof, budget, cancel)
+    try:
+        success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_theorem(proof_file, proof_term, steps, method, budget, cancel)
+    finally:
+        steps.close()
+    response = steps.response.text
+    log['response'] = response
+    log['steps'] = [s.text for s in steps.emitted]
+    log['stream'] = steps.stats()
+    full_proof_str = ''.join(log['steps'])
+    if not success and steps.response.complete and len(extract_code_blocks(response)) > 1:
+        # the stream follows the first block, the batch parser takes the last one
+        steps_last = parse_response_proof(response)
+        log['steps'] = [s.text for s in steps_last]
+        full_proof_str = ''.join(log['steps'])
+        success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_theorem(proof_file, proof_term, steps_last, method, budget, cancel)
+    return success, full_proof_str, partial_proof_str, stuck_state, error_tactic, error_msg, llm.conversation, log, log_prove
+
+
+def prove_candidates(proof_file: ProofFile, proof_term: ProofTerm, candidates: list[list[Step]], sessions: SideSessions, method: str = 'hammer_dsp', budget: Budget | None = None) -> tuple[bool, dict[str, Any], str, str, str, str]:
+    """
+    Check the first candidate in the main document and the others in side
+    sessions, all at once. The first candidate to reach Qed cancels the rest.
+    On failure the main document keeps the partial proof of the first candidate.
+    """
+    if len(candidates) == 1:
+        result = prove_theorem(proof_file, proof_term, candidates[0], method, budget)
+        result[1]['candidate'] = 0
+        return result
+
+    targets = [(proof_file, proof_term)] + sessions.open(proof_file, proof_term, len(candidates) - 1)
+    cancel = threading.Event()
+
+    def check(i: int) -> tuple | None:
+        target_file, target_term = targets[i]
+        try:
+            result = prove_theorem(target_file, target_term, candidates[i], method, budget, cancel)
+        except BudgetExceeded:
+            raise
+        except Exception as e:
+            if i == 0:
+                raise
+            print(f'Candidate {i} failed: {e}')
+            sessions.reset(i - 1)
+            return None
+        if result[0]:
+            cancel.set()
+        return result
+
+    with ThreadPoolExecutor(max_workers=len(candidates)) as pool:
+        results = list(pool.map(check, range(len(candidates))))
+
+    winner = next((i for i, result in enumerate(results) if result is not None and result[0]), 0)
+    success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = results[winner]
+    if winner > 0:
+        # bring the proof found in a side session into the main document
+        success, log_replay = replay_proof(proof_file, proof_term, log_prove['final_proof'])
+        if not success:
+            print(f'Candidate {winner} does not replay in the main document: {log_replay.get("error_msg", "incomplete proof")}')
+            success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = results[0]
+            winner = 0
+    log_prove['candidate'] = winner
+    log_prove['candidates'] = [None if result is None else {'success': result[0], 'error_tactic': result[4], 'error_msg': result[5]} for result in results]
+    return success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg
@@ -1,16 +1,26 @@
 import os
 import json
+import threading
 from typing import Any
 
-from agent_proof.prompt import INITIAL_PROOF_WITH_LEMMAS, INITIAL_PROOF_WO_LEMMAS, REGENERATE_WITH_LEMMAS, REGENERATE_WO_LEMMAS, REGENERATE_WITH_LEMMAS_NEW, REGENERATE_WO_LEMMAS_NEW
-from llmproof.utils import extract_code_blocks
-from utils_coq import parse_response_proof, parse_code, remove_comments
+from agent_proof.prompt import INITIAL_PROOF_WITH_LEMMAS, INITIAL_PROOF_WO_LEMMAS, REGENERATE_WITH_LEMMAS, REGENERATE_WO_LEMMAS
+from utils import extract_code_blocks
+from utils_coq import parse_response_proof, split_code, remove_comments, normalize_spaces
 from llm import LLM
+from budget import Budget
+from agent_proof.stream import StepStream
+from utils_prompt import pack
 from coqpyt.coq.proof_file import ProofFile
 from coqpyt.coq.structs import Step, ProofTerm
 from coqpyt.coq.changes import ProofPop
 
 
+class Candidates:
+    # proofs sampled per regeneration request, 1 turns the candidate mode off
+    k = 1
+    temp = 0.8
+
+
 def clear_proof(proof_file: ProofFile, proof_term: ProofTerm):
     changes = [ProofPop() for _ in range(len(proof_term.steps))]
     proof_file.change_proof(proof_term, changes)
@@ -24,14 +34,23 @@ def _parse_response_proof_refine(response: str, previous_proof: str) -> list[Ste
     if 'no change' in code.lower() and 'Qed' not in code:
         code = previous_proof
     code = remove_comments(code)
-    steps = parse_code(code) # coq_file.parse_code('\n\n' + code)
+    steps = split_code(code)
     for i in range(len(steps)):
         if steps[i].short_text == 'Proof.':
             return steps[i+1:]
     return steps
         
 
-def get_proof_current_theorem(theorem: str, definitions: list[str], lemmas: list[str], reuse_path: str = '') -> tuple[list[Step], dict[str, Any], list[dict]]:
+def build_initial_prompt(theorem: str, definitions: list[str], lemmas: list[str]) -> tuple[str, dict[str, Any]]:
+    template = INITIAL_PROOF_WITH_LEMMAS if lemmas else INITIAL_PROOF_WO_LEMMAS
+    fixed = template.format(theorem=theorem, definitions='', lemmas='')
+    packed, stats = pack(theorem, fixed, {'definitions': list(definitions), 'lemmas': list(lemmas)})
+    definitions_str = '\n\n'.join(packed['definitions'])
+    lemmas_str = '\n\n'.join(packed['lemmas'])
+    return template.format(theorem=theorem, definitions=definitions_str, lemmas=lemmas_str), stats
+
+
+def get_proof_current_theorem(theorem: str, definitions: list[str], lemmas: list[str], reuse_path: str = '', budget: Budget | None = None) -> tuple[list[Step], dict[str, Any], list[dict]]:
     if reuse_path:
         log_path = os.path.join(reuse_path, 'initial_proof.json')
         if os.path.exists(log_path):
@@ -52,14 +71,9 @@ def get_proof_current_theorem(theorem: str, definitions: list[str], lemmas: list
     log['definitions'] = definitions
     log['lemmas'] = lemmas
 
-    definitions_str = '\n\n'.join([text for text in definitions])
-    if lemmas:
-        lemmas_str = '\n\n'.join(lemmas)
-        prompt = INITIAL_PROOF_WITH_LEMMAS.format(theorem=theorem, definitions=definitions_str, lemmas=lemmas_str)
-    else:
-        prompt = INITIAL_PROOF_WO_LEMMAS.format(theorem=theorem, definitions=definitions_str)
+    prompt, log['packing'] = build_initial_prompt(theorem, definitions, lemmas)
 
-    llm = LLM()
+    llm = LLM(budget=budget)
     response = llm.query(prompt, append = True)[0]
     steps = parse_response_proof(response)
     log['prompt'] = prompt
@@ -68,21 +82,23 @@ def get_proof_current_theorem(theorem: str, definitions: list[str], lemmas: list
     return steps, log, llm.conversation
 
 
-def regenerate_proof(theorem: str, partial_proof: str, proof_state: str, error_tactic: str, error_msg: str, definitions: dict[str, str] | list[str], lemmas: dict[str, str] | list[str], similar_proof: str) -> tuple[list[Step], dict[str, Any], list[dict]]:
-    llm = LLM()
+def build_regenerate_prompt(theorem: str, partial_proof: str, proof_state: str, error_tactic: str, error_msg: str, definitions: dict[str, str] | list[str], lemmas: dict[str, str] | list[str], similar_proof: str) -> tuple[str, dict[str, Any]]:
     if isinstance(definitions, dict):
-        definitions_str = '\n\n'.join([text for text in definitions.values()])
-    else:
-        definitions_str = '\n\n'.join(definitions)
+        definitions = list(definitions.values())
     if isinstance(lemmas, dict):
-        lemmas_str = '\n\n'.join([lemma for _, lemma in lemmas.items()])
-    else:
-        lemmas_str = '\n\n'.join(lemmas)
-    if lemmas:
-        prompt = REGENERATE_WITH_LEMMAS.format(theorem=theorem, partial_proof=partial_proof, proof_state=proof_state, error_tactic=error_tactic, error_msg=error_msg, definitions=definitions_str, lemmas=lemmas_str, similar_proof=similar_proof)
-    else:
-        prompt = REGENERATE_WO_LEMMAS.format(theorem=theorem, partial_proof=partial_proof, proof_state=proof_state, error_tactic=error_tactic, error_msg=error_msg, definitions=definitions_str, lemmas=lemmas_str, similar_proof=similar_proof)
+        lemmas = list(lemmas.values())
+    template = REGENERATE_WITH_LEMMAS if lemmas else REGENERATE_WO_LEMMAS
+    fields = dict(theorem=theorem, partial_proof=partial_proof, proof_state=proof_state, error_tactic=error_tactic, error_msg=error_msg, similar_proof=similar_proof)
+    fixed = template.format(definitions='', lemmas='', **fields)
+    packed, stats = pack(theorem + '\n' + proof_state, fixed, {'definitions': list(definitions), 'lemmas': list(lemmas)})
+    definitions_str = '\n\n'.join(packed['definitions'])
+    lemmas_str = '\n\n'.join(packed['lemmas'])
+    return template.format(definitions=definitions_str, lemmas=lemmas_str, **fields), stats
+
 
+def regenerate_proof(theorem: str, partial_proof: str, proof_state: str, error_tactic: str, error_msg: str, definitions: dict[str, str] | list[str], lemmas: dict[str, str] | list[str], similar_proof: str, budget: Budget | None = None) -> tuple[list[Step], dict[str, Any], list[dict]]:
+    llm = LLM(budget=budget)
+    prompt, packing = build_regenerate_prompt(theorem, partial_proof, proof_state, error_tactic, error_msg, definitions, lemmas, similar_proof)
     response = llm.query(prompt)[0]
     steps = parse_response_proof(response)
     log = {
@@ -93,6 +109,47 @@ def regenerate_proof(theorem: str, partial_proof: str, proof_state: str, error_t
         'lemmas': lemmas,
         'steps': [s.text for s in steps],
         'prompt': prompt,
+        'packing': packing,
         'response': response
     }
     return steps, log, llm.conversation
+
+
+def stream_regenerate_proof(theorem: str, partial_proof: str, proof_state: str, error_tactic: str, error_msg: str, definitions: dict[str, str] | list[str], lemmas: dict[str, str] | list[str], similar_proof: str, budget: Budget | None = None, cancel: threading.Event | None = None) -> tuple[StepStream, dict[str, Any], LLM]:
+    # like regenerate_proof, but the steps arrive while the proof is checked
+    llm = LLM(budget=budget)
+    prompt, packing = build_regenerate_prompt(theorem, partial_proof, proof_state, error_tactic, error_msg, definitions, lemmas, similar_proof)
+    steps = StepStream(llm.stream(prompt), cancel)
+    log = {
+        'theorem': theorem,
+        'partial_proof': partial_proof,
+        'proof_state': proof_state,
+        'definitions': definitions,
+        'lemmas': lemmas,
+        'prompt': prompt,
+        'packing': packing,
+    }
+    return steps, log, llm
+
+
+def sample_proofs(prompt: str, k: int, temp: float, budget: Budget | None = None) -> tuple[list[list[Step]], dict[str, Any], list[dict]]:
+    # k completions in one request, proofs equal up to whitespace are kept once
+    llm = LLM(budget=budget)
+    llm.temp = temp
+    responses = llm.query(prompt, append=False, n=k)
+    candidates = []
+    seen = set()
+    for response in responses:
+        steps = parse_response_proof(response)
+        key = tuple(normalize_spaces(s.text.strip()) for s in steps)
+        if not steps or key in seen:
+            continue
+        seen.add(key)
+        candidates.append(steps)
+    log = {
+        'prompt': prompt,
+        'responses': responses,
+        'candidates': [[s.text for s in steps] for steps in candidates],
+    }
+    conversation = [{'role': 'user', 'content': prompt}, {'role': 'assistant', 'content': responses[0]}]
+    return candidates, log, conversation
@@ -1,10 +1,12 @@
+import threading
 from typing import Any
 from collections import deque
 import re
 
 from agent_proof.repair_state import basic_repair, backtrack
 from utils_hammer import *
-from utils_coq import format_goal
+from utils_coq import format_goal, goal_fingerprint
+from budget import Budget
 from coqpyt.coq.proof_file import ProofFile
 from coqpyt.coq.structs import Step, ProofTerm
 from coqpyt.coq.exceptions import InvalidChangeException
@@ -25,17 +27,34 @@ def format_current_goal(proof_file: ProofFile):
     return goal_str
 
 
-def prove(proof_file: ProofFile, proof_term: ProofTerm, steps: List[Step]) -> tuple[bool, dict[str, Any]]:
+def current_state(proof_file: ProofFile) -> dict[str, str]:
+    goals = proof_file.current_goals.goals.goals
+    if not goals:
+        return {'goal': 'current goal completed', 'goal_fingerprint': ''}
+    return {'goal': format_goal(goals[0]), 'goal_fingerprint': goal_fingerprint(goals[0])}
+
+
+def cancelled(proof_file: ProofFile, proof_term: ProofTerm, exe_results: list[dict]) -> dict[str, Any]:
+    return {'success': False, 'results': exe_results, 'final_proof': get_final_proof(proof_term), \
+            'stuck_state': format_current_goal(proof_file), 'error_tactic': '<cancelled>', 'error_msg': 'Another candidate was proved first'}
+
+
+def prove(proof_file: ProofFile, proof_term: ProofTerm, steps: List[Step], budget: Budget | None = None, cancel: threading.Event | None = None) -> tuple[bool, dict[str, Any]]:
     exe_results = []
-    steps = deque(steps)
+    # a StepStream is consumed in place while it fills
+    steps = steps if isinstance(steps, deque) else deque(steps)
     while steps:
+        if budget is not None:
+            budget.check()
+        if cancel is not None and cancel.is_set():
+            return False, cancelled(proof_file, proof_term, exe_results)
         step = steps.popleft()
         text = step.text
         print('executing: ', text)
         if 'admit.' in text or 'Admitted.' in text:
             continue
 
-        step_result = {'step': text, 'goal': format_current_goal(proof_file)}
+        step_result = {'step': text, **current_state(proof_file)}
         try:
             proof_file.append_step(proof_term, text)
             step_result['succ'] = True
@@ -58,7 +77,7 @@ def prove(proof_file: ProofFile, proof_term: ProofTerm, steps: List[Step]) -> tu
             if repair_success:
                 exe_results.append(step_result)
             else:
-                hammer_succ, tactic = hammer(proof_file, proof_term)
+                hammer_succ, tactic = hammer(proof_file, proof_term, budget)
                 print("Hammering: ", hammer_succ)
                 step_result['hammer_succ'] = hammer_succ
                 if hammer_succ:
@@ -110,8 +129,8 @@ def prove(proof_file: ProofFile, proof_term: ProofTerm, steps: List[Step]) -> tu
             clear_proof(proof_file, proof_term)
             return False, log
 
-    step_result = {'step': '$last_hammer$', 'goal': format_current_goal(proof_file)}
-    hammer_succ, tactic = hammer(proof_file, proof_term)
+    step_result = {'step': '$last_hammer$', **current_state(proof_file)}
+    hammer_succ, tactic = hammer(proof_file, proof_term, budget)
     if hammer_succ:
         try:
             proof_file.append_step(proof_term, tactic)
@@ -139,9 +158,26 @@ def prove(proof_file: ProofFile, proof_term: ProofTerm, steps: List[Step]) -> tu
                         'stuck_state': format_current_goal(proof_file), 'error_tactic': 'incomplete proof', 'error_msg': 'The proof is not completed'}
 
 
-def prove_hammer_first(proof_file: ProofFile, proof_term: ProofTerm, steps: List[Step]) -> Tuple[bool, Dict[str, Any]]:
+def replay_proof(proof_file: ProofFile, proof_term: ProofTerm, proof: list[str]) -> tuple[bool, dict[str, Any]]:
+    if len(proof_term.steps) > 0:
+        clear_proof(proof_file, proof_term)
+    for text in proof:
+        try:
+            proof_file.append_step(proof_term, f'\n{text}')
+        except (InvalidChangeException, ResponseError) as e:
+            error_msg = e.errors[-1].message if isinstance(e, InvalidChangeException) and e.errors else str(e)
+            log = {'success': False, 'final_proof': get_final_proof(proof_term), 'error_tactic': text, 'error_msg': error_msg}
+            clear_proof(proof_file, proof_term)
+            return False, log
+    success = len(proof) > 0 and proof[-1].strip() in ['Qed.', 'Defined.']
+    if not success:
+        clear_proof(proof_file, proof_term)
+    return success, {'success': success, 'final_proof': proof}
+
+
+def prove_hammer_first(proof_file: ProofFile, proof_term: ProofTerm, steps: List[Step], budget: Budget | None = None, cancel: threading.Event | None = None) -> Tuple[bool, Dict[str, Any]]:
     initial_goal = format_current_goal(proof_file)
-    hammer_succ, tactic = hammer(proof_file, proof_term)
+    hammer_succ, tactic = hammer(proof_file, proof_term, budget)
     if hammer_succ:
         try:
             proof_file.append_step(proof_term, f'\n{tactic}')
@@ -149,13 +185,18 @@ def prove_hammer_first(proof_file: ProofFile, proof_term: ProofTerm, steps: List
             return True, {'success': True, 'results': [{'step': f' {tactic}', 'goal': initial_goal, 'succ': True, 'hammer_succ': True, 'hammer_tactic': tactic}], 'final_proof': get_final_proof(proof_term), 'stuck_state': '', 'error_tactic': '', 'error_msg': ''}
         except Exception as e:
             clear_proof(proof_file, proof_term)
-    return prove(proof_file, proof_term, steps)
+    return prove(proof_file, proof_term, steps, budget, cancel)
 
 
-def prove_backtrack(proof_file: ProofFile, proof_term: ProofTerm, steps: List[Step]) -> Tuple[bool, Dict[str, Any]]:
+def prove_backtrack(proof_file: ProofFile, proof_term: ProofTerm, steps: List[Step], budget: Budget | None = None, cancel: threading.Event | None = None) -> Tuple[bool, Dict[str, Any]]:
     exe_results = []
-    steps = deque(steps)
+    # a StepStream is consumed in place while it fills
+    steps = steps if isinstance(steps, deque) else deque(steps)
     while steps:
+        if budget is not None:
+            budget.check()
+        if cancel is not None and cancel.is_set():
+            return False, cancelled(proof_file, proof_term, exe_results)
         step = steps.popleft()
         # text = step.text.rstrip()
         text = step.text
@@ -165,7 +206,7 @@ def prove_backtrack(proof_file: ProofFile, proof_term: ProofTerm, steps: List[St
             print('executing: ', text) 
             if step.short_text == 'admit.':
                 continue
-            step_result = {'step': text, 'goal': format_current_goal(proof_file)}
+            step_result = {'step': text, **current_state(proof_file)}
             proof_file.append_step(proof_term, text)
             step_result['succ'] = True
             exe_results.append(step_result)
@@ -179,7 +220,7 @@ def prove_backtrack(proof_file: ProofFile, proof_term: ProofTerm, steps: List[St
             exe_results.append(step_result)
             print('error: ', error_msg)
             if not repair_success:
-                backtrack_success = backtrack(proof_file, proof_term, steps)
+                backtrack_success = backtrack(proof_file, proof_term, steps, budget)
                 step_result['succ'] = backtrack_success
                 exe_results.append(step_result)
                 if not backtrack_success:
@@ -6,9 +6,11 @@ from coqpyt.coq.context import FileContext
 from coqpyt.coq.structs import Term, Step, ProofTerm
 from coqpyt.coq.lsp.structs import Goal, Hyp
 from coqpyt.coq.exceptions import InvalidChangeException
+from coqpyt.lsp.structs import ResponseError
 
-from ..utils_hammer import hammer, hammer_tactic
-from ..utils_coq import *
+from utils_hammer import hammer, hammer_tactic
+from budget import Budget
+from utils_coq import *
 
 
 UNFINISHED_BULLET = r'Wrong bullet (.*?): Current bullet (.*?) is not finished'
@@ -45,21 +47,25 @@ def is_hammer_tactic(tactic: str) -> bool:
             return True
     return False
 
-def backtrack(proof_file: ProofFile, proof_term: ProofTerm, steps: Deque[Step]) -> bool: 
+def backtrack(proof_file: ProofFile, proof_term: ProofTerm, steps: Deque[Step], budget: Budget | None = None) -> bool: 
     hammer_times = 0
     print('start backtrack')
     while True:
-        succ, replace = hammer(proof_file, proof_term)
+        succ, replace = hammer(proof_file, proof_term, budget)
         print('hammering: ', hammer_times, succ)
         hammer_times += 1
         if succ:
-            proof_file.append_step(proof_term, replace)
-            # print(replace)
-            # print(proof_file.current_goals)
-            if not proof_file.current_goals.goals.goals:
-                return True
-            else:
-                proof_file.pop_step(proof_term)
+            try:
+                proof_file.append_step(proof_term, replace)
+                # print(replace)
+                # print(proof_file.current_goals)
+                if not proof_file.current_goals.goals.goals:
+                    return True
+                else:
+                    proof_file.pop_step(proof_term)
+            except (InvalidChangeException, ResponseError) as e:
+                # a reconstructed tactic may still fail where it was found, keep backtracking
+                print('hammer tactic failed: ', e)
         # else:
         if not proof_term.steps or proof_term.steps[-1].step.short_text == 'Proof.':
             return False
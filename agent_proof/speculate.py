@@ -0,0 +1,168 @@
+import time
+import threading
+import contextvars
+from typing import Any, Callable
+
+from budget import Budget
+from checkpoint import SideSessions
+from utils_hammer import hammer
+from agent_proof.proof import replay_proof, current_state
+from coqpyt.coq.proof_file import ProofFile
+from coqpyt.coq.structs import ProofTerm
+from coqpyt.coq.changes import ProofPop
+
+
+class Speculation:
+    # hammer the goal in a side session while the LLM writes the proof
+    enabled = False
+
+
+class HammerRace:
+    """
+    The hammer on the goal of an empty proof, run in a side session while the
+    LLM proof is generated and checked in the main document. `cancel` is set
+    as soon as the hammer closed the goal, to stop the check of the LLM proof;
+    `stop` ends a hammer that is no longer needed by closing its session and
+    waits for it, so that it has charged the budget before the usage is logged.
+    """
+    def __init__(self, proof_file: ProofFile, proof_term: ProofTerm, sessions: SideSessions, budget: Budget | None = None):
+        self.proof_file = proof_file
+        self.proof_term = proof_term
+        self.sessions = sessions
+        self.budget = budget
+        self.cancel = threading.Event()
+        self.decided = threading.Event()  # the hammer closed the goal or the LLM attempt ended
+        self.doc = threading.Lock()  # held while the LLM proof is checked in the main document
+        self.lock = threading.Lock()
+        self.opened = False
+        self.stopped = False
+        self.checked = False
+        self.tactic = None
+        self.message = ''
+        self.start = time.time()
+        self.duration = None
+        # the telemetry context of the theorem carries over to the thread
+        self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self._run,), daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            side_file, side_term = self.sessions.open(self.proof_file, self.proof_term, 1)[0]
+            with self.lock:
+                if self.stopped:
+                    return
+                self.opened = True
+            success, message = hammer(side_file, side_term, self.budget)
+            if success:
+                self.tactic = message
+                self.cancel.set()
+                self.decided.set()
+            else:
+                self.message = message
+        except Exception as e:
+            # also a session closed by `stop`
+            self.message = repr(e)
+        finally:
+            self.duration = time.time() - self.start
+
+    def check(self, prove: Callable[[], tuple]) -> tuple | None:
+        # check the LLM proof in the main document, unless the hammer already won
+        with self.doc:
+            if self.cancel.is_set():
+                return None
+            self.checked = True
+            return prove()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            running = self.opened and self.thread.is_alive()
+            if running:
+                try:
+                    self.sessions.reset(0)
+                except Exception as e:
+                    print(f'Closing the hammer session failed: {e!r}')
+        if running:
+            self.thread.join()
+
+    def stats(self, winner: str) -> dict[str, Any]:
+        return {
+            'winner': winner,
+            'hammer_tactic': self.tactic,
+            'hammer_msg': self.message,
+            'hammer_time': self.duration,
+            'time': time.time() - self.start,
+        }
+
+
+def prove_speculative(proof_file: ProofFile, proof_term: ProofTerm, sessions: SideSessions, budget: Budget | None, attempt: Callable[[HammerRace], tuple | None]) -> tuple:
+    """
+    Race the hammer against `attempt`, which streams an LLM proof and checks it
+    through `race.check`, with `race.cancel` as its cancel event for both. It returns
+    the result of `prove_theorem_regenerate`, or None if the hammer had won
+    before the check started. The first to close the goal wins, but both have
+    ended when this returns, so neither charges `budget` afterwards.
+    """
+    if len(proof_term.steps) > 0:
+        proof_file.change_proof(proof_term, [ProofPop() for _ in range(len(proof_term.steps))])
+    initial_state = current_state(proof_file)
+    race = HammerRace(proof_file, proof_term, sessions, budget)
+    outcome = {}
+    attempt_done = threading.Event()
+
+    def run_attempt():
+        try:
+            outcome['result'] = attempt(race)
+        except BaseException as e:
+            outcome['error'] = e
+        finally:
+            attempt_done.set()
+            race.decided.set()
+
+    threading.Thread(target=contextvars.copy_context().run, args=(run_attempt,), daemon=True).start()
+    race.decided.wait()
+    if race.tactic is None:
+        if 'error' in outcome:
+            race.stop()
+            raise outcome['error']
+        result = outcome['result']
+        if result[0]:
+            race.stop()
+            result[7]['speculative'] = race.stats('llm')
+            return result
+        # the LLM proof failed, the hammer may still close the goal
+        race.thread.join()
+        if race.tactic is None:
+            result[7]['speculative'] = race.stats('none')
+            return result
+
+    with race.doc:
+        checked = race.checked
+    if checked:
+        # the check ran and has ended, cancelled or not, its proof may have been first
+        attempt_done.wait()
+        result = outcome.get('result')
+        if result is not None and result[0]:
+            result[7]['speculative'] = race.stats('llm')
+            return result
+
+    with race.doc:
+        success, log_replay = replay_proof(proof_file, proof_term, [race.tactic.strip(), 'Qed.'])
+    if success:
+        # the cancelled check and its generation end at the next delta
+        attempt_done.wait()
+        log_prove = {'success': True, 'results': [{'step': f' {race.tactic}', **initial_state, 'succ': True, 'hammer_succ': True, 'hammer_tactic': race.tactic}],
+                     'final_proof': log_replay['final_proof'], 'stuck_state': '', 'error_tactic': '', 'error_msg': ''}
+        return True, race.tactic, log_prove['final_proof'], '', '', '', [], {'speculative': race.stats('hammer')}, log_prove
+
+    print(f'Hammer proof does not replay in the main document: {log_replay.get("error_msg", "incomplete proof")}')
+    # the attempt was cancelled by the hammer, its outcome is still needed
+    attempt_done.wait()
+    if 'error' in outcome:
+        raise outcome['error']
+    result = outcome.get('result')
+    if result is None:
+        log_prove = {'success': False, 'results': [], 'final_proof': [], 'stuck_state': initial_state['goal'], 'error_tactic': race.tactic, 'error_msg': log_replay.get('error_msg', '')}
+        return False, race.tactic, [], log_prove['stuck_state'], log_prove['error_tactic'], log_prove['error_msg'], [], {'speculative': race.stats('none')}, log_prove
+    result[7]['speculative'] = race.stats('none')
+    return result
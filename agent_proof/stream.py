@@ -0,0 +1,134 @@
+import time
+import threading
+from collections import deque
+from typing import Any
+
+from llm import ResponseStream
+from utils_coq import to_step
+from utils_lexer import SentenceSplitter
+from coqpyt.coq.structs import Step
+
+
+class Streaming:
+    # feed proof steps to the executor while the response is generated
+    enabled = False
+
+
+# sentences that open a statement, its proof starts after `Proof.`
+HEADERS = ('Theorem', 'Lemma', 'Fact', 'Remark', 'Corollary', 'Proposition', 'Example', 'Definition', 'Fixpoint', 'Goal',
+           'Require', 'From', 'Import', 'Export', 'Open', 'Set', 'Local', 'Section', 'Variable', 'Hypothesis', 'Context')
+
+
+class StepStream(deque):
+    """
+    The steps of a streamed proof, for `prove` in place of the parsed steps.
+    A reader thread fills it as sentences complete; taking a step or testing
+    for emptiness waits until the next one is complete or the response ended.
+    Once `cancel` is set, the response is ended instead of waited for.
+    """
+    def __init__(self, response: ResponseStream, cancel: threading.Event | None = None):
+        super().__init__()
+        self.response = response
+        self.cancel = cancel
+        self.splitter = SentenceSplitter(fence=True)
+        self.emitted: list[Step] = []
+        self.held: list[Step] = []
+        self.proof_started = False
+        self.ended = False
+        self.error = ''
+        self.first_step = None
+        self.cond = threading.Condition()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _push(self, sentences: list[str]):
+        steps = []
+        for sentence in sentences:
+            step = to_step(sentence)
+            # as in `parse_response_proof`, a repeated statement is skipped up to `Proof.`
+            if not self.proof_started:
+                if step.short_text == 'Proof.':
+                    self.proof_started = True
+                    self.held = []
+                    continue
+                if self.held or step.short_text.startswith(HEADERS):
+                    self.held.append(step)
+                    continue
+                self.proof_started = True
+            steps.append(step)
+        if not steps:
+            return
+        with self.cond:
+            if self.first_step is None:
+                self.first_step = time.time() - self.response.start
+            self.emitted.extend(steps)
+            super().extend(steps)
+            self.cond.notify_all()
+
+    def _read(self):
+        try:
+            for delta in self.response:
+                self._push(self.splitter.feed(delta))
+            self._push(self.splitter.finish())
+            if not self.proof_started:
+                # no `Proof.` after all, the statement is part of the proof
+                self.proof_started = True
+                held, self.held = self.held, []
+                with self.cond:
+                    self.emitted.extend(held)
+                    super().extend(held)
+        except Exception as e:
+            # a broken connection ends the proof where it broke
+            print(f'LLM stream failed: {e!r}')
+            self.error = repr(e)
+        finally:
+            with self.cond:
+                self.ended = True
+                self.cond.notify_all()
+
+    def _wait(self, count: int):
+        with self.cond:
+            while super().__len__() < count and not self.ended:
+                if self.cancel is not None and self.cancel.is_set():
+                    # the reader stops at the next delta, not at the next sentence
+                    self.response.cancel()
+                self.cond.wait(None if self.cancel is None else 0.1)
+
+    def __len__(self) -> int:
+        self._wait(1)
+        return super().__len__()
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __getitem__(self, index: int) -> Step:
+        if index >= 0:
+            self._wait(index + 1)
+        else:
+            self._wait(float('inf'))
+        return super().__getitem__(index)
+
+    def popleft(self) -> Step:
+        self._wait(1)
+        with self.cond:
+            return super().popleft()
+
+    def appendleft(self, step: Step):
+        with self.cond:
+            super().appendleft(step)
+
+    def close(self):
+        # stop the generation, the executor has decided
+        self.response.cancel()
+        self.reader.join()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'complete': self.response.complete,
+            'cancelled': self.response.cancelled and not self.response.complete,
+            'first_delta': self.response.first_delta,
+            'first_step': self.first_step,
+            'duration': time.time() - self.response.start,
+            'steps': len(self.emitted),
+            'error': self.error,
+        }
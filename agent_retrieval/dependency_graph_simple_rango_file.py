@@ -4,6 +4,7 @@ import json
 import re
 from coqpyt.coq.structs import ProofTerm, ProofStep, Term
 from agent_retrieval.tactics import all_tactics, keywords
+from utils_lexer import identifiers
 
 types = ['LEMMA', 'THEOREM', 'COROLLARY']
 
@@ -24,14 +25,10 @@ def get_theorem_name(text: str) -> str:
     
 
 def get_ids_from_sentence(text) -> list[str]:
-    ID_FORM = re.compile(r"[^\[\]\{\}\(\);:=,\s]+")
-    sentence_ids = re.findall(ID_FORM, text)
     sentence_ids_sanitized = []
-    for id_ in sentence_ids:
+    for id_ in identifiers(text):
         if id_ in all_tactics or id_ in keywords:
             continue
-        if id_.endswith('.'):
-            id_ = id_[:-1].strip()
         sentence_ids_sanitized.append(id_)
     return sentence_ids_sanitized
 
@@ -1,6 +1,6 @@
 import numpy as np
 from rank_bm25 import BM25Okapi
-from ..utils_coq import normalize_spaces, get_ids_in_step, get_ids_in_step_recursive
+from utils_coq import normalize_spaces, get_ids_in_step, get_ids_in_step_recursive
 from coqpyt.coq.proof_file import ProofFile
 from coqpyt.coq.structs import Term, Step, ProofTerm, TermType
 from coqpyt.coq.lsp.structs import Goal, Hyp
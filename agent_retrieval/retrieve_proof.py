@@ -10,19 +10,16 @@ from agent_retrieval.retrieve_hammer import retrieve_hammer
 from agent_retrieval.tactics import all_tactics
 from utils import json_load, json_dump, find_datapoint_dir_from_file
 from utils_coq import remove_comments, get_ids_in_step_recursive, parse_response_proof, format_goal
+from utils_lexer import identifiers
 from path import DATASET_NORMAL
 import os
 
 
-IDENT_PATTERN = re.compile(r'[a-zA-Z_][a-zA-Z0-9_\']*(?:\.[a-zA-Z_][a-zA-Z0-9_\']*)*')
-
 def extract_identifiers_in_sentence(sentence: str):
     if not sentence:
         return []
-    identifiers = IDENT_PATTERN.findall(sentence)
-
     results = set()
-    for identifier in identifiers:
+    for identifier in identifiers(sentence):
         if '.' in identifier:
             results.add(identifier.split('.')[-1])
         else:
@@ -0,0 +1,273 @@
+"""
+Multi-node execution of prove_project through a shared-directory work queue.
+
+The coordinator publishes one JSON file per task into `<queue_dir>/pending`.
+Workers on any host that sees the directory lease a task by renaming it into
+`leased` (rename is atomic), keep the lease alive by touching the file while
+they work, and report the result into `done`. A lease whose file has not been
+touched for `lease_timeout` seconds belongs to a crashed worker and is moved
+back to `pending` by the coordinator.
+
+Workers should run from a checkout on shared storage, so that their logs land in
+the same `log/` directory; the ledger is only written by the coordinator.
+"""
+import os
+import time
+import json
+import socket
+import hashlib
+import argparse
+import threading
+
+from llm import LLM
+from budget import Budget
+from llm_cache import ResponseCache, MODES as CACHE_MODES
+from hammer_cache import HammerCache
+from llm_client import Limits
+from utils_prompt import Packing, Compaction
+from telemetry import Telemetry
+from agent_proof.gen_proof import Candidates
+from agent_proof.stream import Streaming
+from agent_proof.speculate import Speculation
+from main.framework import Replay
+from ledger import TaskSkipped, get_ledger
+from run import collect_tasks, _prove_one_thm
+from checkpoint import close_checkpoint
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FINISHED = 'finished'
+
+
+def queue_path(queue_dir: str, state: str, name: str = '') -> str:
+    if not name:
+        return os.path.join(queue_dir, state)
+    return os.path.join(queue_dir, state, name)
+
+
+def task_name(exp_name: str, proj: str, commit: str, file: str, theorem: str) -> str:
+    # tasks of the same (commit, file) share a prefix, so a worker can stay on its file;
+    # the experiment is part of it, so a reused queue directory does not mix experiments
+    group = hashlib.sha1(f'{exp_name}/{proj}/{commit}/{file}'.encode()).hexdigest()[:12]
+    thm = hashlib.sha1(theorem.encode()).hexdigest()[:12]
+    return f'{group}-{thm}'
+
+
+def publish(queue_dir: str, all_tasks: list[tuple]) -> list[str]:
+    for state in [PENDING, LEASED, DONE]:
+        os.makedirs(queue_path(queue_dir, state), exist_ok=True)
+    # left by an earlier experiment on the same queue, workers would exit at once
+    if os.path.exists(queue_path(queue_dir, FINISHED)):
+        os.remove(queue_path(queue_dir, FINISHED))
+    file_targets: dict[tuple[str, str], list[dict]] = {}
+    for task in all_tasks:
+        file_targets.setdefault((task[3], task[5]), []).append(task[6])
+
+    names = []
+    for exp_name, workspace, proj, commit, parent_commit, file, thm, _, resume, checkpoint, incremental in all_tasks:
+        name = task_name(exp_name, proj, commit, file, thm['name'])
+        names.append(name)
+        if os.path.exists(queue_path(queue_dir, DONE, name + '.json')):
+            continue
+        spec = {
+            'exp_name': exp_name, 'workspace': workspace, 'proj': proj, 'commit': commit, 'parent_commit': parent_commit,
+            'file': file, 'task': thm, 'tasks': file_targets[(commit, file)], 'resume': resume, 'checkpoint': checkpoint, 'incremental': incremental,
+        }
+        tmp = queue_path(queue_dir, PENDING, f'.{name}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(spec, f)
+        os.replace(tmp, queue_path(queue_dir, PENDING, name + '.json'))
+    return names
+
+
+def lease(queue_dir: str, worker: str, prefer_group: str = '') -> tuple[str, str] | None:
+    pending = sorted(n for n in os.listdir(queue_path(queue_dir, PENDING)) if n.endswith('.json'))
+    # tasks of the file the worker is warm on come first
+    if prefer_group:
+        pending.sort(key=lambda n: not n.startswith(prefer_group + '-'))
+    for file_name in pending:
+        name = file_name[:-len('.json')]
+        leased = queue_path(queue_dir, LEASED, f'{name}@{worker}.json')
+        try:
+            os.rename(queue_path(queue_dir, PENDING, file_name), leased)
+        except FileNotFoundError:
+            # another worker was faster
+            continue
+        os.utime(leased)
+        return name, leased
+    return None
+
+
+def complete(queue_dir: str, name: str, leased: str, result: dict):
+    tmp = queue_path(queue_dir, DONE, f'.{name}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(result, f)
+    os.replace(tmp, queue_path(queue_dir, DONE, name + '.json'))
+    if os.path.exists(leased):
+        os.remove(leased)
+
+
+def requeue_expired(queue_dir: str, lease_timeout: float) -> int:
+    count = 0
+    now = time.time()
+    for file_name in os.listdir(queue_path(queue_dir, LEASED)):
+        leased = queue_path(queue_dir, LEASED, file_name)
+        try:
+            if now - os.path.getmtime(leased) < lease_timeout:
+                continue
+            name = file_name.split('@')[0]
+            if os.path.exists(queue_path(queue_dir, DONE, name + '.json')):
+                os.remove(leased)
+            else:
+                os.rename(leased, queue_path(queue_dir, PENDING, name + '.json'))
+                count += 1
+        except FileNotFoundError:
+            continue
+    return count
+
+
+def heartbeat(leased: str, interval: float, stop: threading.Event):
+    while not stop.wait(interval):
+        try:
+            os.utime(leased)
+        except FileNotFoundError:
+            # the lease expired and the task was handed out again, the result is still reported
+            pass
+
+
+def coordinator(queue_dir: str, exp_name: str, proj: str, resume: str, checkpoint: bool, incremental: bool, lease_timeout: float, poll: float):
+    all_tasks = collect_tasks(exp_name, proj, resume, checkpoint, incremental)
+    names = publish(queue_dir, all_tasks)
+    specs = {name: task for name, task in zip(names, all_tasks)}
+    print(f'Published {len(names)} tasks to {queue_dir}')
+
+    ledger = get_ledger()
+    recorded = set()
+    while len(recorded) < len(names):
+        for file_name in os.listdir(queue_path(queue_dir, DONE)):
+            name = file_name[:-len('.json')]
+            if not file_name.endswith('.json') or name in recorded or name not in specs:
+                continue
+            with open(queue_path(queue_dir, DONE, file_name)) as f:
+                result = json.load(f)
+            task = specs[name]
+            exp_name, _, proj, commit, _, file, thm = task[:7]
+            ledger.start(exp_name, proj, commit, file, thm['name'])
+            if result.get('skipped'):
+                ledger.skip(exp_name, proj, commit, file, thm['name'], result['skipped'], result['duration'])
+            elif result['error']:
+                ledger.error(exp_name, proj, commit, file, thm['name'], result['error'], result['duration'], result.get('tokens'))
+            else:
+                ledger.finish(exp_name, proj, commit, file, thm['name'], result['success'], result['duration'], result.get('tokens'))
+            recorded.add(name)
+
+        requeued = requeue_expired(queue_dir, lease_timeout)
+        if requeued:
+            print(f'Re-queued {requeued} expired leases')
+        print(f'Done {len(recorded)}/{len(names)}')
+        if len(recorded) < len(names):
+            time.sleep(poll)
+
+    open(queue_path(queue_dir, FINISHED), 'w').close()
+
+
+def worker(queue_dir: str, worker_id: str, heartbeat_interval: float, poll: float):
+    group = ''
+    while True:
+        leased_task = lease(queue_dir, worker_id, group)
+        if leased_task is None:
+            if os.path.exists(queue_path(queue_dir, FINISHED)):
+                break
+            time.sleep(poll)
+            continue
+
+        name, leased = leased_task
+        group = name.split('-')[0]
+        with open(leased) as f:
+            spec = json.load(f)
+
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat, args=(leased, heartbeat_interval, stop), daemon=True)
+        beat.start()
+        start = time.time()
+        result = {'worker': worker_id, 'success': False, 'error': None, 'skipped': None}
+        budget = Budget()
+        try:
+            result['success'] = _prove_one_thm(spec['exp_name'], spec['workspace'], spec['proj'], spec['commit'], spec['parent_commit'],
+                                               spec['file'], spec['task'], spec['tasks'], spec['resume'], spec['checkpoint'], spec['incremental'], budget)
+        except TaskSkipped as e:
+            print('Skipped: ', spec['file'], spec['task']['name'], e)
+            result['skipped'] = str(e)
+        except Exception as e:
+            print('Error: ', spec['file'], spec['task']['name'], e)
+            result['error'] = repr(e)
+            close_checkpoint()
+        finally:
+            stop.set()
+            beat.join()
+        result['duration'] = time.time() - start
+        result['tokens'] = budget.tokens
+        complete(queue_dir, name, leased, result)
+    close_checkpoint()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['coordinator', 'worker'])
+    parser.add_argument('--queue_dir', type=str, required=True)
+    parser.add_argument('--exp_name', type=str)
+    parser.add_argument('--proj', type=str)
+    parser.add_argument('--model', type=str, choices=['gpt-4o', 'gpt-4o-mini', 'deepseek-chat', 'claude-3-7-sonnet-20250219', 'meta-llama/llama-4-maverick-17b-128e-instruct-fp8'])
+    parser.add_argument('--temp', type=float, default=0)
+    parser.add_argument('--top_p', type=float, default=1)
+    parser.add_argument('--resume', type=str, default='')
+    parser.add_argument('--checkpoint', action='store_true')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--replay_from', type=str, nargs='*', default=[])
+    parser.add_argument('--replay_human', action='store_true')
+    parser.add_argument('--candidates', type=int, default=1)
+    parser.add_argument('--candidate_temp', type=float, default=0.8)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--speculative_hammer', action='store_true')
+    parser.add_argument('--llm_cache', type=str, default='off', choices=CACHE_MODES)
+    parser.add_argument('--llm_base_url', type=str, default='')
+    parser.add_argument('--rpm', type=int, default=0)
+    parser.add_argument('--prompt_tokens', type=int, default=0)
+    parser.add_argument('--history_tokens', type=int, default=0)
+    parser.add_argument('--hammer_cache', action='store_true')
+    parser.add_argument('--telemetry', action='store_true')
+    parser.add_argument('--max_time', type=float, default=0)
+    parser.add_argument('--max_tokens', type=int, default=0)
+    parser.add_argument('--max_hammer_calls', type=int, default=0)
+    parser.add_argument('--max_iters', type=int, default=3)
+    parser.add_argument('--worker_id', type=str, default=f'{socket.gethostname()}-{os.getpid()}')
+    parser.add_argument('--lease_timeout', type=float, default=300, help='seconds without heartbeat before a task is re-queued')
+    parser.add_argument('--heartbeat', type=float, default=30)
+    parser.add_argument('--poll', type=float, default=10)
+    args = parser.parse_args()
+
+    LLM.model = args.model
+    LLM.temp = args.temp
+    LLM.top_p = args.top_p
+    LLM.base_url = args.llm_base_url
+    ResponseCache.mode = args.llm_cache
+    Candidates.k = args.candidates
+    Candidates.temp = args.candidate_temp
+    Streaming.enabled = args.stream
+    Speculation.enabled = args.speculative_hammer
+    Replay.experiments = args.replay_from
+    Replay.human = args.replay_human
+    Limits.requests_per_minute = args.rpm
+    Packing.max_tokens = args.prompt_tokens
+    Compaction.max_tokens = args.history_tokens
+    Telemetry.enabled = args.telemetry
+    HammerCache.enabled = args.hammer_cache
+    Budget.max_time = args.max_time
+    Budget.max_tokens = args.max_tokens
+    Budget.max_hammer_calls = args.max_hammer_calls
+    Budget.max_iters = args.max_iters
+    if args.mode == 'coordinator':
+        coordinator(args.queue_dir, args.exp_name, args.proj, args.resume, args.checkpoint, args.incremental, args.lease_timeout, args.poll)
+    else:
+        worker(args.queue_dir, args.worker_id, args.heartbeat, args.poll)
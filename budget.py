@@ -0,0 +1,84 @@
+import time
+from typing import Any
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class Budget:
+    """
+    Resources a single theorem may consume across the LLM, coq-lsp and hammer.
+    The limits are class attributes set from the command line, like `LLM.model`
+    (0 means unlimited); every theorem gets its own instance to charge.
+    """
+    max_time = 0
+    max_tokens = 0
+    max_hammer_calls = 0
+    max_iters = 3
+
+    def __init__(self):
+        self.max_time = Budget.max_time
+        self.max_tokens = Budget.max_tokens
+        self.max_hammer_calls = Budget.max_hammer_calls
+        self.max_iters = Budget.max_iters
+        self.start = time.time()
+        self.llm_calls = 0
+        self.llm_cached = 0
+        self.llm_time = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.hammer_calls = 0
+        self.hammer_cached = 0
+        self.hammer_time = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.start
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def check(self):
+        if self.max_time and self.elapsed > self.max_time:
+            raise BudgetExceeded(f'wall time {self.elapsed:.0f}s over the limit of {self.max_time}s')
+        if self.max_tokens and self.tokens >= self.max_tokens:
+            raise BudgetExceeded(f'{self.tokens} LLM tokens over the limit of {self.max_tokens}')
+
+    def charge_llm(self, usage: dict[str, int] | None, duration: float, cached: bool = False):
+        self.llm_calls += 1
+        self.llm_time += duration
+        if cached:
+            # replayed responses cost no tokens
+            self.llm_cached += 1
+            return
+        # some compatible endpoints do not report usage
+        if usage is not None:
+            self.prompt_tokens += usage['prompt_tokens']
+            self.completion_tokens += usage['completion_tokens']
+
+    def allow_hammer(self) -> bool:
+        return not self.max_hammer_calls or self.hammer_calls < self.max_hammer_calls
+
+    def charge_hammer(self, duration: float, cached: bool = False):
+        if cached:
+            # a cached result does not count against max_hammer_calls
+            self.hammer_cached += 1
+            return
+        self.hammer_calls += 1
+        self.hammer_time += duration
+
+    def usage(self) -> dict[str, Any]:
+        return {
+            'time': self.elapsed,
+            'llm_calls': self.llm_calls,
+            'llm_cached': self.llm_cached,
+            'llm_time': self.llm_time,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'hammer_calls': self.hammer_calls,
+            'hammer_cached': self.hammer_cached,
+            'hammer_time': self.hammer_time,
+            'limits': {'time': self.max_time, 'tokens': self.max_tokens, 'hammer_calls': self.max_hammer_calls, 'iters': self.max_iters},
+        }
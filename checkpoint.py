@@ -0,0 +1,143 @@
+import os
+import atexit
+from coqpyt.coq.proof_file import ProofFile
+from coqpyt.coq.structs import Step, ProofTerm
+from coqpyt.coq.changes import CoqAddStep, CoqDeleteStep
+from utils import copy_file
+
+HAMMER_TIME = 10
+HAMMER_HEADER = f'From Hammer Require Import Hammer.\nSet Hammer ATPLimit {HAMMER_TIME}.\n'
+
+
+class FileCheckpoint:
+    """
+    A long-lived ProofFile over one source file. The first theorem checks the
+    whole prefix; later theorems roll the document back to the prefix they
+    share with it and only check the delta.
+    """
+    def __init__(self, workspace: str, file: str, option: str, header: str = HAMMER_HEADER):
+        self.workspace = workspace
+        self.file = file
+        self.option = option
+        self.header = header
+        self.copied_file = None
+        self.proof_file = None
+        self.header_size = 0
+
+    def open_theorem(self, partial_steps: list[Step]) -> tuple[ProofFile, ProofTerm]:
+        texts = [step.text for step in partial_steps]
+        if self.proof_file is None:
+            self._start(texts)
+        else:
+            self._rollback(texts)
+        proof_file = self.proof_file
+        assert proof_file.is_valid
+        assert proof_file.in_proof
+        proof_term = proof_file.open_proofs[-1]
+        proof_file.append_step(proof_term, '\nProof.')
+        return proof_file, proof_term
+
+    def _start(self, texts: list[str]):
+        file_path = os.path.join(self.workspace, self.file)
+        self.copied_file = copy_file(file_path, content=self.header + ''.join(texts))
+        self.proof_file = ProofFile(self.copied_file, use_disk_cache=True, workspace=self.workspace, timeout=600, error_mode='warning', extra_options=self.option)
+        self.proof_file.run()
+        self.header_size = len(self.proof_file.steps) - len(texts)
+
+    def _rollback(self, texts: list[str]):
+        proof_file = self.proof_file
+        # sentences equal up to surrounding whitespace have the same effect
+        current = [step.text.strip() for step in proof_file.steps[self.header_size:]]
+        target = [text.strip() for text in texts]
+        common = 0
+        while common < min(len(current), len(target)) and current[common] == target[common]:
+            common += 1
+
+        keep = self.header_size + common
+        if proof_file.steps_taken > keep:
+            proof_file.exec(keep - proof_file.steps_taken)
+        changes = [CoqDeleteStep(i) for i in range(len(proof_file.steps) - 1, keep - 1, -1)]
+        for i, text in enumerate(texts[common:]):
+            if not text[:1].isspace():
+                text = '\n' + text
+            changes.append(CoqAddStep(text, keep + i - 1))
+        if changes:
+            proof_file.change_steps(changes)
+        proof_file.run()
+
+    def close(self):
+        if self.proof_file is not None:
+            self.proof_file.close()
+            self.proof_file = None
+        if self.copied_file is not None and os.path.exists(self.copied_file):
+            os.remove(self.copied_file)
+        self.copied_file = None
+
+
+# only the checkpoint of the most recent file is kept alive in a worker
+_checkpoint: FileCheckpoint | None = None
+
+
+def get_checkpoint(workspace: str, file: str, option: str) -> FileCheckpoint:
+    global _checkpoint
+    if _checkpoint is not None and (_checkpoint.workspace, _checkpoint.file, _checkpoint.option) != (workspace, file, option):
+        close_checkpoint()
+    if _checkpoint is None:
+        _checkpoint = FileCheckpoint(workspace, file, option)
+    return _checkpoint
+
+
+class SideSessions:
+    """
+    Extra checkpoints of the file being proved, used to check several proof
+    candidates side by side. Each one mirrors the main document up to the
+    theorem statement, lemmas added before the theorem included.
+    """
+    def __init__(self, workspace: str, file: str, option: str):
+        self.workspace = workspace
+        self.file = file
+        self.option = option
+        self.checkpoints: list[FileCheckpoint] = []
+
+    def open(self, proof_file: ProofFile, proof_term: ProofTerm, count: int) -> list[tuple[ProofFile, ProofTerm]]:
+        index = proof_file.find_step_index(proof_term.ast.range)
+        # the main document already starts with the hammer header
+        partial_steps = proof_file.steps[:index + 1]
+        while len(self.checkpoints) < count:
+            self.checkpoints.append(FileCheckpoint(self.workspace, self.file, self.option, header=''))
+        return [checkpoint.open_theorem(partial_steps) for checkpoint in self.checkpoints[:count]]
+
+    def reset(self, i: int):
+        # a session in an unknown state is checked again from scratch next time
+        self.checkpoints[i].close()
+
+    def close(self):
+        for checkpoint in self.checkpoints:
+            checkpoint.close()
+        self.checkpoints = []
+
+
+_side_sessions: SideSessions | None = None
+
+
+def get_side_sessions(workspace: str, file: str, option: str) -> SideSessions:
+    global _side_sessions
+    if _side_sessions is not None and (_side_sessions.workspace, _side_sessions.file, _side_sessions.option) != (workspace, file, option):
+        _side_sessions.close()
+        _side_sessions = None
+    if _side_sessions is None:
+        _side_sessions = SideSessions(workspace, file, option)
+    return _side_sessions
+
+
+def close_checkpoint():
+    global _checkpoint, _side_sessions
+    if _checkpoint is not None:
+        _checkpoint.close()
+        _checkpoint = None
+    if _side_sessions is not None:
+        _side_sessions.close()
+        _side_sessions = None
+
+
+atexit.register(close_checkpoint)
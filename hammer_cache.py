@@ -0,0 +1,95 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from path import LOG
+from utils import create_dirs
+
+HAMMER_CACHE = os.path.join(LOG, 'hammer_cache.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    environment TEXT NOT NULL,
+    goal TEXT NOT NULL,
+    success INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    atp_limit REAL NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+"""
+
+
+def hammer_key(environment: str, goal: str) -> str:
+    return hashlib.sha256(f'{environment}/{goal}'.encode()).hexdigest()
+
+
+class HammerCache:
+    """
+    Hammer results by environment and goal fingerprint, shared by all workers
+    that see the log directory. A success stores the reconstructed tactic and
+    is kept until the tactic is found not to apply. A failure only answers
+    calls with the same or a smaller ATP limit, and only for `negative_ttl`
+    seconds, after which the hammer is tried again; it never replaces a
+    success, since a hammer run out of time under load says little.
+    """
+    enabled = False
+    negative_ttl = 7 * 24 * 3600
+
+    def __init__(self, path: str = HAMMER_CACHE):
+        self.path = path
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # one connection per thread, and never one inherited from a forked parent
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            create_dirs(self.path)
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, environment: str, goal: str, atp_limit: float) -> tuple[bool, str] | None:
+        key = hammer_key(environment, goal)
+        row = self.conn.execute('SELECT success, result, atp_limit, created FROM results WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row is None or (not row[0] and (row[2] < atp_limit or now - row[3] > HammerCache.negative_ttl)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.conn:
+            self.conn.execute('UPDATE results SET last_used = ? WHERE key = ?', (now, key))
+        return bool(row[0]), row[1]
+
+    def put(self, environment: str, goal: str, atp_limit: float, success: bool, result: str):
+        now = time.time()
+        with self.conn:
+            self.conn.execute('INSERT INTO results (key, environment, goal, success, result, atp_limit, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                              'ON CONFLICT (key) DO UPDATE SET success = excluded.success, result = excluded.result, atp_limit = excluded.atp_limit, '
+                              'created = excluded.created, last_used = excluded.last_used WHERE results.success = 0 OR excluded.success = 1',
+                              (hammer_key(environment, goal), environment, goal, int(success), result, atp_limit, now, now))
+
+    def delete(self, environment: str, goal: str):
+        # a stored tactic that no longer applies
+        self.stale += 1
+        with self.conn:
+            self.conn.execute('DELETE FROM results WHERE key = ?', (hammer_key(environment, goal),))
+
+
+_cache: HammerCache | None = None
+
+
+def get_hammer_cache() -> HammerCache:
+    global _cache
+    if _cache is None:
+        _cache = HammerCache()
+    return _cache
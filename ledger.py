@@ -0,0 +1,171 @@
+import os
+import time
+import sqlite3
+import threading
+from path import LOG
+from utils import json_load, create_dirs
+
+LEDGER = os.path.join(LOG, 'ledger.db')
+MAX_ATTEMPTS = 3
+
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    exp TEXT NOT NULL,
+    proj TEXT NOT NULL,
+    commit_sha TEXT NOT NULL,
+    file TEXT NOT NULL,
+    theorem TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    duration REAL,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    tokens INTEGER,
+    PRIMARY KEY (exp, proj, commit_sha, file, theorem)
+)
+"""
+
+
+class TaskSkipped(Exception):
+    # the task cannot be attempted yet, e.g. its theorem or initial attempt is missing
+    pass
+
+
+class Ledger:
+    """
+    Task states of all experiments in one SQLite database. Every state change
+    is a single transaction, so a crashed worker leaves its task `running` (and
+    it is retried on resume) instead of leaving a half-written log behind.
+    """
+    def __init__(self, path: str = LEDGER):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # one connection per thread, and never one inherited from a forked parent
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            create_dirs(self.path)
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(SCHEMA)
+            # ledgers created before token accounting
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(tasks)')]
+            if 'tokens' not in columns:
+                try:
+                    conn.execute('ALTER TABLE tasks ADD COLUMN tokens INTEGER')
+                except sqlite3.OperationalError:
+                    # another process added it first
+                    pass
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add_tasks(self, exp: str, proj: str, tasks: list[tuple[str, str, str]]):
+        rows = [(exp, proj, commit, file, theorem, PENDING) for commit, file, theorem in tasks]
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO tasks (exp, proj, commit_sha, file, theorem, status) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def has_tasks(self, exp: str, proj: str) -> bool:
+        row = self.conn.execute('SELECT 1 FROM tasks WHERE exp = ? AND proj = ? LIMIT 1', (exp, proj)).fetchone()
+        return row is not None
+
+    def done(self, exp: str, proj: str) -> set[tuple[str, str, str]]:
+        rows = self.conn.execute('SELECT commit_sha, file, theorem FROM tasks WHERE exp = ? AND proj = ? AND status IN (?, ?)', (exp, proj, SUCCEEDED, FAILED))
+        return set(rows)
+
+    def succeeded(self, exp: str, proj: str) -> list[tuple[str, str, str]]:
+        rows = self.conn.execute('SELECT commit_sha, file, theorem FROM tasks WHERE exp = ? AND proj = ? AND status = ?', (exp, proj, SUCCEEDED))
+        return list(rows)
+
+    def rows(self, exp: str, proj: str) -> list[dict]:
+        cursor = self.conn.execute('SELECT * FROM tasks WHERE exp = ? AND proj = ?', (exp, proj))
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def history(self, proj: str, exclude: str = '') -> dict[tuple[str, str, str], tuple[float, float | None]]:
+        # mean duration and tokens of every finished theorem over the other experiments,
+        # tokens are NULL where they were not recorded and AVG leaves them out
+        rows = self.conn.execute('SELECT commit_sha, file, theorem, AVG(duration), AVG(tokens) FROM tasks '
+                                 'WHERE proj = ? AND exp != ? AND status IN (?, ?) AND duration IS NOT NULL GROUP BY commit_sha, file, theorem',
+                                 (proj, exclude, SUCCEEDED, FAILED))
+        return {(commit, file, theorem): (duration, tokens) for commit, file, theorem, duration, tokens in rows}
+
+    def start(self, exp: str, proj: str, commit: str, file: str, theorem: str):
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO tasks (exp, proj, commit_sha, file, theorem, status) VALUES (?, ?, ?, ?, ?, ?)', (exp, proj, commit, file, theorem, PENDING))
+            self.conn.execute('UPDATE tasks SET status = ?, attempts = attempts + 1, started = ?, error = NULL WHERE exp = ? AND proj = ? AND commit_sha = ? AND file = ? AND theorem = ?',
+                              (RUNNING, time.time(), exp, proj, commit, file, theorem))
+
+    def finish(self, exp: str, proj: str, commit: str, file: str, theorem: str, success: bool, duration: float, tokens: int | None = None):
+        status = SUCCEEDED if success else FAILED
+        with self.conn:
+            self.conn.execute('UPDATE tasks SET status = ?, duration = ?, tokens = ?, finished = ? WHERE exp = ? AND proj = ? AND commit_sha = ? AND file = ? AND theorem = ?',
+                              (status, duration, tokens, time.time(), exp, proj, commit, file, theorem))
+
+    def error(self, exp: str, proj: str, commit: str, file: str, theorem: str, error: str, duration: float, tokens: int | None = None):
+        # crashed attempts are retried on resume until MAX_ATTEMPTS is reached
+        with self.conn:
+            self.conn.execute('UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, duration = ?, tokens = ?, finished = ? WHERE exp = ? AND proj = ? AND commit_sha = ? AND file = ? AND theorem = ?',
+                              (MAX_ATTEMPTS, FAILED, PENDING, error, duration, tokens, time.time(), exp, proj, commit, file, theorem))
+
+    def skip(self, exp: str, proj: str, commit: str, file: str, theorem: str, reason: str, duration: float):
+        # not done, so the task is attempted again on resume once its input exists
+        with self.conn:
+            self.conn.execute('UPDATE tasks SET status = ?, attempts = attempts - 1, error = ?, duration = ?, finished = ? WHERE exp = ? AND proj = ? AND commit_sha = ? AND file = ? AND theorem = ?',
+                              (SKIPPED, reason, duration, time.time(), exp, proj, commit, file, theorem))
+
+    def copy_succeeded(self, from_exp: str, to_exp: str, proj: str):
+        with self.conn:
+            self.conn.execute('INSERT INTO tasks (exp, proj, commit_sha, file, theorem, status, attempts, duration) '
+                              'SELECT ?, proj, commit_sha, file, theorem, status, 0, duration FROM tasks WHERE exp = ? AND proj = ? AND status = ? '
+                              'ON CONFLICT DO UPDATE SET status = excluded.status, duration = excluded.duration, error = NULL',
+                              (to_exp, from_exp, proj, SUCCEEDED))
+
+    def import_logs(self, exp: str, proj: str):
+        """
+        Record the logs of an experiment run before the ledger existed. This walks
+        `log/<exp>/<proj>` once; afterwards the ledger is the source of truth.
+        """
+        if self.has_tasks(exp, proj):
+            return
+        proj_path = os.path.join(LOG, exp, proj)
+        if not os.path.isdir(proj_path):
+            return
+        rows = []
+        for commit in os.listdir(proj_path):
+            commit_path = os.path.join(proj_path, commit)
+            if not os.path.isdir(commit_path):
+                continue
+            for root, _, files in os.walk(commit_path):
+                for thm in files:
+                    if not thm.endswith('.json'):
+                        continue
+                    try:
+                        success = json_load(os.path.join(root, thm))[0]['success']
+                    except Exception:
+                        # a log cut short by a crash does not count as done
+                        continue
+                    file = os.path.relpath(root, commit_path)
+                    status = SUCCEEDED if success else FAILED
+                    rows.append((exp, proj, commit, file, thm[:-len('.json')], status, 1))
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO tasks (exp, proj, commit_sha, file, theorem, status, attempts) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+_ledger: Ledger | None = None
+
+
+def get_ledger() -> Ledger:
+    global _ledger
+    if _ledger is None:
+        _ledger = Ledger()
+    return _ledger
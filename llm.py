@@ -1,14 +1,27 @@
-from openai import OpenAI
+import time
+import asyncio
+from typing import Any, Iterator
+from budget import Budget
+from llm_cache import get_cache, request_key
+from llm_client import get_client, get_async_client, complete, acomplete, open_stream
+from utils_prompt import count_tokens, compact, Compaction
+from telemetry import call_site, get_context, record
 
 api_key_openai = "YOUR OPENAI API KEY HERE"
 api_key_deepseek = "YOUR DEEPSEEK API KEY HERE"
 
+providers = {
+    'openai': (api_key_openai, None),
+    'deepseek': (api_key_deepseek, "https://api.deepseek.com"),
+}
+
 class LLM:
     supported_models = ["deepseek-chat", 'gpt-4o-mini', 'gpt-4o-2024-08-06', 'gpt-4o', 'claude-3-7-sonnet-20250219']
     model = ''
     temp = 0
     top_p = 1
-    def __init__(self, conversation=None):
+    base_url = ''  # e.g. a local llm_stub.py server, overrides the provider's endpoint
+    def __init__(self, conversation=None, budget: Budget | None = None):
         self.model = LLM.model
         if self.model == 'gpt-4o':
             self.model = 'gpt-4o-2024-08-06'
@@ -18,30 +31,101 @@ class LLM:
             self.conversation = conversation
         else:
             self.conversation = []
+        self.budget = budget
+        # messages of the conversation sent as outlines, see `compact`
+        self.compacted = 0
+        self.compaction = {}
         assert self.model in self.supported_models, f"Unsupported model: {self.model}"
         if 'gpt' in self.model.lower() or 'claude' in self.model.lower():
-            self.client = OpenAI(api_key=api_key_openai) 
+            self.provider = 'openai'
         elif 'deepseek' in self.model.lower():
-            self.client = OpenAI(api_key=api_key_deepseek, base_url="https://api.deepseek.com")
+            self.provider = 'deepseek'
         else:
             raise ValueError(f"Unknown model: {self.model}")
+        # pooled and shared by all instances of the process
+        self.client = get_client(self.provider, *self.endpoint())
 
+    def endpoint(self) -> tuple[str, str | None]:
+        api_key, base_url = providers[self.provider]
+        return api_key, LLM.base_url or base_url
 
-    def query(self, prompt: str, append: bool = True, n: int=1) -> list[str]:
+    def request(self, messages: list[dict], n: int) -> dict[str, Any]:
+        return {'model': self.model, 'messages': messages, 'n': n, 'temperature': self.temp, 'top_p': self.top_p}
+
+    def request_key(self, messages: list[dict], n: int) -> str:
+        # sampled requests are neither cached nor coalesced
+        if self.temp != 0:
+            return ''
+        return request_key(self.model, messages, n, self.temp, self.top_p)
+
+    def _prepare(self, prompt: str, append: bool, n: int) -> list[dict]:
         if append:
             assert n == 1
-
+        if self.budget is not None:
+            self.budget.check()
         messages = self.conversation + [{'role': 'user', 'content': prompt}]
-        response = self.client.chat.completions.create(model=self.model,
-            messages=messages, n=n, temperature=self.temp, top_p=self.top_p)
-        # print(response)
-        role = response.choices[0].message.role
-        contents = [c.message.content for c in response.choices]
+        if Compaction.max_tokens and len(messages) > 1:
+            messages, self.compacted, self.compaction = compact(messages, self.compacted)
+        return messages
+
+    def cache_status(self, shared: bool) -> str:
+        if get_cache().enabled(self.temp):
+            return 'hit' if shared else 'miss'
+        return 'coalesced' if shared else 'off'
+
+    def _finish(self, prompt: str, append: bool, response: dict[str, Any], duration: float, shared: bool, site: str, n: int) -> list[str]:
+        if self.budget is not None:
+            self.budget.charge_llm(response['usage'], duration, cached=shared)
+        record(site, get_context(), self.model, response['usage'], duration, 0 if shared else response.get('retries', 0), self.cache_status(shared), n=n)
+        contents = response['contents']
         if append:
             self.conversation.append({'role': 'user', 'content': prompt})
-            self.conversation.append({'role': role, 'content': contents[0]})
+            self.conversation.append({'role': response['role'], 'content': contents[0]})
         return contents
 
+    def query(self, prompt: str, append: bool = True, n: int=1) -> list[str]:
+        site = call_site()
+        messages = self._prepare(prompt, append, n)
+        start = time.time()
+        key = self.request_key(messages, n)
+        create = lambda: complete(self.provider, self.client, self.request(messages, n), key)
+        cache = get_cache()
+        if cache.enabled(self.temp):
+            response, shared = cache.get_or_create(key, self.model, create)
+        else:
+            response, shared = create()
+        return self._finish(prompt, append, response, time.time() - start, shared, site, n)
+
+    async def aquery(self, prompt: str, append: bool = True, n: int=1) -> list[str]:
+        site = call_site()
+        messages = self._prepare(prompt, append, n)
+        start = time.time()
+        key = self.request_key(messages, n)
+        cache = get_cache()
+        response, shared = None, False
+        # the cache is SQLite, keep it off the event loop
+        if cache.enabled(self.temp):
+            response = await asyncio.to_thread(cache.get, key)
+            shared = response is not None
+        if response is None:
+            client = get_async_client(self.provider, *self.endpoint())
+            response, shared = await acomplete(self.provider, client, self.request(messages, n), key)
+            if cache.enabled(self.temp):
+                await asyncio.to_thread(cache.put, key, self.model, response)
+        return self._finish(prompt, append, response, time.time() - start, shared, site, n)
+
+    def stream(self, prompt: str, append: bool = True) -> 'ResponseStream':
+        site = call_site()
+        messages = self._prepare(prompt, append, 1)
+        key = self.request_key(messages, 1)
+        cache = get_cache()
+        if cache.enabled(self.temp):
+            response = cache.get(key)
+            if response is not None:
+                return ResponseStream(self, prompt, append, messages, iter([(response['contents'][0], response['usage'])]), key, site, cached=True)
+        chunks, retries = open_stream(self.provider, self.client, self.request(messages, 1))
+        return ResponseStream(self, prompt, append, messages, chunks, key, site, retries=retries)
+
     def add_user_message(self, message: str):
         self.conversation.append({'role': 'user', 'content': message})
 
@@ -49,5 +133,75 @@ class LLM:
         self.conversation.append({'role': 'assistant', 'content': message})
 
 
+class ResponseStream:
+    """
+    A completion read while it is generated. Iterating yields the text deltas;
+    `cancel` stops the generation at the next delta. The LLM is charged and the
+    conversation extended once the iteration ends, with the text received so far.
+    """
+    def __init__(self, llm: LLM, prompt: str, append: bool, messages: list[dict], chunks: Iterator[tuple[str, dict | None]], key: str, site: str, cached: bool = False, retries: int = 0):
+        self.llm = llm
+        self.site = site
+        # the reader thread that finishes the stream does not share the context of the caller
+        self.context = get_context()
+        self.retries = retries
+        self.prompt = prompt
+        self.append = append
+        self.messages = messages
+        self.chunks = chunks
+        self.key = key
+        self.cached = cached
+        self.parts = []
+        self.usage = None
+        self.start = time.time()
+        self.first_delta = None
+        self.cancelled = False
+        self.complete = False
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.parts)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __iter__(self) -> Iterator[str]:
+        try:
+            for text, usage in self.chunks:
+                if usage is not None:
+                    self.usage = usage
+                if text:
+                    if self.first_delta is None:
+                        self.first_delta = time.time() - self.start
+                    self.parts.append(text)
+                    yield text
+                if self.cancelled:
+                    break
+            else:
+                self.complete = True
+        finally:
+            close = getattr(self.chunks, 'close', None)
+            if close is not None:
+                close()
+            self.finish()
+
+    def finish(self):
+        text = self.text
+        usage = self.usage
+        if usage is None and not self.cached:
+            # a cancelled stream never gets to the usage chunk
+            usage = {'prompt_tokens': sum(count_tokens(m['content']) for m in self.messages), 'completion_tokens': count_tokens(text)}
+        if self.llm.budget is not None:
+            self.llm.budget.charge_llm(usage, time.time() - self.start, cached=self.cached)
+        record(self.site, self.context, self.llm.model, usage, time.time() - self.start, self.retries, self.llm.cache_status(self.cached),
+               n=1, stream=True, first_delta=self.first_delta, cancelled=not self.complete)
+        cache = get_cache()
+        if self.complete and not self.cached and self.key and cache.enabled(self.llm.temp):
+            cache.put(self.key, self.llm.model, {'role': 'assistant', 'contents': [text], 'usage': usage})
+        if self.append:
+            self.llm.conversation.append({'role': 'user', 'content': self.prompt})
+            self.llm.conversation.append({'role': 'assistant', 'content': text})
+
+
 if __name__ == '__main__':
     pass
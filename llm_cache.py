@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Any, Callable
+from path import LOG
+from utils import create_dirs
+
+LLM_CACHE = os.path.join(LOG, 'llm_cache.db')
+
+OFF = 'off'
+READ = 'read'
+RECORD = 'record'
+BYPASS = 'bypass'
+MODES = [OFF, READ, RECORD, BYPASS]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS inflight (
+    key TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    started REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+-- total size of the responses, kept up to date by put and evict
+CREATE TABLE IF NOT EXISTS meta (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    total INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (id, total) SELECT 0, (SELECT COALESCE(SUM(size), 0) FROM responses) WHERE NOT EXISTS (SELECT 1 FROM meta);
+"""
+
+
+def request_key(model: str, messages: list[dict], n: int, temp: float, top_p: float) -> str:
+    request = json.dumps({'model': model, 'messages': messages, 'n': n, 'temperature': temp, 'top_p': top_p}, sort_keys=True)
+    return hashlib.sha256(request.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Responses of deterministic (temperature 0) chat completions, keyed by a hash
+    of the full request. `read` only serves hits, `record` serves hits and
+    stores misses, `bypass` always queries and stores the fresh response. The
+    least recently used entries are evicted beyond `max_bytes`.
+
+    While recording, a request is claimed before it is sent, so that workers in
+    other processes sending the same request wait for its response instead.
+    A claim of a crashed owner is dropped after `inflight_timeout` seconds, by
+    default as long as the request may take with all its retries.
+    """
+    mode = OFF
+    max_bytes = 2 * 1024 ** 3
+    inflight_timeout = 0
+    poll = 0.5
+
+    def __init__(self, path: str = LLM_CACHE):
+        self.path = path
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # one connection per thread, and never one inherited from a forked parent
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            create_dirs(self.path)
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enabled(self, temp: float) -> bool:
+        return ResponseCache.mode != OFF and temp == 0
+
+    def writable(self) -> bool:
+        return ResponseCache.mode in [RECORD, BYPASS]
+
+    def get(self, key: str) -> dict | None:
+        if ResponseCache.mode not in [READ, RECORD]:
+            return None
+        row = self.conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if ResponseCache.mode == RECORD:
+            with self.conn:
+                self.conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, model: str, response: dict):
+        if ResponseCache.mode not in [RECORD, BYPASS]:
+            return
+        text = json.dumps(response)
+        now = time.time()
+        with self.conn:
+            row = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO responses (key, model, response, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, model, text, len(text), now, now))
+            self.conn.execute('UPDATE meta SET total = total + ?', (len(text) - (row[0] if row else 0),))
+            total = self.conn.execute('SELECT total FROM meta').fetchone()[0]
+        if total > ResponseCache.max_bytes:
+            self.evict()
+
+    def claim(self, key: str) -> bool:
+        # llm_client imports this module
+        from llm_client import Limits
+        timeout = ResponseCache.inflight_timeout or Limits.deadline()
+        with self.conn:
+            # a hung owner does not block the request forever
+            self.conn.execute('DELETE FROM inflight WHERE started < ?', (time.time() - timeout,))
+            cursor = self.conn.execute('INSERT OR IGNORE INTO inflight (key, pid, started) VALUES (?, ?, ?)', (key, os.getpid(), time.time()))
+        return cursor.rowcount == 1
+
+    def release(self, key: str):
+        # only our own claim, it may have expired and been taken by another process
+        with self.conn:
+            self.conn.execute('DELETE FROM inflight WHERE key = ? AND pid = ?', (key, os.getpid()))
+
+    def wait(self, key: str, since: float) -> dict | None:
+        # the response of the owner, or None once it gave up
+        while True:
+            row = self.conn.execute('SELECT response FROM responses WHERE key = ? AND created >= ?', (key, since)).fetchone()
+            if row is not None:
+                return json.loads(row[0])
+            if self.conn.execute('SELECT 1 FROM inflight WHERE key = ?', (key,)).fetchone() is None:
+                return None
+            time.sleep(ResponseCache.poll)
+
+    def get_or_create(self, key: str, model: str, create: Callable[[], tuple[dict[str, Any], bool]]) -> tuple[dict[str, Any], bool]:
+        response = self.get(key)
+        if response is not None:
+            return response, True
+        if not self.writable():
+            return create()
+        # a bypassed request only takes responses newer than itself
+        since = time.time() if ResponseCache.mode == BYPASS else 0
+        while not self.claim(key):
+            response = self.wait(key, since)
+            if response is not None:
+                self.hits += 1
+                return response, True
+        try:
+            response, shared = create()
+            self.put(key, model, response)
+        finally:
+            self.release(key)
+        return response, shared
+
+    def evict(self):
+        with self.conn:
+            total = self.conn.execute('SELECT total FROM meta').fetchone()[0]
+            if total <= ResponseCache.max_bytes:
+                return
+            freed = 0
+            keys = []
+            for key, size in self.conn.execute('SELECT key, size FROM responses ORDER BY last_used'):
+                keys.append((key,))
+                freed += size
+                if total - freed <= ResponseCache.max_bytes:
+                    break
+            self.conn.executemany('DELETE FROM responses WHERE key = ?', keys)
+            self.conn.execute('UPDATE meta SET total = total - ?', (freed,))
+
+
+_cache: ResponseCache | None = None
+
+
+def get_cache() -> ResponseCache:
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
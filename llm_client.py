@@ -0,0 +1,277 @@
+"""
+Shared access to the chat completion endpoints. All LLM instances of a
+process reuse one pooled client per provider, wait on a per-provider token
+bucket shared by all processes before each request, retry rate limits, timeouts and server errors with
+jittered exponential backoff, and coalesce identical deterministic requests
+that are in flight at the same time into a single call.
+"""
+import os
+import time
+import random
+import sqlite3
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Iterator
+
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from llm_cache import LLM_CACHE
+from utils import create_dirs
+
+RETRYABLE = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+class Limits:
+    requests_per_minute = 0  # per provider over all processes sharing the log directory, 0 for no limit
+    burst = 10
+    max_retries = 6
+    backoff = 1.0
+    max_backoff = 60.0
+    timeout = 600.0
+
+    @staticmethod
+    def deadline() -> float:
+        # the longest one request may take, every attempt timing out and backing off
+        return Limits.timeout * (Limits.max_retries + 1) + Limits.max_backoff * Limits.max_retries
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # take a token now, possibly going into debt, and return how long to wait for it
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+    async def aacquire(self):
+        await asyncio.sleep(self.reserve())
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A token bucket kept in a table of the LLM cache database, so that worker
+    processes draw from one rate limit instead of one each. SQLite locking is
+    only reliable on a local disk: workers on several hosts share a bucket per
+    host and should divide the rate between them.
+    """
+    def __init__(self, name: str, rate: float, burst: int, path: str = LLM_CACHE):
+        super().__init__(rate, burst)
+        self.name = name
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # one connection per thread, and never one inherited from a forked parent
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            create_dirs(self.path)
+            # transactions are begun explicitly
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def reserve(self) -> float:
+        conn = self.conn
+        # the clock is shared between processes, so wall time instead of monotonic
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (self.name,)).fetchone()
+            now = time.time()
+            tokens = float(self.burst) if row is None else min(self.burst, row[0] + max(0.0, now - row[1]) * self.rate)
+            tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)', (self.name, tokens, now))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return 0.0 if tokens >= 0 else -tokens / self.rate
+
+    async def aacquire(self):
+        # waiting for the database lock must not block the event loop
+        await asyncio.sleep(await asyncio.to_thread(self.reserve))
+
+
+_clients: dict[tuple, Any] = {}
+_buckets: dict[tuple[str, int], TokenBucket | None] = {}
+_lock = threading.Lock()
+
+
+def get_client(provider: str, api_key: str, base_url: str | None = None) -> OpenAI:
+    # clients hold connection pools, which must not be shared with forked workers
+    key = (provider, base_url, os.getpid())
+    with _lock:
+        if key not in _clients:
+            _clients[key] = OpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=Limits.timeout)
+        return _clients[key]
+
+
+def get_async_client(provider: str, api_key: str, base_url: str | None = None) -> AsyncOpenAI:
+    # an async client is bound to the event loop it first runs in
+    key = (provider, base_url, os.getpid(), id(asyncio.get_running_loop()))
+    with _lock:
+        if key not in _clients:
+            _clients[key] = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=Limits.timeout)
+        return _clients[key]
+
+
+def get_bucket(provider: str) -> TokenBucket | None:
+    key = (provider, os.getpid())
+    with _lock:
+        if key not in _buckets:
+            rpm = Limits.requests_per_minute
+            _buckets[key] = SharedTokenBucket(provider, rpm / 60, Limits.burst) if rpm else None
+        return _buckets[key]
+
+
+def backoff_delay(attempt: int) -> float:
+    # full jitter keeps workers that were throttled together from retrying together
+    return random.uniform(0, min(Limits.max_backoff, Limits.backoff * 2 ** attempt))
+
+
+def to_response(completion) -> dict[str, Any]:
+    usage = None
+    if completion.usage is not None:
+        usage = {'prompt_tokens': completion.usage.prompt_tokens, 'completion_tokens': completion.usage.completion_tokens}
+    return {
+        'role': completion.choices[0].message.role,
+        'contents': [c.message.content for c in completion.choices],
+        'usage': usage,
+    }
+
+
+def _create(provider: str, client: OpenAI, request: dict[str, Any]) -> dict[str, Any]:
+    bucket = get_bucket(provider)
+    for attempt in range(Limits.max_retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            response = to_response(client.chat.completions.create(**request))
+            response['retries'] = attempt
+            return response
+        except RETRYABLE as e:
+            if attempt == Limits.max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            print(f'LLM request failed ({type(e).__name__}), retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+
+async def _acreate(provider: str, client: AsyncOpenAI, request: dict[str, Any]) -> dict[str, Any]:
+    bucket = get_bucket(provider)
+    for attempt in range(Limits.max_retries + 1):
+        if bucket is not None:
+            await bucket.aacquire()
+        try:
+            response = to_response(await client.chat.completions.create(**request))
+            response['retries'] = attempt
+            return response
+        except RETRYABLE as e:
+            if attempt == Limits.max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            print(f'LLM request failed ({type(e).__name__}), retrying in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+
+def _deltas(stream) -> Iterator[tuple[str, dict[str, int] | None]]:
+    try:
+        for chunk in stream:
+            usage = None
+            if chunk.usage is not None:
+                usage = {'prompt_tokens': chunk.usage.prompt_tokens, 'completion_tokens': chunk.usage.completion_tokens}
+            text = chunk.choices[0].delta.content or '' if chunk.choices else ''
+            yield text, usage
+    finally:
+        # closing the generator early drops the connection, which stops the generation
+        stream.close()
+
+
+def open_stream(provider: str, client: OpenAI, request: dict[str, Any]) -> tuple[Iterator[tuple[str, dict[str, int] | None]], int]:
+    """
+    Start a streamed completion, retrying like `_create` until the first byte.
+    Returns the text deltas, with the usage at the last chunk, and the retries.
+    """
+    bucket = get_bucket(provider)
+    for attempt in range(Limits.max_retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            stream = client.chat.completions.create(**request, stream=True, stream_options={'include_usage': True})
+            return _deltas(stream), attempt
+        except RETRYABLE as e:
+            if attempt == Limits.max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            print(f'LLM request failed ({type(e).__name__}), retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+
+_inflight: dict[str, Future] = {}
+_ainflight: dict[tuple[int, str], asyncio.Future] = {}
+
+
+def coalesce(key: str, create: Callable[[], dict[str, Any]]) -> tuple[dict[str, Any], bool]:
+    """
+    Run `create` once for all threads asking for `key` at the same time.
+    Returns the response and whether it was shared from another caller.
+    """
+    with _lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _inflight[key] = future
+    if not owner:
+        return future.result(), True
+    try:
+        response = create()
+        future.set_result(response)
+        return response, False
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+
+
+async def acoalesce(key: str, create: Callable[[], Awaitable[dict[str, Any]]]) -> tuple[dict[str, Any], bool]:
+    loop_key = (id(asyncio.get_running_loop()), key)
+    task = _ainflight.get(loop_key)
+    if task is not None:
+        return await asyncio.shield(task), True
+    task = asyncio.ensure_future(create())
+    _ainflight[loop_key] = task
+    try:
+        return await asyncio.shield(task), False
+    finally:
+        _ainflight.pop(loop_key, None)
+
+
+def complete(provider: str, client: OpenAI, request: dict[str, Any], key: str = '') -> tuple[dict[str, Any], bool]:
+    # only deterministic requests get a key, sampled ones must stay independent
+    if not key:
+        return _create(provider, client, request), False
+    return coalesce(key, lambda: _create(provider, client, request))
+
+
+async def acomplete(provider: str, client: AsyncOpenAI, request: dict[str, Any], key: str = '') -> tuple[dict[str, Any], bool]:
+    if not key:
+        return await _acreate(provider, client, request), False
+    return await acoalesce(key, lambda: _acreate(provider, client, request))
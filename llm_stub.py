@@ -0,0 +1,244 @@
+"""
+Offline stand-in for the chat completion endpoint, to benchmark the agent loop
+without network access or API cost. Point the agent at it with
+`--llm_base_url=http://127.0.0.1:<port>/v1`.
+
+A request is answered with, in this order:
+1. the response stored for exactly this request in an LLM cache database,
+2. the response recorded for the same prompt in the logs of earlier runs,
+3. the first scripted template whose pattern matches the prompt,
+4. a built-in template for the kind of prompt (proof, lemmas or decision).
+
+Latency and failures are drawn from a hash of the request and how often it was
+seen, so a rerun sees the same delays and the same failed attempts.
+"""
+import os
+import re
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+from utils import list_files_rec
+from utils_prompt import count_tokens
+from llm_cache import request_key
+
+DEFAULT_TEMPLATES = [
+    # decision making and its follow-ups
+    (r'choose one of the following actions|select a refinement strategy', '```\nRegenerate\n```'),
+    # lemma proposal and refinement
+    (r'propose some new lemma statements|refine an existing lemma', '```coq\nLemma stub_lemma : True.\nProof.\n  trivial.\nQed.\n```'),
+    # initial and regenerated proofs
+    (r'', '```coq\nProof.\n  auto.\nQed.\n```'),
+]
+
+
+class Stub:
+    latency = 0.0  # seconds per request
+    token_latency = 0.0  # seconds per completion token
+    jitter = 0.0  # relative, latency is scaled by a factor in [1 - jitter, 1 + jitter]
+    failure_rate = 0.0
+    seed = 0
+
+
+def prompt_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode()).hexdigest()
+
+
+def collect_pairs(obj: Any, pairs: dict[str, str]):
+    # logs nest {'prompt', 'response'} entries and conversations at any depth
+    if isinstance(obj, dict):
+        if isinstance(obj.get('prompt'), str) and isinstance(obj.get('response'), str):
+            pairs.setdefault(prompt_key(obj['prompt']), obj['response'])
+        for value in obj.values():
+            collect_pairs(value, pairs)
+    elif isinstance(obj, list):
+        for message, reply in zip(obj, obj[1:]):
+            if isinstance(message, dict) and isinstance(reply, dict) and message.get('role') == 'user' and reply.get('role') == 'assistant':
+                pairs.setdefault(prompt_key(message['content']), reply['content'])
+        for value in obj:
+            collect_pairs(value, pairs)
+
+
+def load_corpus(log_dirs: list[str]) -> dict[str, str]:
+    pairs = {}
+    for log_dir in log_dirs:
+        for file in list_files_rec(log_dir, '.json'):
+            try:
+                with open(os.path.join(log_dir, file)) as f:
+                    collect_pairs(json.load(f), pairs)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+    return pairs
+
+
+def load_templates(path: str) -> list[tuple[str, str]]:
+    # [{"match": "<regex>", "response": "<text>"}, ...]
+    if not path:
+        return []
+    with open(path) as f:
+        return [(t['match'], t['response']) for t in json.load(f)]
+
+
+class Backend:
+    def __init__(self, corpus: dict[str, str], templates: list[tuple[str, str]], cache_db: str = ''):
+        self.corpus = corpus
+        self.templates = [(re.compile(p, re.IGNORECASE), r) for p, r in templates + DEFAULT_TEMPLATES]
+        self.cache_db = cache_db
+        self.seen: dict[str, int] = {}
+        self.sources: dict[str, int] = {'cache': 0, 'corpus': 0, 'template': 0, 'failure': 0}
+        self.lock = threading.Lock()
+
+    def from_cache(self, key: str) -> list[str] | None:
+        if not self.cache_db:
+            return None
+        conn = sqlite3.connect(self.cache_db, timeout=60)
+        try:
+            row = conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+        finally:
+            conn.close()
+        return None if row is None else json.loads(row[0])['contents']
+
+    def answer(self, request: dict[str, Any]) -> tuple[list[str], str]:
+        n = request.get('n', 1)
+        key = request_key(request['model'], request['messages'], n, request.get('temperature', 0), request.get('top_p', 1))
+        contents = self.from_cache(key)
+        if contents is not None:
+            return contents, 'cache'
+        prompt = request['messages'][-1]['content']
+        response = self.corpus.get(prompt_key(prompt))
+        if response is not None:
+            return [response] * n, 'corpus'
+        for pattern, response in self.templates:
+            if pattern.search(prompt):
+                return [response] * n, 'template'
+
+    def draw(self, request: dict[str, Any]) -> random.Random:
+        # the n-th sending of a request always gets the same draws
+        body = json.dumps(request, sort_keys=True)
+        with self.lock:
+            count = self.seen.get(body, 0)
+            self.seen[body] = count + 1
+        return random.Random(f'{Stub.seed}/{count}/{body}')
+
+    def count(self, source: str):
+        with self.lock:
+            self.sources[source] += 1
+
+
+def completion(request: dict[str, Any], contents: list[str]) -> dict[str, Any]:
+    prompt_tokens = sum(count_tokens(m['content']) for m in request['messages'])
+    completion_tokens = sum(count_tokens(c) for c in contents)
+    return {
+        'id': f'stub-{hashlib.sha1(json.dumps(request, sort_keys=True).encode()).hexdigest()[:12]}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': request['model'],
+        'choices': [{'index': i, 'message': {'role': 'assistant', 'content': c}, 'finish_reason': 'stop'} for i, c in enumerate(contents)],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens},
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    backend: Backend
+
+    def send_json(self, status: int, body: dict[str, Any]):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {'error': {'message': f'unknown path {self.path}', 'type': 'invalid_request_error'}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        rng = self.backend.draw(request)
+        if rng.random() < Stub.failure_rate:
+            self.backend.count('failure')
+            status = rng.choice([429, 500, 503])
+            time.sleep(Stub.latency * rng.uniform(1 - Stub.jitter, 1 + Stub.jitter))
+            self.send_json(status, {'error': {'message': 'injected failure', 'type': 'server_error' if status != 429 else 'rate_limit_error'}})
+            return
+
+        contents, source = self.backend.answer(request)
+        self.backend.count(source)
+        body = completion(request, contents)
+        scale = rng.uniform(1 - Stub.jitter, 1 + Stub.jitter)
+        if request.get('stream'):
+            self.send_stream(request, body, scale)
+            return
+        time.sleep((Stub.latency + Stub.token_latency * body['usage']['completion_tokens']) * scale)
+        self.send_json(200, body)
+
+    def send_stream(self, request: dict[str, Any], body: dict[str, Any], scale: float):
+        # server-sent events, one chunk per word of the first choice
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        chunk = {key: body[key] for key in ['id', 'created', 'model']}
+        chunk['object'] = 'chat.completion.chunk'
+        try:
+            time.sleep(Stub.latency * scale)
+            for word in re.findall(r'\s*\S+\s*', body['choices'][0]['message']['content']):
+                time.sleep(Stub.token_latency * count_tokens(word) * scale)
+                self.send_event({**chunk, 'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}]})
+            self.send_event({**chunk, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+            if request.get('stream_options', {}).get('include_usage'):
+                self.send_event({**chunk, 'choices': [], 'usage': body['usage']})
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client cancelled the generation
+            pass
+
+    def send_event(self, data: dict[str, Any]):
+        self.wfile.write(f'data: {json.dumps(data)}\n\n'.encode())
+        self.wfile.flush()
+
+    def log_message(self, format: str, *args):
+        pass
+
+
+def serve(host: str, port: int, backend: Backend):
+    Handler.backend = backend
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    print(f'Serving chat completions on http://{host}:{server.server_port}/v1 ({len(backend.corpus)} recorded prompts)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f'Answered from {backend.sources}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--corpus', type=str, nargs='*', default=[], help='log directories of earlier runs to replay responses from')
+    parser.add_argument('--cache_db', type=str, default='', help='LLM cache database to replay exact requests from')
+    parser.add_argument('--templates', type=str, default='', help='JSON list of {"match": <regex>, "response": <text>}, tried before the built-in ones')
+    parser.add_argument('--latency', type=float, default=0, help='seconds per request')
+    parser.add_argument('--token_latency', type=float, default=0, help='seconds per completion token')
+    parser.add_argument('--jitter', type=float, default=0, help='relative spread of the latency')
+    parser.add_argument('--failure_rate', type=float, default=0, help='fraction of requests answered with 429/500/503')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    Stub.latency = args.latency
+    Stub.token_latency = args.token_latency
+    Stub.jitter = args.jitter
+    Stub.failure_rate = args.failure_rate
+    Stub.seed = args.seed
+    backend = Backend(load_corpus(args.corpus), load_templates(args.templates), args.cache_db)
+    serve(args.host, args.port, backend)
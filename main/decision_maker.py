@@ -1,6 +1,7 @@
 from llm import LLM
 from main.prompt import DECISIONS_INSTRUCTION, DECISION_MAKING_INITIAL
 from utils_coq import extract_code_blocks
+from utils_prompt import pack
 
 
 def parse_kws(response: str):
@@ -41,10 +42,13 @@ def parse_decision_response(response: str) -> tuple[str, list[str]]:
     assert False, f'Invalid response: {response}'
     
 
-def decision_initial_llm(theorem: str, partial_proof: str, proof_state: str, definitions: list[str], lemmas: list[str], similar_theorem: str, llm: LLM) -> tuple[str, list[str]]:
-    definitions_str = '\n\n'.join(definitions)
-    lemmas_str = '\n\n'.join(lemmas)
-    prompt = DECISION_MAKING_INITIAL.format(theorem=theorem, partial_proof=partial_proof, proof_state=proof_state, definitions=definitions_str, lemmas=lemmas_str, similar_theorem=similar_theorem)
+def decision_initial_llm(theorem: str, partial_proof: str, proof_state: str, definitions: list[str], lemmas: list[str], similar_theorem: str, llm: LLM, log: dict) -> tuple[str, list[str]]:
+    fields = dict(theorem=theorem, partial_proof=partial_proof, proof_state=proof_state, similar_theorem=similar_theorem)
+    fixed = DECISION_MAKING_INITIAL.format(definitions='', lemmas='', **fields)
+    packed, log['packing'] = pack(theorem + '\n' + proof_state, fixed, {'definitions': list(definitions), 'lemmas': list(lemmas)})
+    definitions_str = '\n\n'.join(packed['definitions'])
+    lemmas_str = '\n\n'.join(packed['lemmas'])
+    prompt = DECISION_MAKING_INITIAL.format(definitions=definitions_str, lemmas=lemmas_str, **fields)
     response = llm.query(prompt)[0]
     action, kws = parse_decision_response(response)
     return action, kws
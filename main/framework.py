@@ -1,35 +1,125 @@
 import os
 from typing import Any
+from functools import lru_cache
 from coqpyt.coq.proof_file import ProofFile
 from coqpyt.coq.structs import ProofTerm
 
 from utils import json_load, json_dump
-from utils_coq import get_ids_in_step_recursive
+from utils_coq import get_ids_in_step_recursive, theorem_fingerprint, IdCache
+from utils_lexer import normalize
 from agent_retrieval.agent import retrieve_similar_theorems, retrieve_current_lemmas, retrieve_current_terms_by_name
 from agent_lemma.agent import lemma_discovery, lemma_refinement
-from agent_proof.agent import prove_theorem_initial, prove_theorem_regenerate, prove_theorem_refine, prove_theorem_regenerate_new
-from agent_retrieval.dependency_graph_simple_rango_file import Graph
+from agent_proof.agent import prove_theorem_initial, prove_theorem_regenerate
+from agent_proof.proof import replay_proof, get_final_proof
+from agent_retrieval.dependency_graph_simple_rango_file import Graph, Thm
 from path import DATASET_NORMAL
 from llm import LLM
+from budget import Budget, BudgetExceeded
+from ledger import TaskSkipped
+from checkpoint import SideSessions
 from main.decision_maker import decision_initial_llm, decision_following_llm
 from main.prompt import RETRIEVED_EXTRA_LEMMAS, NO_MORE_LEMMAS, NEW_LEMMA_DISCOVERY_REFINED, NO_NEW_LEMMAS, REGENERATE_FEEDBACK
 
 
-def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofTerm, proj: str, commit: str, file_name: str, resume: str = '') -> tuple[bool, dict[str, Any]]:
+class Replay:
+    # where --incremental looks for the proof of an unchanged theorem in the parent commit,
+    # after the log of the experiment itself
+    experiments: list[str] = []
+    human = False
+
+
+@lru_cache(maxsize=2)
+def get_parent_theorems(proj: str, parent_commit: str) -> dict[tuple[str, str], Thm]:
+    datapoint_path = os.path.join(DATASET_NORMAL, proj, parent_commit, 'datapoint')
+    if not os.path.isdir(datapoint_path):
+        return {}
+    graph = Graph.from_proj_datapoint(datapoint_path, proj)
+    return {(graph_file.file_path, thm.name): thm for graph_file in graph.files_list for thm in graph_file.all_theorems_list}
+
+
+def get_parent_proof(exp_name: str, proj: str, parent_commit: str, file_name: str, theorem_name: str, theorem_str: str, fingerprint: str) -> tuple[str, list[str]] | None:
+    for exp in [exp_name] + Replay.experiments:
+        parent_log_path = os.path.join('./log', exp, proj, parent_commit, file_name, theorem_name+'.json')
+        if not os.path.exists(parent_log_path):
+            continue
+        try:
+            parent_log = json_load(parent_log_path)[0]
+        except Exception:
+            continue
+        if parent_log.get('fingerprint') == fingerprint and parent_log.get('final_proof'):
+            return exp, parent_log['final_proof']
+    if Replay.human:
+        # the datapoint has no fingerprint, the statement must match and coq-lsp checks the rest
+        thm = get_parent_theorems(proj, parent_commit).get((file_name, theorem_name))
+        if thm is not None and thm.steps and normalize(thm.text) == normalize(theorem_str):
+            return 'human', [step.text.strip() for step in thm.steps]
+    return None
+
+
+def replay_parent_proof(exp_name: str, proof_file: ProofFile, proof_term: ProofTerm, proj: str, parent_commit: str, file_name: str, theorem_name: str, fingerprint: str) -> tuple[bool, dict[str, Any]]:
+    parent_proof = get_parent_proof(exp_name, proj, parent_commit, file_name, theorem_name, proof_term.step.short_text, fingerprint)
+    if parent_proof is None:
+        return False, {}
+    source, proof = parent_proof
+    print(f'replaying proof from parent commit ({source}): ', theorem_name)
+    success, log_replay = replay_proof(proof_file, proof_term, proof)
+    log_replay['source'] = source
+    return success, log_replay
+
+
+def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofTerm, proj: str, commit: str, file_name: str, resume: str = '', parent_commit: str = '', incremental: bool = False, budget: Budget | None = None, sessions: SideSessions | None = None) -> tuple[bool, list[dict[str, Any]]]:
+    if budget is None:
+        budget = Budget()
+    theorem_name = proof_file.context.get_names(proof_file.context.expr(proof_term.step))[0]
+    log_path = os.path.join('./log', exp_name, proj, commit, file_name, theorem_name+'.json')
+
+    log = []
+    id_cache = IdCache.stats()
+    try:
+        success = _prove_llm_simpl_new(log, exp_name, proof_file, proof_term, proj, commit, file_name, resume, parent_commit, incremental, budget, sessions)
+    except BudgetExceeded as e:
+        print('budget exceeded: ', theorem_name, e)
+        success = False
+        if not log:
+            log.append({'iter': 0, 'success': False})
+        log[0]['budget_exceeded'] = str(e)
+
+    log[0]['budget'] = budget.usage()
+    # the cache lives as long as the worker, only this theorem's lookups are logged
+    id_cache_end = IdCache.stats()
+    log[0]['id_cache'] = {'hits': id_cache_end['hits'] - id_cache['hits'], 'misses': id_cache_end['misses'] - id_cache['misses'], 'size': id_cache_end['size']}
+    json_dump(log, log_path)
+    return success, log
+
+
+def _prove_llm_simpl_new(log: list[dict[str, Any]], exp_name: str, proof_file: ProofFile, proof_term: ProofTerm, proj: str, commit: str, file_name: str, resume: str, parent_commit: str, incremental: bool, budget: Budget, sessions: SideSessions | None) -> bool:
     theorem_name = proof_file.context.get_names(proof_file.context.expr(proof_term.step))[0]
     theorem_str = proof_term.step.short_text
     definitions = get_ids_in_step_recursive(proof_file, proof_term)
     definitions = {name: term.step.short_text.strip() for name, term in definitions.items()}
     definitions_list = list(set(definitions.values()))
+    fingerprint = theorem_fingerprint(theorem_str, definitions)
 
     print('start proving: ', theorem_name)
-    log_file_path = os.path.join('./log', exp_name, proj, commit, file_name)
-    log_path = os.path.join(log_file_path, theorem_name+'.json')
 
     datapoint_path = os.path.join(DATASET_NORMAL, proj, commit, 'datapoint')
     graph = Graph.from_proj_datapoint(datapoint_path, proj)
 
-    log = []
+    # the statement and its dependencies are unchanged since the parent commit, try its proof first
+    replay_failed = False
+    if incremental and parent_commit:
+        replay_success, log_replay = replay_parent_proof(exp_name, proof_file, proof_term, proj, parent_commit, file_name, theorem_name, fingerprint)
+        if replay_success:
+            log.append({
+                'iter': 0,
+                'success': True,
+                'fingerprint': fingerprint,
+                'replayed_from': parent_commit,
+                'replayed_proof_of': log_replay['source'],
+                'final_proof': log_replay['final_proof'],
+            })
+            return True
+        replay_failed = bool(log_replay)
 
     # generate initial proof and try to prove it
     resume_path = os.path.join('./log', resume, proj, commit, file_name, theorem_name+'.json')
@@ -42,7 +132,7 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
         error_tactic_initial = resume_log['error_tactic']
         error_msg_initial = resume_log['error_msg']
     else:
-        return False, []
+        raise TaskSkipped(f'No initial attempt of {theorem_name} in {resume_path}')
 
 
     log.append({
@@ -52,11 +142,13 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
         'stuck_state_initial': stuck_state_initial,
         'error_tactic_initial': error_tactic_initial,
         'error_msg_initial': error_msg_initial,
+        'fingerprint': fingerprint,
+        'replay_failed': replay_failed,
     })
 
     if success:
-        json_dump(log, log_path)
-        return True, log
+        log[0]['final_proof'] = partial_proof_initial
+        return True
     
     # if failed, retrieve more context, including lemmas, ...
     lemmas_list, lemmas_dict = retrieve_current_lemmas(proof_file, proof_term)
@@ -83,10 +175,12 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
     error_tactic = error_tactic_initial
     error_msg = error_msg_initial
     # ask LLM what is the next action
-    llm = LLM()
-    for iter in range(1, 4):
+    llm = LLM(budget=budget)
+    for iter in range(1, budget.max_iters + 1):
+        budget.check()
+        log_decision = {}
         if iter == 1:
-            decision, keywords = decision_initial_llm(theorem_str, partial_proof, stuck_state, definitions_list, lemmas_list_top, most_similar_theorem.get_complete(), llm)
+            decision, keywords = decision_initial_llm(theorem_str, partial_proof, stuck_state, definitions_list, lemmas_list_top, most_similar_theorem.get_complete(), llm, log_decision)
         else:
             decision, keywords = decision_following_llm(llm)
 
@@ -104,7 +198,7 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
                 prompt = RETRIEVED_EXTRA_LEMMAS.format(lemmas_current=current_lemmas_str, lemmas_previous=previous_lemmas_str)
             llm.add_user_message(prompt)
             helpfer_lemmas = current_lemmas_list + list(proposed_lemmas.values()) + list(refined_lemmas.values())
-            success, full_proof_regenerate, partial_proof_regenerate, stuck_state_regenerate, error_tactic_regenerate, error_msg_regenerate, conversation, log_gen, log_prove = prove_theorem_regenerate(proof_file, proof_term, stuck_state, theorem_str, partial_proof, definitions_list, helpfer_lemmas)
+            success, full_proof_regenerate, partial_proof_regenerate, stuck_state_regenerate, error_tactic_regenerate, error_msg_regenerate, conversation, log_gen, log_prove = prove_theorem_regenerate(proof_file, proof_term, stuck_state, theorem_str, error_tactic, error_msg, partial_proof, definitions_list, helpfer_lemmas, most_similar_theorem.get_complete(), budget=budget, sessions=sessions)
             # success, full_proof_regenerate, partial_proof_regenerate, stuck_state_regenerate, error_tactic_regenerate, error_msg_regenerate, conversation, log_gen, log_prove = prove_theorem_regenerate_new(regen_llm, proof_file, proof_term, stuck_state, theorem_str, partial_proof, error_tactic, error_msg, definitions_list, helpfer_lemmas)
             stuck_state = stuck_state_regenerate
             partial_proof = partial_proof_regenerate
@@ -114,6 +208,8 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
             log.append({
                 'iter': iter,
                 'decision': 'context_retrieval',
+                'compaction': llm.compaction,
+                **log_decision,
                 'success': success,
                 'keywords': keywords,
                 'current_lemmas': current_lemmas_list,
@@ -125,8 +221,8 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
                 'log_prove': log_prove,
             })
             if success:
-                json_dump(log, log_path)
-                return True, log
+                log[0]['final_proof'] = get_final_proof(proof_term)
+                return True
 
         elif decision == 'lemma_discovery':
             # propose new lemmas
@@ -138,7 +234,7 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
                     if thm is not None:
                         to_refine_lemmas[name] = thm.get_complete().strip()
                 non_exist_lemmas = {name: term.get_complete().strip() for name, term in most_similar_theorem_lemmas.items() if name not in lemmas_dict and name not in refined_lemmas}
-                success_refine_lemmas, failed_refine_lemmas, log_lemma_refinement = lemma_refinement(proof_file, proof_term, theorem_str, most_similar_theorem_definitions_list, definitions_list, non_exist_lemmas)
+                success_refine_lemmas, failed_refine_lemmas, log_lemma_refinement = lemma_refinement(proof_file, proof_term, theorem_str, stuck_state, definitions_list, lemmas_list_top, non_exist_lemmas, budget=budget)
             else:
                 success_refine_lemmas = {}
                 log_lemma_refinement = {}
@@ -147,7 +243,7 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
             helper_lemmas.update(lemmas_list_top_dict)
             helper_lemmas.update(refined_lemmas)
             helper_lemmas.update(proposed_lemmas)
-            success_propose_lemmas, failed_propose_lemmas, log_lemma_discovery = lemma_discovery(proof_file, proof_term, helper_lemmas)
+            success_propose_lemmas, failed_propose_lemmas, log_lemma_discovery = lemma_discovery(proof_file, proof_term, helper_lemmas, budget=budget)
 
             refined_lemmas.update(success_refine_lemmas)
             proposed_lemmas.update(success_propose_lemmas)
@@ -160,7 +256,7 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
                 prompt = NEW_LEMMA_DISCOVERY_REFINED.format(refined_lemmas=refined_lemmas_str, new_lemmas=proposed_lemmas_str)
             llm.add_user_message(prompt)
             helpfer_lemmas = lemmas_list_top + list(proposed_lemmas.values()) + list(refined_lemmas.values())
-            success, full_proof_regenerate, partial_proof_regenerate, stuck_state_regenerate, error_tactic_regenerate, error_msg_regenerate, conversation, log_gen, log_prove = prove_theorem_regenerate(proof_file, proof_term, stuck_state, theorem_str, partial_proof, definitions_list, helpfer_lemmas)
+            success, full_proof_regenerate, partial_proof_regenerate, stuck_state_regenerate, error_tactic_regenerate, error_msg_regenerate, conversation, log_gen, log_prove = prove_theorem_regenerate(proof_file, proof_term, stuck_state, theorem_str, error_tactic, error_msg, partial_proof, definitions_list, helpfer_lemmas, most_similar_theorem.get_complete(), budget=budget, sessions=sessions)
                 # success, full_proof_regenerate, partial_proof_regenerate, stuck_state_regenerate, error_tactic_regenerate, error_msg_regenerate, conversation, log_gen, log_prove = prove_theorem_regenerate_new(regen_llm, proof_file, proof_term, stuck_state, theorem_str, partial_proof, error_tactic, error_msg, definitions_list, helpfer_lemmas)
             stuck_state = stuck_state_regenerate
             partial_proof = partial_proof_regenerate
@@ -170,6 +266,8 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
             log.append({
                 'iter': iter,
                 'decision': 'lemma_discovery',
+                'compaction': llm.compaction,
+                **log_decision,
                 'success': success,
                 'refined_lemmas': success_refine_lemmas,
                 'proposed_lemmas': success_propose_lemmas,
@@ -177,8 +275,8 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
                 'log_prove': log_prove,
             })
             if success:
-                json_dump(log, log_path)
-                return True, log
+                log[0]['final_proof'] = get_final_proof(proof_term)
+                return True
 
         elif decision == 'regenerate':
             # regenerate the proof
@@ -186,9 +284,9 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
             helper_lemmas.update(lemmas_list_top_dict)
             helper_lemmas.update(refined_lemmas)
             helper_lemmas.update(proposed_lemmas)
-            helper_lemmas_list = [item.text.strip() for item in helper_lemmas.values()]
+            helper_lemmas_list = [text.strip() for text in helper_lemmas.values()]
             # generate a new proof
-            success, full_proof_regenerate, partial_proof_regenerate, stuck_state_regenerate, error_tactic_regenerate, error_msg_regenerate, conversation, log_gen, log_prove = prove_theorem_regenerate(proof_file, proof_term, stuck_state, error_tactic, error_msg, theorem_str, partial_proof, definitions_list, helper_lemmas_list, most_similar_theorem.get_complete())
+            success, full_proof_regenerate, partial_proof_regenerate, stuck_state_regenerate, error_tactic_regenerate, error_msg_regenerate, conversation, log_gen, log_prove = prove_theorem_regenerate(proof_file, proof_term, stuck_state, theorem_str, error_tactic, error_msg, partial_proof, definitions_list, helper_lemmas_list, most_similar_theorem.get_complete(), budget=budget, sessions=sessions)
             stuck_state = stuck_state_regenerate
             partial_proof = partial_proof_regenerate
             error_tactic = error_tactic_regenerate
@@ -197,16 +295,17 @@ def prove_llm_simpl_new(exp_name: str, proof_file: ProofFile, proof_term: ProofT
             log.append({
                 'iter': iter,
                 'decision': 'regenerate',
+                'compaction': llm.compaction,
+                **log_decision,
                 'success': success,
                 'log_gen': log_gen, 
                 'log_prove': log_prove,
             })
 
             if success:
-                json_dump(log, log_path)
-                return True, log
+                log[0]['final_proof'] = get_final_proof(proof_term)
+                return True
             else:
                 prompt = REGENERATE_FEEDBACK.format(generated_proof=full_proof_regenerate, partial_proof=partial_proof_regenerate, proof_state=stuck_state_regenerate, error_tactic=error_tactic_regenerate, error_msg=error_msg_regenerate)
                 llm.add_user_message(prompt)
-    json_dump(log, log_path)
-    return False, log
+    return False
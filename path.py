@@ -1,5 +1,6 @@
 COQDEV = './CoqDev/dataset'
 DATASET = './dataset_final/normal'
+DATASET_NORMAL = DATASET
 DATASET_NO_DEPS = './dataset_final/no_deps'
 
 LOG_BASELINE = './logs_baseline'
@@ -0,0 +1,215 @@
+"""
+Two-stage runtime for the initial proof attempt. An asyncio stage builds the
+prompts from the datapoint graph (no Coq needed) and keeps many LLM requests in
+flight through the async client, while a separate pool of Coq executors checks the returned proofs. Each
+stage is sized on its own, so neither the network nor coq-lsp sits idle.
+
+The logs written here have the same format as the initial attempts read by
+`prove_llm_simpl_new`, so a pipeline experiment can be passed to `run.py` as
+`--resume` to continue with the refinement loop.
+"""
+import os
+import time
+import zlib
+import asyncio
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from path import DATASET_NORMAL, LOG
+from llm import LLM
+from llm_cache import ResponseCache, MODES as CACHE_MODES
+from hammer_cache import HammerCache
+from llm_client import Limits
+from budget import Budget
+from utils_prompt import Packing
+from telemetry import Telemetry, set_context
+from utils import json_dump, get_coq_project_info_from_file
+from utils_coq import parse_response_proof
+from ledger import TaskSkipped, get_ledger
+from agent_proof.agent import prove_theorem
+from agent_proof.gen_proof import build_initial_prompt
+from agent_retrieval.dependency_graph_simple_rango_file import Graph
+from run import collect_tasks, get_file_steps, get_partial_steps, is_begin_of
+from checkpoint import FileCheckpoint
+
+
+class Executors:
+    # file checkpoints each Coq executor keeps open, least recently used closed first
+    open_files = 4
+
+
+_graphs: dict[tuple[str, str], Graph] = {}
+_graphs_lock = threading.Lock()
+
+
+def get_graph(proj: str, commit: str) -> Graph:
+    # prompts are built in threads, a graph is only loaded once
+    with _graphs_lock:
+        if (proj, commit) not in _graphs:
+            datapoint_path = os.path.join(DATASET_NORMAL, proj, commit, 'datapoint')
+            _graphs[(proj, commit)] = Graph.from_proj_datapoint(datapoint_path, proj)
+        return _graphs[(proj, commit)]
+
+
+def initial_prompt(proj: str, commit: str, file: str, task: dict) -> str:
+    graph_file = get_graph(proj, commit).get_graph_file(file)
+    definitions = []
+    if graph_file is not None:
+        terms = graph_file.get_terms_in_text_recursive(task['text'])
+        definitions = list({term.text.strip() for name, term in terms.items() if name != task['name']})
+    prompt, _ = build_initial_prompt(task['text'], definitions, [])
+    return prompt
+
+
+# (workspace, file, options) -> checkpoint, per Coq executor; responses of different files arrive interleaved
+_checkpoints: OrderedDict[tuple[str, str, str], FileCheckpoint] = OrderedDict()
+
+
+def get_file_checkpoint(workspace: str, file: str, option: str) -> FileCheckpoint:
+    key = (workspace, file, option)
+    if key in _checkpoints:
+        _checkpoints.move_to_end(key)
+        return _checkpoints[key]
+    while len(_checkpoints) >= Executors.open_files:
+        _, checkpoint = _checkpoints.popitem(last=False)
+        checkpoint.close()
+    _checkpoints[key] = FileCheckpoint(workspace, file, option)
+    return _checkpoints[key]
+
+
+def close_file_checkpoint(workspace: str, file: str, option: str):
+    checkpoint = _checkpoints.pop((workspace, file, option), None)
+    if checkpoint is not None:
+        checkpoint.close()
+
+
+def close_checkpoints():
+    while _checkpoints:
+        _, checkpoint = _checkpoints.popitem()
+        checkpoint.close()
+
+
+def check_initial_proof(exp_name: str, workspace: str, proj: str, commit: str, file: str, task: dict, tasks: list[dict], prompt: str, response: str, usage: dict) -> bool | None:
+    """
+    Runs in a Coq executor: open the theorem in the checkpoint of its file,
+    check the proof from the response and write the log of the initial
+    attempt. `usage` is the budget usage of the LLM request, so the ledger
+    records the same time and tokens as for a theorem proved by run.py.
+    """
+    ledger = get_ledger()
+    start = time.time()
+    option = ''
+    try:
+        option = get_coq_project_info_from_file(os.path.join(workspace, file))
+        partial_steps = get_partial_steps(get_file_steps(workspace, file, option), task, tasks)
+        if partial_steps is None:
+            raise TaskSkipped(f'Theorem {task["name"]} not found in {file}')
+        proof_file, proof_term = get_file_checkpoint(workspace, file, option).open_theorem(partial_steps)
+        assert is_begin_of(proof_term.step, task)
+
+        steps = parse_response_proof(response)
+        success, log_prove, partial_proof_str, stuck_state, error_tactic, error_msg = prove_theorem(proof_file, proof_term, steps)
+        log = [{
+            'iter': 0,
+            'success': success,
+            'partial_proof_initial': partial_proof_str,
+            'stuck_state': stuck_state,
+            'error_tactic': error_tactic,
+            'error_msg': error_msg,
+            'prompt': prompt,
+            'response': response,
+            'log_prove': log_prove,
+            'budget': usage,
+        }]
+        json_dump(log, os.path.join(LOG, exp_name, proj, commit, file, task['name'] + '.json'))
+        ledger.finish(exp_name, proj, commit, file, task['name'], success, usage['llm_time'] + time.time() - start, usage['prompt_tokens'] + usage['completion_tokens'])
+        return success
+    except TaskSkipped as e:
+        print('Skipped: ', file, task['name'], e)
+        ledger.skip(exp_name, proj, commit, file, task['name'], str(e), time.time() - start)
+        return None
+    except Exception as e:
+        print('Error: ', file, task['name'], e)
+        # the document may be left in an unknown state
+        close_file_checkpoint(workspace, file, option)
+        ledger.error(exp_name, proj, commit, file, task['name'], repr(e), usage['llm_time'] + time.time() - start, usage['prompt_tokens'] + usage['completion_tokens'])
+        return None
+
+
+async def run_pipeline(exp_name: str, proj: str, llm_concurrency: int, coq_workers: int):
+    all_tasks = collect_tasks(exp_name, proj, checkpoint=True)
+    print(f'Remaining tasks: {len(all_tasks)}')
+
+    llm_slots = asyncio.Semaphore(llm_concurrency)
+    # one single-process executor per shard, so a file always lands on the same warm checkpoint
+    coq_pools = [ProcessPoolExecutor(max_workers=1) for _ in range(coq_workers)]
+    ledger = get_ledger()
+    begin = time.time()
+
+    # only the targets of the same file matter when cutting the prefix of a theorem
+    file_targets: dict[tuple[str, str], list[dict]] = {}
+    for task in all_tasks:
+        file_targets.setdefault((task[3], task[5]), []).append(task[6])
+
+    async def one(task: tuple) -> bool | None:
+        exp_name, workspace, proj, commit, _, file, thm = task[:7]
+        tasks = file_targets[(commit, file)]
+        # loading a graph and writing the ledger block, keep them off the event loop
+        prompt = await asyncio.to_thread(initial_prompt, proj, commit, file, thm)
+        set_context(exp_name=exp_name, proj=proj, commit=commit, file=file, theorem=thm['name'])
+        await asyncio.to_thread(ledger.start, exp_name, proj, commit, file, thm['name'])
+        budget = Budget()
+        try:
+            async with llm_slots:
+                response = (await LLM(budget=budget).aquery(prompt))[0]
+        except Exception as e:
+            print('LLM error: ', file, thm['name'], e)
+            await asyncio.to_thread(ledger.error, exp_name, proj, commit, file, thm['name'], repr(e), budget.llm_time, budget.tokens)
+            return None
+        shard = zlib.crc32(f'{commit}/{file}'.encode()) % coq_workers
+        future = coq_pools[shard].submit(check_initial_proof, exp_name, workspace, proj, commit, file, thm, tasks, prompt, response, budget.usage())
+        return await asyncio.wrap_future(future)
+
+    results = await asyncio.gather(*[one(task) for task in all_tasks])
+
+    for pool in coq_pools:
+        pool.submit(close_checkpoints).result()
+        pool.shutdown()
+
+    wall = time.time() - begin
+    proved = sum(1 for r in results if r)
+    checked = sum(1 for r in results if r is not None)
+    print(f'Proved {proved}/{checked} theorems in {wall:.1f}s ({checked / wall * 3600 if wall > 0 else 0:.1f} theorems/hour)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--exp_name', type=str)
+    parser.add_argument('--proj', type=str)
+    parser.add_argument('--model', type=str, choices=['gpt-4o', 'gpt-4o-mini', 'deepseek-chat', 'claude-3-7-sonnet-20250219', 'meta-llama/llama-4-maverick-17b-128e-instruct-fp8'])
+    parser.add_argument('--temp', type=float, default=0)
+    parser.add_argument('--top_p', type=float, default=1)
+    parser.add_argument('--llm_cache', type=str, default='off', choices=CACHE_MODES, help='replay temperature 0 responses from log/llm_cache.db')
+    parser.add_argument('--llm_base_url', type=str, default='', help='OpenAI-compatible endpoint to use instead of the provider, e.g. llm_stub.py')
+    parser.add_argument('--llm_concurrency', type=int, default=16, help='LLM requests in flight')
+    parser.add_argument('--rpm', type=int, default=0, help='LLM requests per minute, 0 for no limit')
+    parser.add_argument('--prompt_tokens', type=int, default=0, help='token budget for the definitions and lemmas of a prompt, 0 for no limit')
+    parser.add_argument('--hammer_cache', action='store_true', help='reuse hammer results for the same goal and environment from log/hammer_cache.db')
+    parser.add_argument('--telemetry', action='store_true', help='record every LLM call under log/<exp_name>/telemetry')
+    parser.add_argument('--coq_workers', type=int, default=4, help='Coq executor processes')
+    parser.add_argument('--open_files', type=int, default=4, help='file checkpoints each Coq executor keeps open')
+    args = parser.parse_args()
+
+    LLM.model = args.model
+    LLM.temp = args.temp
+    LLM.top_p = args.top_p
+    LLM.base_url = args.llm_base_url
+    ResponseCache.mode = args.llm_cache
+    Limits.requests_per_minute = args.rpm
+    Packing.max_tokens = args.prompt_tokens
+    Telemetry.enabled = args.telemetry
+    HammerCache.enabled = args.hammer_cache
+    Executors.open_files = args.open_files
+    asyncio.run(run_pipeline(args.exp_name, args.proj, args.llm_concurrency, args.coq_workers))
@@ -3,14 +3,28 @@ from coqpyt.coq.proof_file import ProofFile
 from coqpyt.coq.base_file import CoqFile
 from coqpyt.coq.structs import Step
 import shutil
-import multiprocessing
+import time
 import os
 import argparse
 import re
+from collections import OrderedDict
 from path import DATASET, DATASET_NO_DEPS, LOG
-from utils import get_coq_project_info_from_file, copy_file, json_load
+from utils import get_coq_project_info_from_file, copy_file, create_dirs, json_load, json_dump
+from ledger import Ledger, TaskSkipped, get_ledger
+from scheduler import run_grouped, print_stats
+from checkpoint import HAMMER_HEADER, get_checkpoint, get_side_sessions, close_checkpoint
 from main.framework import prove_llm_simpl_new
+from agent_proof.gen_proof import Candidates
+from agent_proof.stream import Streaming
+from agent_proof.speculate import Speculation
+from main.framework import Replay
 from llm import LLM
+from budget import Budget
+from llm_cache import ResponseCache, MODES as CACHE_MODES
+from hammer_cache import HammerCache
+from llm_client import Limits
+from utils_prompt import Packing, Compaction
+from telemetry import Telemetry, set_context
 import json
 
 
@@ -38,34 +52,16 @@ def get_targets(proj: str) -> tuple[dict[str, dict], dict[str, str]]:
     return targets, parent_commits
 
 
-def copy_resume_log(exp_name: str, proj: str, commit: str, file_name: str, resume: str):
-    log_resume_path = os.path.join('./log', resume, proj, commit, file_name)
-    log_exp_path = os.path.join('./log', exp_name, proj, commit, file_name)
-    if not os.path.exists(log_exp_path):
-        os.makedirs(log_exp_path)
-    if not os.path.exists(log_resume_path):
-        print(f'Log resume path {log_resume_path} does not exist')
-        return
-    
-    thms = os.listdir(log_resume_path)
-    for thm in thms:
-        thm_log_path = os.path.join(log_resume_path, thm)
-        thm_log = json_load(thm_log_path)
-        succ = thm_log[0]['success']
-        if succ:
-            shutil.copy(thm_log_path, os.path.join(log_exp_path, thm))
-
-
-def get_existing_logs(exp_name: str, proj: str, commit: str, file: str) -> set[str]:
-    log_poj_path = os.path.join(LOG, exp_name, proj, commit, file)
-    if not os.path.exists(log_poj_path):
-        return set()
-    thms = os.listdir(log_poj_path)
-    results = set()
-    for thm in thms:
-        thm_name = thm.replace('.json', '')
-        results.add(file + '/' + thm_name)
-    return results
+def copy_resume_logs(ledger: Ledger, exp_name: str, proj: str, resume: str):
+    ledger.import_logs(resume, proj)
+    resumed = ledger.succeeded(resume, proj)
+    for commit, file, thm in resumed:
+        thm_log_path = os.path.join(LOG, resume, proj, commit, file, thm + '.json')
+        exp_log_path = os.path.join(LOG, exp_name, proj, commit, file, thm + '.json')
+        create_dirs(exp_log_path)
+        shutil.copy(thm_log_path, exp_log_path)
+    ledger.copy_succeeded(resume, exp_name, proj)
+    print(f'Resumed {len(resumed)} proved theorems from {resume}')
 
 
 def get_theorem_name(text: str) -> str:
@@ -100,12 +96,27 @@ def is_abort(steps: list[Step], ind: int) -> int:
     return 0
 
 
-def prove_one_thm(exp_name: str, workspace: str, proj: str, commit: str, parent_commit: str, file: str, task: dict, tasks: list[dict], resume: str = ''):  
+# (workspace, file, options) -> steps of the file, parsed once per worker;
+# only the most recent files are kept, a worker moves on file by file
+STEPS_CACHE_FILES = 4
+_steps_cache: OrderedDict[tuple[str, str, str], list[Step]] = OrderedDict()
+
+
+def get_file_steps(workspace: str, file: str, option: str) -> list[Step]:
+    key = (workspace, file, option)
+    if key in _steps_cache:
+        _steps_cache.move_to_end(key)
+        return _steps_cache[key]
     file_path = os.path.join(workspace, file)
-    option = get_coq_project_info_from_file(file_path)
     with CoqFile(file_path, workspace=workspace, timeout=600, extra_options=option) as coq_file:
         steps = coq_file.steps
+    while len(_steps_cache) >= STEPS_CACHE_FILES:
+        _steps_cache.popitem(last=False)
+    _steps_cache[key] = steps
+    return steps
 
+
+def get_partial_steps(steps: list[Step], task: dict, tasks: list[dict]) -> list[Step] | None:
     partial_steps = []
     ind = 0
     while ind < len(steps):
@@ -113,7 +124,7 @@ def prove_one_thm(exp_name: str, workspace: str, proj: str, commit: str, parent_
         if is_begin_any(step, tasks):
             if is_begin_of(step, task):
                 partial_steps.append(step)
-                break
+                return partial_steps
             else:
                 abt = is_abort(steps, ind)
                 if abt > 0:
@@ -124,15 +135,49 @@ def prove_one_thm(exp_name: str, workspace: str, proj: str, commit: str, parent_
         else:
             partial_steps.append(step)
             ind += 1
+    return None
 
-    if ind == len(steps):
-        print(f'Theorem {task["name"]} not found in {file}')
-        return
-    
-    partial_steps_text = ''.join([step.text for step in partial_steps])
-    hammer_time = 10
-    
-    partial_steps_text = f'From Hammer Require Import Hammer.\nSet Hammer ATPLimit {hammer_time}.\n' + partial_steps_text
+
+def prove_one_thm(exp_name: str, workspace: str, proj: str, commit: str, parent_commit: str, file: str, task: dict, tasks: list[dict], resume: str = '', checkpoint: bool = False, incremental: bool = False):  
+    ledger = get_ledger()
+    ledger.start(exp_name, proj, commit, file, task['name'])
+    start = time.time()
+    budget = Budget()
+    try:
+        success = _prove_one_thm(exp_name, workspace, proj, commit, parent_commit, file, task, tasks, resume, checkpoint, incremental, budget)
+        ledger.finish(exp_name, proj, commit, file, task['name'], success, time.time() - start, budget.tokens)
+    except TaskSkipped as e:
+        print('Skipped: ', file, task['name'], e)
+        ledger.skip(exp_name, proj, commit, file, task['name'], str(e), time.time() - start)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print('Error: ', file, task['name'])
+        print(e)
+        if checkpoint:
+            # the document may be left in an unknown state, start over for the next theorem
+            close_checkpoint()
+        ledger.error(exp_name, proj, commit, file, task['name'], repr(e), time.time() - start, budget.tokens)
+
+
+def _prove_one_thm(exp_name: str, workspace: str, proj: str, commit: str, parent_commit: str, file: str, task: dict, tasks: list[dict], resume: str, checkpoint: bool, incremental: bool = False, budget: Budget | None = None) -> bool:
+    file_path = os.path.join(workspace, file)
+    option = get_coq_project_info_from_file(file_path)
+    steps = get_file_steps(workspace, file, option)
+
+    partial_steps = get_partial_steps(steps, task, tasks)
+    if partial_steps is None:
+        raise TaskSkipped(f'Theorem {task["name"]} not found in {file}')
+    set_context(exp_name=exp_name, proj=proj, commit=commit, file=file, theorem=task['name'])
+    sessions = get_side_sessions(workspace, file, option) if Candidates.k > 1 or Speculation.enabled else None
+
+    if checkpoint:
+        proof_file, proof_term = get_checkpoint(workspace, file, option).open_theorem(partial_steps)
+        assert is_begin_of(proof_term.step, task)
+        success, log = prove_llm_simpl_new(exp_name, proof_file, proof_term, proj, commit, file, resume, parent_commit, incremental, budget, sessions)
+        return success
+
+    partial_steps_text = HAMMER_HEADER + ''.join([step.text for step in partial_steps])
 
     copied_file = copy_file(file_path, content = partial_steps_text)
     try:
@@ -144,46 +189,168 @@ def prove_one_thm(exp_name: str, workspace: str, proj: str, commit: str, parent_
             proof_term = proof_file.open_proofs[-1]
             assert is_begin_of(proof_term.step, task)
             proof_file.append_step(proof_term, '\nProof.')
-            success, log = prove_llm_simpl_new(exp_name, proof_file, proof_term, proj, commit, file, resume)
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        print('Error: ', file, task['name'])
-        print(e)
+            success, log = prove_llm_simpl_new(exp_name, proof_file, proof_term, proj, commit, file, resume, parent_commit, incremental, budget, sessions)
+            return success
     finally:
         os.remove(copied_file)
 
 
-def prove_project(exp_name: str, proj: str, resume: str, processes: int):
-    eval_targets, parent_commits = get_targets(proj)
+def order_commits(parent_commits: dict[str, str]) -> dict[str, int]:
+    # position of each eval commit such that a commit comes after its parent
+    order = {}
+    def visit(commit: str):
+        if commit in order:
+            return
+        parent = parent_commits[commit]
+        if parent in parent_commits:
+            visit(parent)
+        order[commit] = len(order)
+    for commit in parent_commits:
+        visit(commit)
+    return order
+
+
+def collect_tasks(exp_name: str, proj: str, resume: str = '', checkpoint: bool = False, incremental: bool = False, manifest: str = '') -> list[tuple]:
+    if manifest:
+        eval_targets, parent_commits = load_manifest(manifest, proj)
+    else:
+        eval_targets, parent_commits = get_targets(proj)
     all_tasks = []
     all_thms = []
 
+    ledger = get_ledger()
+    ledger.import_logs(exp_name, proj)
+    if resume:
+        copy_resume_logs(ledger, exp_name, proj, resume)
+    targets = [(commit, file, thm['name']) for commit, file_to_theorems in eval_targets.items()
+               for file, theorems in file_to_theorems.items() for thm in theorems]
+    ledger.add_tasks(exp_name, proj, targets)
+    done = ledger.done(exp_name, proj)
+
     for commit, file_to_theorems in eval_targets.items():
         parent_commit = parent_commits[commit]
         workspace = os.path.join(DATASET_NO_DEPS, proj, commit, proj)
         for file, theorems in file_to_theorems.items():
-            if resume:
-                copy_resume_log(exp_name, proj, commit, file, resume)
-            existing_logs = get_existing_logs(exp_name, proj, commit, file)
-            theorems_unsolved = [thm for thm in theorems if file + '/' + thm['name'] not in existing_logs]
-            if len(theorems_unsolved) == 0:
-                continue
+            theorems_unsolved = [thm for thm in theorems if (commit, file, thm['name']) not in done]
             for thm in theorems_unsolved:
-                all_tasks.append((exp_name, workspace, proj, commit, parent_commit, file, thm, all_thms, resume))
+                all_tasks.append((exp_name, workspace, proj, commit, parent_commit, file, thm, all_thms, resume, checkpoint, incremental))
                 all_thms.append(thm)
 
-    all_tasks.sort(key=lambda x: x[4] + '/' + x[6] + '/' + x[7]['name'])
-    
+    # keep theorems of the same file adjacent so workers reuse the parsed steps,
+    # and visit parent commits first so their proofs can be replayed
+    commit_order = order_commits(parent_commits)
+    all_tasks.sort(key=lambda x: (commit_order[x[3]], x[5], x[6]['name']))
+    return all_tasks
+
+
+def load_manifest(manifest: str, proj: str) -> tuple[dict[str, dict], dict[str, str]]:
+    content = json_load(manifest)
+    assert content['proj'] == proj, f'Manifest {manifest} is for {content["proj"]}, not {proj}'
+    total_count = sum(len(theorems) for file_to_theorems in content['targets'].values() for theorems in file_to_theorems.values())
+    print(f'Total number of theorems in manifest: {total_count}')
+    return content['targets'], content['parent_commits']
+
+
+def plan_project(exp_name: str, proj: str, resume: str = '', processes: int = 1) -> dict[str, Any]:
+    """
+    Dry run of prove_project: find the theorems that are left, check that their
+    workspaces exist and project the cost from earlier experiments on the same
+    project. Nothing is proved or copied; the only write is the one-time import
+    of logs from before the ledger into it.
+    """
+    eval_targets, parent_commits = get_targets(proj)
+    ledger = get_ledger()
+    ledger.import_logs(exp_name, proj)
+    done = ledger.done(exp_name, proj)
+    if resume:
+        # these are copied over when the experiment starts
+        ledger.import_logs(resume, proj)
+        done |= set(ledger.succeeded(resume, proj))
+    history = ledger.history(proj, exclude=exp_name)
+    known_time = [duration for duration, _ in history.values()]
+    known_tokens = [tokens for _, tokens in history.values() if tokens is not None]
+    mean_time = sum(known_time) / len(known_time) if known_time else None
+    mean_tokens = sum(known_tokens) / len(known_tokens) if known_tokens else None
+
+    remaining_targets = {}
+    commits = {}
+    missing = []
+    cpu_time, tokens, seen = 0.0, 0.0, 0
+    for commit, file_to_theorems in eval_targets.items():
+        workspace = os.path.join(DATASET_NO_DEPS, proj, commit, proj)
+        files = {}
+        for file, theorems in file_to_theorems.items():
+            theorems_unsolved = [thm for thm in theorems if (commit, file, thm['name']) not in done]
+            if not theorems_unsolved:
+                continue
+            remaining_targets.setdefault(commit, {})[file] = theorems_unsolved
+            files[file] = len(theorems_unsolved)
+            if not os.path.exists(os.path.join(workspace, file)):
+                missing.append(os.path.join(workspace, file))
+            for thm in theorems_unsolved:
+                # the same theorem in an earlier experiment is the best guess, the project mean otherwise
+                duration, thm_tokens = history.get((commit, file, thm['name']), (mean_time, mean_tokens))
+                seen += (commit, file, thm['name']) in history
+                cpu_time += duration or 0.0
+                tokens += (thm_tokens if thm_tokens is not None else mean_tokens) or 0.0
+        if files:
+            commits[commit] = {'workspace': workspace, 'files': files, 'theorems': sum(files.values())}
+
+    total = sum(len(theorems) for file_to_theorems in eval_targets.values() for theorems in file_to_theorems.values())
+    remaining = sum(c['theorems'] for c in commits.values())
+    return {
+        'exp_name': exp_name,
+        'proj': proj,
+        'total': total,
+        'remaining': remaining,
+        'commits': commits,
+        'files': sum(len(c['files']) for c in commits.values()),
+        'workspaces': len(commits),
+        'missing': missing,
+        'estimate': {
+            'history_theorems': seen,
+            'mean_time': mean_time,
+            'mean_tokens': mean_tokens,
+            'cpu_time': cpu_time if mean_time is not None else None,
+            'wall_time': cpu_time / processes if mean_time is not None else None,
+            'processes': processes,
+            'tokens': tokens if mean_tokens is not None else None,
+        },
+        'manifest': {'proj': proj, 'targets': remaining_targets, 'parent_commits': {commit: parent_commits[commit] for commit in remaining_targets}},
+    }
+
+
+def print_plan(plan: dict[str, Any]):
+    print(f"{plan['proj']}: {plan['remaining']}/{plan['total']} theorems left in {plan['files']} files of {plan['workspaces']} workspaces")
+    for commit, info in plan['commits'].items():
+        print(f"  {commit}: {info['theorems']} theorems")
+        for file, count in info['files'].items():
+            print(f'    {file}: {count}')
+    for path in plan['missing']:
+        print(f'  missing: {path}')
+    estimate = plan['estimate']
+    if estimate['mean_time'] is None:
+        print('No earlier experiment on this project, cannot project the cost')
+        return
+    print(f"Projected: {estimate['cpu_time'] / 3600:.1f} CPU hours, {estimate['wall_time'] / 3600:.1f} hours with {estimate['processes']} processes "
+          f"({estimate['history_theorems']}/{plan['remaining']} theorems seen before)")
+    if estimate['tokens'] is not None:
+        print(f"Projected LLM tokens: {estimate['tokens']:.0f}")
+
+
+def prove_project(exp_name: str, proj: str, resume: str, processes: int, checkpoint: bool = False, incremental: bool = False, manifest: str = ''):
+    all_tasks = collect_tasks(exp_name, proj, resume, checkpoint, incremental, manifest)
     print(f'Remaining tasks: {len(all_tasks)}')
     if processes == 1:
         for task in all_tasks:
             prove_one_thm(*task) 
     else:
-        pool = multiprocessing.Pool(processes=processes)
-        pool.starmap(prove_one_thm, all_tasks)
-        pool.close()
-        pool.join()
+        # theorems of one (commit, file) stay on one warm worker; to replay parent proofs,
+        # a commit only starts once its parent commit has been proved
+        order = dict(stage=lambda x: x[3], after=lambda x: x[4]) if incremental else {}
+        summary = run_grouped(prove_one_thm, all_tasks, processes, group_key=lambda x: (x[3], x[5]), on_exit=close_checkpoint, **order)
+        print_stats(summary)
+        json_dump(summary, os.path.join(LOG, exp_name, proj, 'scheduler.json'))
 
 
 if __name__ == '__main__':
@@ -196,9 +363,54 @@ if __name__ == '__main__':
     parser.add_argument('--top_p', type=float, default=1)
     parser.add_argument('--resume', type=str, default='')
     parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--checkpoint', action='store_true', help='share the checked prefix between theorems of the same file')
+    parser.add_argument('--incremental', action='store_true', help='replay proofs of unchanged theorems from the parent commit first')
+    parser.add_argument('--replay_from', type=str, nargs='*', default=[], help='with --incremental, earlier experiments to take parent proofs from')
+    parser.add_argument('--replay_human', action='store_true', help='with --incremental, fall back to the human proof in the parent commit')
+    parser.add_argument('--max_time', type=float, default=0, help='wall time per theorem in seconds, 0 for no limit')
+    parser.add_argument('--max_tokens', type=int, default=0, help='LLM tokens per theorem, 0 for no limit')
+    parser.add_argument('--max_hammer_calls', type=int, default=0, help='hammer calls per theorem, 0 for no limit')
+    parser.add_argument('--max_iters', type=int, default=3, help='refinement iterations per theorem')
+    parser.add_argument('--candidates', type=int, default=1, help='proofs sampled per regeneration and checked in parallel sessions')
+    parser.add_argument('--candidate_temp', type=float, default=0.8, help='temperature for sampling the candidates')
+    parser.add_argument('--stream', action='store_true', help='check regenerated proofs while they are generated')
+    parser.add_argument('--speculative_hammer', action='store_true', help='hammer the goal in a side session while the LLM generates the proof')
+    parser.add_argument('--llm_cache', type=str, default='off', choices=CACHE_MODES, help='replay temperature 0 responses from log/llm_cache.db')
+    parser.add_argument('--llm_base_url', type=str, default='', help='OpenAI-compatible endpoint to use instead of the provider, e.g. llm_stub.py')
+    parser.add_argument('--rpm', type=int, default=0, help='LLM requests per minute over all processes, 0 for no limit')
+    parser.add_argument('--prompt_tokens', type=int, default=0, help='token budget for the definitions and lemmas of a prompt, 0 for no limit')
+    parser.add_argument('--history_tokens', type=int, default=0, help='token budget for the decision conversation resent with each request, 0 for no limit')
+    parser.add_argument('--hammer_cache', action='store_true', help='reuse hammer results for the same goal and environment from log/hammer_cache.db')
+    parser.add_argument('--telemetry', action='store_true', help='record every LLM call under log/<exp_name>/telemetry')
+    parser.add_argument('--plan', action='store_true', help='only report the remaining work and projected cost, and write a task manifest')
+    parser.add_argument('--manifest', type=str, default='', help='run the tasks of a manifest written by --plan instead of all targets')
     args = parser.parse_args()
 
     LLM.model = args.model
     LLM.temp = args.temp
     LLM.top_p = args.top_p
-    prove_project(args.exp_name, args.proj, args.resume, args.processes)
+    LLM.base_url = args.llm_base_url
+    ResponseCache.mode = args.llm_cache
+    Candidates.k = args.candidates
+    Candidates.temp = args.candidate_temp
+    Streaming.enabled = args.stream
+    Speculation.enabled = args.speculative_hammer
+    Replay.experiments = args.replay_from
+    Replay.human = args.replay_human
+    Limits.requests_per_minute = args.rpm
+    Packing.max_tokens = args.prompt_tokens
+    Compaction.max_tokens = args.history_tokens
+    Telemetry.enabled = args.telemetry
+    HammerCache.enabled = args.hammer_cache
+    Budget.max_time = args.max_time
+    Budget.max_tokens = args.max_tokens
+    Budget.max_hammer_calls = args.max_hammer_calls
+    Budget.max_iters = args.max_iters
+    if args.plan:
+        plan = plan_project(args.exp_name, args.proj, args.resume, args.processes)
+        print_plan(plan)
+        manifest_path = os.path.join(LOG, args.exp_name, args.proj, 'manifest.json')
+        json_dump(plan['manifest'], manifest_path)
+        print(f'Task manifest written to {manifest_path}, run it with --manifest={manifest_path}')
+    else:
+        prove_project(args.exp_name, args.proj, args.resume, args.processes, args.checkpoint, args.incremental, args.manifest)
@@ -0,0 +1,202 @@
+import time
+import queue
+import multiprocessing
+from collections import deque, Counter
+from typing import Any, Callable, Hashable
+
+
+def partition_groups(tasks: list[tuple], group_key: Callable[[tuple], Hashable], workers: int) -> list[deque[list[tuple]]]:
+    """
+    Group tasks by `group_key` and split the groups into one contiguous run per
+    worker with roughly equal task counts, so that a worker sees as few
+    distinct keys (commits, files) as possible.
+    """
+    groups: dict[Hashable, list[tuple]] = {}
+    for task in tasks:
+        groups.setdefault(group_key(task), []).append(task)
+
+    queues = [deque() for _ in range(workers)]
+    target = len(tasks) / workers
+    worker, assigned = 0, 0
+    for group in groups.values():
+        if assigned >= target * (worker + 1) and worker < workers - 1:
+            worker += 1
+        queues[worker].append(group)
+        assigned += len(group)
+    return queues
+
+
+def _worker_loop(worker_id: int, generation: int, func: Callable, requests: multiprocessing.Queue, replies: multiprocessing.Queue, started: Any, on_exit: Callable | None):
+    report = None
+    while True:
+        requests.put((worker_id, generation, report))
+        group = replies.get()
+        if group is None:
+            break
+        busy = 0.0
+        for i, task in enumerate(group):
+            # read by the coordinator if this process dies
+            started.value = i
+            start = time.time()
+            try:
+                func(*task)
+            except Exception as e:
+                print(f'Worker {worker_id} failed on task: {e}')
+            busy += time.time() - start
+        started.value = len(group)
+        report = {'busy': busy, 'tasks': len(group)}
+    if on_exit is not None:
+        on_exit()
+
+
+def _take(groups: deque[list[tuple]], ready: Callable[[list[tuple]], bool], last: bool = False) -> list[tuple] | None:
+    # the first (or last) group that may run now
+    indices = range(len(groups) - 1, -1, -1) if last else range(len(groups))
+    for i in indices:
+        if ready(groups[i]):
+            group = groups[i]
+            del groups[i]
+            return group
+    return None
+
+
+def _steal(queues: list[deque], ready: Callable[[list[tuple]], bool]) -> list[tuple] | None:
+    candidates = [w for w in range(len(queues)) if any(ready(g) for g in queues[w])]
+    if not candidates:
+        return None
+    victim = max(candidates, key=lambda w: sum(len(g) for g in queues[w]))
+    # take from the far end of the victim's queue, away from its warm groups
+    return _take(queues[victim], ready, last=True)
+
+
+def run_grouped(func: Callable, tasks: list[tuple], processes: int, group_key: Callable[[tuple], Hashable], on_exit: Callable | None = None, poll: float = 5.0,
+                stage: Callable[[tuple], Hashable] | None = None, after: Callable[[tuple], Hashable] | None = None) -> dict[str, Any]:
+    """
+    Run `func(*task)` for all tasks in `processes` long-lived workers. Tasks
+    sharing a group key always run on the same worker, in order. An idle worker
+    first drains its own queue of groups, then steals whole groups from the
+    most loaded worker. Returns per-worker utilisation statistics.
+
+    With `stage` and `after`, a group is only handed out once every group of
+    the stage it comes after has reported back (e.g. a commit after its parent
+    commit); a worker with nothing else to run waits for it.
+
+    A worker that dies (killed for memory, a crash in coq-lsp) is noticed
+    within `poll` seconds: the task it was running counts as failed, the rest
+    of its group goes back to its queue and a new worker takes its place.
+    """
+    queues = partition_groups(tasks, group_key, processes)
+    requests = multiprocessing.Queue()
+    replies = [multiprocessing.Queue() for _ in range(processes)]
+    started = [multiprocessing.Value('i', -1) for _ in range(processes)]
+    generations = [0] * processes
+    current: list[list[tuple] | None] = [None] * processes
+    # groups of each stage that have not reported back
+    unfinished: Counter[Hashable] = Counter(stage(group[0]) for q in queues for group in q) if stage is not None else Counter()
+    ready = lambda group: after is None or unfinished[after(group[0])] == 0
+    waiting: list[int] = []
+
+    def spawn(worker_id: int) -> multiprocessing.Process:
+        worker = multiprocessing.Process(target=_worker_loop, args=(worker_id, generations[worker_id], func, requests, replies[worker_id], started[worker_id], on_exit))
+        worker.start()
+        return worker
+
+    def report_done(worker_id: int):
+        if current[worker_id] is not None and stage is not None:
+            unfinished[stage(current[worker_id][0])] -= 1
+        current[worker_id] = None
+
+    begin = time.time()
+    stats = [{'busy': 0.0, 'tasks': 0, 'groups': 0, 'steals': 0, 'restarts': 0, 'lost': 0, 'finished': None} for _ in range(processes)]
+    workers = [spawn(i) for i in range(processes)]
+
+    def assign(worker_id: int) -> int:
+        # hand out the next group, returns 1 when the worker is done
+        worker_stats = stats[worker_id]
+        group = _take(queues[worker_id], ready)
+        if group is None:
+            group = _steal(queues, ready)
+            if group is not None:
+                worker_stats['steals'] += 1
+        if group is None and any(queues):
+            # all that is left waits for groups still running
+            waiting.append(worker_id)
+            return 0
+        if group is None:
+            worker_stats['finished'] = time.time() - begin
+        else:
+            worker_stats['groups'] += 1
+        current[worker_id] = group
+        started[worker_id].value = -1
+        replies[worker_id].put(group)
+        return 1 if group is None else 0
+
+    def wake() -> int:
+        done = 0
+        for worker_id in waiting[:]:
+            waiting.remove(worker_id)
+            done += assign(worker_id)
+        return done
+
+    running = processes
+    while running > 0:
+        try:
+            worker_id, generation, report = requests.get(timeout=poll)
+        except queue.Empty:
+            for i, worker in enumerate(workers):
+                if stats[i]['finished'] is not None or worker.is_alive():
+                    continue
+                group, done = current[i], started[i].value
+                print(f'Worker {i} died (exit code {worker.exitcode})')
+                if group is not None and done < len(group):
+                    # the task it was running is not tried again here, the rest of the group is
+                    if done >= 0:
+                        print(f'Worker {i} died on task: {group[done]}')
+                        stats[i]['lost'] += 1
+                    rest = group[done + 1:] if done >= 0 else group
+                    if rest:
+                        queues[i].appendleft(rest)
+                        current[i] = None
+                report_done(i)
+                if i in waiting:
+                    waiting.remove(i)
+                # requests and replies of the dead process are stale
+                generations[i] += 1
+                replies[i] = multiprocessing.Queue()
+                stats[i]['restarts'] += 1
+                workers[i] = spawn(i)
+            running -= wake()
+            continue
+        if generation != generations[worker_id]:
+            continue
+        if report is not None:
+            stats[worker_id]['busy'] += report['busy']
+            stats[worker_id]['tasks'] += report['tasks']
+            report_done(worker_id)
+            running -= wake()
+        running -= assign(worker_id)
+
+    for worker in workers:
+        worker.join()
+    return summarize(stats, time.time() - begin)
+
+
+def summarize(stats: list[dict[str, Any]], wall: float) -> dict[str, Any]:
+    finished = [s['finished'] for s in stats]
+    for s in stats:
+        s['utilisation'] = s['busy'] / wall if wall > 0 else 0.0
+    return {
+        'wall': wall,
+        'utilisation': sum(s['busy'] for s in stats) / (wall * len(stats)) if wall > 0 else 0.0,
+        # time between the first worker running out of work and the end of the run
+        'tail': max(finished) - min(finished),
+        'workers': stats,
+    }
+
+
+def print_stats(summary: dict[str, Any]):
+    print(f"Wall time: {summary['wall']:.1f}s, utilisation: {summary['utilisation']:.1%}, straggler tail: {summary['tail']:.1f}s")
+    for i, s in enumerate(summary['workers']):
+        print(f"  worker {i}: {s['tasks']} tasks in {s['groups']} groups ({s['steals']} stolen), busy {s['busy']:.1f}s ({s['utilisation']:.1%}), done at {s['finished']:.1f}s")
+        if s['restarts']:
+            print(f"    restarted {s['restarts']} times, {s['lost']} tasks lost")
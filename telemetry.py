@@ -0,0 +1,162 @@
+"""
+Structured records of LLM calls. With `--telemetry`, every query appends one
+JSON line to `log/<exp_name>/telemetry/<host>-<pid>.jsonl`, with the call site,
+the theorem it was made for, tokens, latency, retries and cache status.
+
+`python telemetry.py --exp_name <exp_name>` aggregates them per call site and
+per project.
+"""
+import os
+import sys
+import math
+import json
+import time
+import socket
+import argparse
+import threading
+from contextvars import ContextVar
+from typing import Any
+
+from path import LOG
+from utils import create_dirs
+
+# USD per million prompt and completion tokens
+PRICES = {
+    'gpt-4o-2024-08-06': (2.5, 10.0),
+    'gpt-4o-mini': (0.15, 0.6),
+    'deepseek-chat': (0.27, 1.1),
+    'claude-3-7-sonnet-20250219': (3.0, 15.0),
+}
+
+
+class Telemetry:
+    enabled = False
+
+
+_context: ContextVar[dict[str, str]] = ContextVar('telemetry_context', default={})
+_lock = threading.Lock()
+
+
+def set_context(**context: str):
+    # the experiment and theorem the calls of this thread or task are made for
+    _context.set(context)
+
+
+def get_context() -> dict[str, str]:
+    return _context.get()
+
+
+def call_site(depth: int = 2) -> str:
+    # the function that called into LLM, `depth` frames above the caller of call_site
+    frame = sys._getframe(depth)
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+
+def cost(model: str, prompt_tokens: int, completion_tokens: int) -> float | None:
+    if model not in PRICES:
+        return None
+    prompt_price, completion_price = PRICES[model]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+def record(site: str, context: dict[str, str], model: str, usage: dict[str, int] | None, latency: float, retries: int, cache: str, **extra: Any):
+    if not Telemetry.enabled:
+        return
+    prompt_tokens = usage['prompt_tokens'] if usage else 0
+    completion_tokens = usage['completion_tokens'] if usage else 0
+    entry = {
+        'time': time.time(),
+        'site': site,
+        **context,
+        'model': model,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        # cache hits and shared responses were not paid for
+        'cost': cost(model, prompt_tokens, completion_tokens) if cache in ['off', 'miss'] else 0.0,
+        'latency': latency,
+        'retries': retries,
+        'cache': cache,
+        **extra,
+    }
+    path = os.path.join(LOG, context.get('exp_name', 'default'), 'telemetry', f'{socket.gethostname()}-{os.getpid()}.jsonl')
+    with _lock:
+        create_dirs(path)
+        with open(path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+def load_records(exp_name: str) -> list[dict[str, Any]]:
+    records = []
+    path = os.path.join(LOG, exp_name, 'telemetry')
+    if not os.path.isdir(path):
+        return records
+    for file in sorted(os.listdir(path)):
+        if not file.endswith('.jsonl'):
+            continue
+        with open(os.path.join(path, file)) as f:
+            for line in f:
+                # the last line of a killed worker may be cut off
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return records
+
+
+def percentile(values: list[float], p: float) -> float:
+    # nearest rank
+    values = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[index]
+
+
+def summarize(records: list[dict[str, Any]]) -> dict[str, Any]:
+    latencies = [r['latency'] for r in records]
+    tokens = [r['prompt_tokens'] + r['completion_tokens'] for r in records]
+    costs = [r['cost'] for r in records if r['cost'] is not None]
+    return {
+        'calls': len(records),
+        'latency': {f'p{p}': percentile(latencies, p) for p in [50, 90, 99]},
+        'latency_total': sum(latencies),
+        'tokens': {f'p{p}': percentile(tokens, p) for p in [50, 90, 99]},
+        'prompt_tokens': sum(r['prompt_tokens'] for r in records),
+        'completion_tokens': sum(r['completion_tokens'] for r in records),
+        'cost': sum(costs),
+        'retries': sum(r['retries'] for r in records),
+        'cache_hits': sum(1 for r in records if r['cache'] in ['hit', 'coalesced']),
+    }
+
+
+def aggregate(records: list[dict[str, Any]]) -> dict[str, Any]:
+    groups: dict[tuple[str, str], list[dict]] = {}
+    for r in records:
+        groups.setdefault(('*', r['site']), []).append(r)
+        groups.setdefault((r.get('proj', '?'), r['site']), []).append(r)
+    return {f'{proj}/{site}': summarize(group) for (proj, site), group in sorted(groups.items())}
+
+
+def print_summary(summary: dict[str, Any]):
+    print(f"{'project/site':<60} {'calls':>6} {'p50 s':>7} {'p90 s':>7} {'p99 s':>7} {'total s':>9} {'tokens':>10} {'cost $':>8} {'retries':>7} {'hits':>5}")
+    for key, s in summary.items():
+        print(f"{key:<60} {s['calls']:>6} {s['latency']['p50']:>7.2f} {s['latency']['p90']:>7.2f} {s['latency']['p99']:>7.2f} {s['latency_total']:>9.1f} "
+              f"{s['prompt_tokens'] + s['completion_tokens']:>10} {s['cost']:>8.3f} {s['retries']:>7} {s['cache_hits']:>5}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--exp_name', type=str, required=True)
+    parser.add_argument('--proj', type=str, default='', help='only the calls for this project')
+    parser.add_argument('--json', type=str, default='', help='also write the summary to this file')
+    args = parser.parse_args()
+
+    records = load_records(args.exp_name)
+    if args.proj:
+        records = [r for r in records if r.get('proj') == args.proj]
+    if not records:
+        print(f'No telemetry for {args.exp_name}, run it with --telemetry')
+        sys.exit(1)
+    summary = aggregate(records)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
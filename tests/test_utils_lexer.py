@@ -0,0 +1,44 @@
+import os
+import json
+
+import pytest
+
+from utils_lexer import SentenceSplitter, split_sentences, strip_comments, identifiers
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'data', 'sentence_splits.json')
+
+with open(CORPUS) as f:
+    cases = json.load(f)
+
+
+@pytest.mark.parametrize('case', cases, ids=[case['name'] for case in cases])
+def test_split(case):
+    # None where coq-lsp has to decide
+    assert split_sentences(case['code']) == case['sentences']
+
+
+@pytest.mark.parametrize('case', cases, ids=[case['name'] for case in cases])
+def test_split_streamed(case):
+    # a response arrives in arbitrary chunks, the sentences must not depend on them
+    splitter = SentenceSplitter()
+    sentences = []
+    for c in case['code']:
+        sentences += splitter.feed(c)
+    sentences += splitter.finish()
+    assert (None if splitter.ambiguous else sentences) == case['sentences']
+
+
+def test_split_fenced():
+    splitter = SentenceSplitter(fence=True)
+    response = 'Here is the proof:\n```coq\nProof.\nintros. auto.\nQed.\n```\nThe `auto.` closes the goal.'
+    sentences = splitter.feed(response) + splitter.finish()
+    assert sentences == ['Proof.', '\nintros.', ' auto.', '\nQed.']
+    assert not splitter.ambiguous
+
+
+def test_strip_comments():
+    assert strip_comments('a (* b (* c *) "*)" *) d "(* e"') == 'a  d "(* e"'
+
+
+def test_identifiers():
+    assert identifiers('apply (* H0 *) Nat.add_comm with (n := "x y").') == ['apply', 'Nat.add_comm', 'with', 'n']
@@ -78,7 +78,11 @@ def norm_postfix(file_name: str, target_postfix: str) -> str:
 def json_dump(obj, out_file: str):
     out_file = norm_postfix(out_file, 'json')
     create_dirs(out_file)
-    json.dump(obj, open(out_file, 'w'))
+    # write to a temporary file first so a crash never leaves a truncated log
+    tmp_file = f'{out_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_file, out_file)
 
 
 def json_load(in_file: str):
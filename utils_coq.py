@@ -1,7 +1,15 @@
 import re
 import random
 import os
+import shutil
+import atexit
+import hashlib
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
 from utils import extract_code_blocks
+from utils_lexer import split_sentences, strip_comments, identifiers
 from typing import List, Dict, Tuple
 from coqpyt.coq.proof_file import ProofFile
 from coqpyt.coq.base_file import CoqFile
@@ -9,19 +17,109 @@ from coqpyt.coq.context import FileContext
 from coqpyt.coq.structs import Term, Step, ProofTerm
 from coqpyt.coq.lsp.structs import Goal, Hyp
 from coqpyt.coq.exceptions import InvalidChangeException
-from datetime import datetime
 
 
-def parse_code(code: str) -> list[Step]:
-    timestamp = str(datetime.now().timestamp()).replace('.', '')
-    file_name = f'__parse__{timestamp}.v'
-    code = '\n' + code.strip()
+class CodeParser:
+    """
+    One coq-lsp document kept open per worker process to split code into
+    sentences. Code is parsed through in-memory edits of an empty scratch
+    document in a private directory, instead of a new file and a new coq-lsp
+    session per call.
+    """
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix='parse_')
+        self.path = os.path.join(self.dir, 'Parse.v')
+        with open(self.path, 'w') as f:
+            f.write('')
+        self.coq_file = CoqFile(self.path, timeout=60)
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def parse(self, code: str) -> list[Step]:
+        with self.lock:
+            return self.coq_file.parse_code('\n' + code.strip())
+
+    def close(self):
+        try:
+            self.coq_file.close()
+        except Exception:
+            # the session may already be dead
+            pass
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+_parser: CodeParser | None = None
+
+
+def get_parser() -> CodeParser:
+    global _parser
+    if _parser is not None and _parser.pid != os.getpid():
+        # the session of the parent process is not ours to use or close
+        _parser = None
+    if _parser is None:
+        _parser = CodeParser()
+    return _parser
+
+
+def close_parser():
+    global _parser
+    parser, _parser = _parser, None
+    if parser is not None and parser.pid == os.getpid():
+        parser.close()
+
+
+atexit.register(close_parser)
+
+
+def parse_code_file(code: str) -> list[Step]:
+    # one-off parse in a fresh session
+    tmp_dir = tempfile.mkdtemp(prefix='parse_')
+    file_name = os.path.join(tmp_dir, 'Parse.v')
     with open(file_name, 'w') as f:
-        f.write(code)
-    with CoqFile(file_name) as coq_file:
-        steps = coq_file.steps
-    os.remove(file_name)
-    return steps
+        f.write('\n' + code.strip())
+    try:
+        with CoqFile(file_name) as coq_file:
+            return coq_file.steps
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def parse_code(code: str) -> list[Step]:
+    try:
+        return get_parser().parse(code)
+    except Exception as e:
+        # a broken session is replaced on the next call, this one gets a fresh session
+        print(f'Parser session failed: {e!r}')
+        close_parser()
+        return parse_code_file(code)
+
+
+def to_step(sentence: str) -> Step:
+    text = strip_comments(sentence)
+    short_text = text.strip()
+    leading = text[:len(text) - len(text.lstrip())]
+    return Step((leading or '\n') + short_text, short_text, None)
+
+
+def split_code(code: str) -> list[Step]:
+    # the lexer splits well-formed code, coq-lsp decides the rest
+    sentences = split_sentences(code.strip())
+    if sentences is None:
+        return parse_code(code)
+    return [to_step(s) for s in sentences]
+
+
+def cut_at_proof(code: str) -> str:
+    # the statements before `Proof.`, a `Proof.` in a comment or string does not count
+    sentences = split_sentences(code)
+    if sentences is None:
+        return code[:code.find('Proof.')] if 'Proof.' in code else code
+    end = 0
+    for sentence in sentences:
+        if re.match(r'Proof\b', strip_comments(sentence).strip()):
+            break
+        end += len(sentence)
+    return code[:end]
 
 
 def parse_response_proof(response: str) -> List[Step]:
@@ -30,7 +128,7 @@ def parse_response_proof(response: str) -> List[Step]:
         return []
     code = blocks[-1].strip()
     code = remove_comments(code)
-    steps = parse_code(code) # coq_file.parse_code('\n\n' + code)
+    steps = split_code(code)
     for i in range(len(steps)):
         if steps[i].short_text == 'Proof.':
             return steps[i+1:]
@@ -38,13 +136,36 @@ def parse_response_proof(response: str) -> List[Step]:
 
 
 def format_goal(goal: Goal) -> str:
+    # kept on the goal, it is formatted for the log and again for prompts
+    formatted = getattr(goal, '_formatted', None)
+    if formatted is not None:
+        return formatted
     hyps, ty = goal.hyps, goal.ty
     result = "(* Hypotheses: *)\n{hypotheses}\n\n(* Goal: *)\n{goal}"
     hypotheses = ""
     for hyp in hyps:
         names = ", ".join(hyp.names)
         hypotheses += f"{names} : {hyp.ty}\n"
-    return result.format(hypotheses=hypotheses, goal=ty)
+    formatted = result.format(hypotheses=hypotheses, goal=ty)
+    goal._formatted = formatted
+    return formatted
+
+
+def goal_fingerprint(goal: Goal) -> str:
+    """
+    Hash of a goal up to whitespace and the order of its hypotheses, computed
+    once per Goal. Equal fingerprints mean equal goals, the bodies of let-bound
+    hypotheses included.
+    """
+    fingerprint = getattr(goal, '_fingerprint', None)
+    if fingerprint is not None:
+        return fingerprint
+    hyps = sorted(f"{', '.join(sorted(hyp.names))}{' := ' + normalize_spaces(hyp.definition) if hyp.definition is not None else ''} : {normalize_spaces(hyp.ty)}"
+                  for hyp in goal.hyps)
+    content = '\n'.join(hyps + ['|- ' + normalize_spaces(goal.ty)])
+    fingerprint = hashlib.sha256(content.encode()).hexdigest()
+    goal._fingerprint = fingerprint
+    return fingerprint
 
 
 def get_theorem_name(text: str) -> str:
@@ -56,9 +177,7 @@ def get_theorem_name(text: str) -> str:
     
 
 def get_ids_from_sentence(text) -> list[str]:
-    ID_FORM = re.compile(r"[^\[\]\{\}\(\):=,\s]+")
-    sentence_ids = re.findall(ID_FORM, text)
-    return sentence_ids
+    return identifiers(text)
 
 
 def is_bullet(step: str) -> bool:
@@ -119,14 +238,46 @@ def is_within_proj(term: Term, proj: str) -> bool:
     return False
 
 
+class IdCache:
+    """
+    The ids in the AST of a step, by step text, so that a step seen again (a
+    definition reached from several theorems, a repeated error step) is not
+    walked again. The ids are resolved to terms in the context of each call.
+    """
+    max_size = 4096
+    hits = 0
+    misses = 0
+    _names: OrderedDict[str, list[str]] = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def stats(cls) -> dict[str, int]:
+        return {'hits': cls.hits, 'misses': cls.misses, 'size': len(cls._names)}
+
+
+def get_ids_in_ast(proof_file: ProofFile, step: Step) -> list[str]:
+    with IdCache._lock:
+        names = IdCache._names.get(step.text)
+        if names is not None:
+            IdCache._names.move_to_end(step.text)
+            IdCache.hits += 1
+            return names
+    names = list(set(_get_all_ids(proof_file.context.expr(step))))
+    with IdCache._lock:
+        IdCache.misses += 1
+        IdCache._names[step.text] = names
+        while len(IdCache._names) > IdCache.max_size:
+            IdCache._names.popitem(last=False)
+    return names
+
+
 def get_ids_in_step(proof_file: ProofFile, code: Term | Step | str, remove_std: bool = True) -> Dict[str, Term]:
     if isinstance(code, str):
         names = get_ids_from_sentence(code)
     else:
         if isinstance(code, Term):
             code = code.step
-        expr = proof_file.context.expr(code)
-        names = set(_get_all_ids(expr))
+        names = get_ids_in_ast(proof_file, code)
     results = {}
     for name in names:
         term = proof_file.context.get_term(name)
@@ -138,21 +289,92 @@ def get_ids_in_step(proof_file: ProofFile, code: Term | Step | str, remove_std:
     return results
 
 
+class Dependencies:
+    """
+    The ids used by the terms of one proof file, direct and transitive, filled
+    as they are asked for. Everything is dropped when the terms of the file
+    change, e.g. when a lemma is added before the theorem.
+    """
+    def __init__(self):
+        self.version = None
+        self.direct: dict[tuple[str, bool], dict[str, Term]] = {}
+        self.closure: dict[tuple[str, bool], dict[str, Term]] = {}
+        self.environment: str | None = None
+        self.hits = 0
+        self.misses = 0
+
+    def check(self, proof_file: ProofFile):
+        terms = proof_file.context.terms
+        last = next(reversed(terms), None)
+        # a term added or removed at the end, or replaced by a new one, changes the version
+        version = (id(proof_file.context), len(terms), last, id(terms[last]) if last is not None else None)
+        if version != self.version:
+            self.version = version
+            self.direct.clear()
+            self.closure.clear()
+            self.environment = None
+
+    def get_direct(self, proof_file: ProofFile, name: str, term: Term, remove_std: bool) -> dict[str, Term]:
+        key = (name, remove_std)
+        if key not in self.direct:
+            self.direct[key] = get_ids_in_step(proof_file, term, remove_std)
+        return self.direct[key]
+
+    def get_closure(self, proof_file: ProofFile, name: str, term: Term, remove_std: bool) -> dict[str, Term]:
+        # `name` and everything its term depends on, transitively
+        key = (name, remove_std)
+        if key in self.closure:
+            self.hits += 1
+            return self.closure[key]
+        self.misses += 1
+        results = {name: term}
+        pending = [name]
+        for current in pending:
+            for dep, dep_term in self.get_direct(proof_file, current, results[current], remove_std).items():
+                if dep not in results:
+                    results[dep] = dep_term
+                    pending.append(dep)
+        self.closure[key] = results
+        return results
+
+
+_dependencies: weakref.WeakKeyDictionary[ProofFile, Dependencies] = weakref.WeakKeyDictionary()
+_dependencies_lock = threading.Lock()
+
+
+def get_dependencies(proof_file: ProofFile) -> Dependencies:
+    with _dependencies_lock:
+        deps = _dependencies.get(proof_file)
+        if deps is None:
+            deps = _dependencies[proof_file] = Dependencies()
+    deps.check(proof_file)
+    return deps
+
+
+def environment_fingerprint(proof_file: ProofFile, proof_term: ProofTerm) -> str:
+    """
+    Hash of the terms in scope and of the document up to the statement of
+    `proof_term`. The text also covers what the terms do not show, such as
+    hints, notations, options and sections.
+    """
+    deps = get_dependencies(proof_file)
+    if deps.environment is None:
+        # computed again only when the terms change
+        terms = proof_file.context.terms
+        content = '\n'.join(sorted(f'{name}: {term.step.short_text}' for name, term in terms.items()))
+        deps.environment = hashlib.sha256(content.encode()).hexdigest()
+    index = proof_file.find_step_index(proof_term.ast.range)
+    # side sessions and the main document differ in the whitespace between sentences
+    prefix = '\n'.join(step.text.strip() for step in proof_file.steps[:index + 1])
+    return hashlib.sha256(f'{deps.environment}\n{prefix}'.encode()).hexdigest()
+
+
 def get_ids_in_step_recursive(proof_file: ProofFile, code: Term | Step | str, remove_std: bool = True) -> Dict[str, Term]:
-    results = get_ids_in_step(proof_file, code, remove_std)
-    checked = set()
-    while True:
-        original_size = len(results)
-        new_results = {}
-        for name, term in results.items():
-            if name in checked:
-                continue
-            res = get_ids_in_step(proof_file, term, remove_std)
-            new_results.update(res)
-            checked.add(name)
-        results.update(new_results)
-        if len(results) == original_size:
-            break
+    deps = get_dependencies(proof_file)
+    results = {}
+    for name, term in get_ids_in_step(proof_file, code, remove_std).items():
+        if name not in results:
+            results.update(deps.get_closure(proof_file, name, term, remove_std))
     return results
 
 
@@ -169,20 +391,7 @@ def execute_once(proof_file: ProofFile, proof_term: ProofTerm, step: str) -> Tup
 
 
 def remove_comments(code: str) -> str:
-    result = []
-    i = 0
-    while i < len(code):
-        # Check for the start of a comment
-        if code[i:i+2] == "(*":
-            # Move the index forward until the end of the comment
-            i += 2
-            while i < len(code) and code[i:i+2] != "*)":
-                i += 1
-            i += 2  # Skip the closing "*)"
-        else:
-            result.append(code[i])
-            i += 1
-    return ''.join(result).strip()
+    return strip_comments(code).strip()
 
 
 def is_import(step: str) -> bool:
@@ -209,6 +418,16 @@ def normalize_spaces(s: str) -> str:
     return re.sub(r"\s+", " ", s, flags=re.DOTALL)
 
 
+def theorem_fingerprint(theorem: str, definitions: dict[str, str]) -> str:
+    """
+    Hash of a theorem statement and the texts of its transitive dependencies.
+    Equal fingerprints at two commits mean the statement did not change in meaning.
+    """
+    content = [normalize_spaces(theorem.strip())]
+    content += [f'{name}: {normalize_spaces(text)}' for name, text in sorted(definitions.items())]
+    return hashlib.sha256('\n'.join(content).encode()).hexdigest()
+
+
 if __name__ == "__main__":
     code = """
     (* Now we need to prove that list_order il_0 u_0 u_1 = false if list_member il_1 u_1 = false *)
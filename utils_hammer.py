@@ -1,48 +1,18 @@
+import time
 from typing import List, Dict, Tuple
-from utils_coq import normalize_spaces
+from budget import Budget
+from utils_coq import goal_fingerprint, environment_fingerprint
+from hammer_cache import HammerCache, get_hammer_cache
+from checkpoint import HAMMER_TIME
 from coqpyt.coq.structs import Term, Step, ProofTerm
-from coqpyt.coq.lsp.structs import Goal, Hyp, GoalConfig, GoalAnswer
+from coqpyt.coq.lsp.structs import Goal, GoalConfig, GoalAnswer
 from coqpyt.coq.proof_file import ProofFile
 from coqpyt.coq.exceptions import InvalidChangeException
 from coqpyt.lsp.structs import ResponseError
 
 
-def eq_hyp(hyp_1: Hyp, hyp_2: Hyp) -> bool:
-    if normalize_spaces(hyp_1.ty) != normalize_spaces(hyp_2.ty):
-        return False
-    if len(hyp_1.names) != len(hyp_2.names):
-        return False
-    names_1 = set(hyp_1.names)
-    names_2 = set(hyp_2.names)
-    return names_1 == names_2
-
-
-def eq_goal(goal_1: Goal, goal_2: Goal) -> bool: 
-    if normalize_spaces(goal_1.ty) != normalize_spaces(goal_2.ty):
-        return False
-    if len(goal_1.hyps) != len(goal_2.hyps):
-        return False
-    
-    hyps_1 = [h for h in goal_1.hyps]
-    hyps_2 = [h for h in goal_2.hyps]
-
-    remove = []
-    for i in range(len(hyps_1)):
-        found = False
-        for j in range(len(hyps_2)):
-            if eq_hyp(hyps_1[i], hyps_2[j]):
-                hyps_2.pop(j)
-                remove.append(i)
-                found = True
-                break
-        if not found:
-            return False
-    for r in remove:
-        hyps_1.pop(r)
-    
-    if len(hyps_1) > 0:
-        return False
-    return True
+def eq_goal(goal_1: Goal, goal_2: Goal) -> bool:
+    return goal_fingerprint(goal_1) == goal_fingerprint(goal_2)
 
 # TODO: sometimes, qimpl use: lemma just adds the lemma to the hyps. This does not make progress.
 def progress(old_state: GoalAnswer, new_state: GoalAnswer) -> bool:
@@ -87,13 +57,55 @@ def hammer_tactic(proof_file: ProofFile, proof_term: ProofTerm, tactic: str) ->
         return False, 'No progress'
 
 
-def hammer(proof_file: ProofFile, proof_term: ProofTerm) -> Tuple[bool, str]:
+def hammer_state(proof_file: ProofFile, proof_term: ProofTerm) -> tuple[str, str] | None:
+    # the environment and focused goal a hammer result holds for
+    goals = proof_file.current_goals.goals.goals
+    if not goals:
+        return None
+    return environment_fingerprint(proof_file, proof_term), goal_fingerprint(goals[0])
+
+
+def check_tactic(proof_file: ProofFile, proof_term: ProofTerm, tactic: str) -> bool:
+    # whether `tactic` applies and makes progress, the document is left as it was
+    old_state = proof_file.current_goals
+    try:
+        proof_file.append_step(proof_term, tactic)
+    except (InvalidChangeException, ResponseError):
+        return False
+    new_state = proof_file.current_goals
+    proof_file.pop_step(proof_term)
+    return progress(old_state, new_state)
+
+
+def hammer(proof_file: ProofFile, proof_term: ProofTerm, budget: Budget | None = None) -> Tuple[bool, str]:
     tactic = 'hammer.'
 
+    if budget is not None:
+        budget.check()
+    state = hammer_state(proof_file, proof_term) if HammerCache.enabled else None
+    if state is not None:
+        cache = get_hammer_cache()
+        cached = cache.get(*state, HAMMER_TIME)
+        # the key cannot cover everything a tactic depends on, a stored tactic is tried first
+        if cached is not None and cached[0] and not check_tactic(proof_file, proof_term, cached[1]):
+            cache.delete(*state)
+            cached = None
+        if cached is not None:
+            if budget is not None:
+                budget.charge_hammer(0, cached=True)
+            return cached
+    if budget is not None and not budget.allow_hammer():
+        return False, 'Hammer budget exhausted'
     # print('start hammer')
+    start = time.time()
     sucess, message = automation(proof_file, proof_term, tactic)
+    if budget is not None:
+        budget.charge_hammer(time.time() - start)
     # print('Hammer res: ', sucess, message)
     if not sucess:
+        # only the verdict of the hammer itself, not a broken coq-lsp request
+        if state is not None and 'Hammer failed' in message:
+            get_hammer_cache().put(*state, HAMMER_TIME, False, message)
         return False, message
     proof_file.pop_step(proof_term)
     prefix = 'Replace the hammer tactic with:'
@@ -105,4 +117,6 @@ def hammer(proof_file: ProofFile, proof_term: ProofTerm) -> Tuple[bool, str]:
     # "srun eauto" causes error, use "srun best" instead
     if replace.startswith('srun eauto '):
         replace = replace.replace('srun eauto ', 'best ')
+    if state is not None:
+        get_hammer_cache().put(*state, HAMMER_TIME, True, '\n' + replace)
     return True, '\n' + replace
@@ -0,0 +1,322 @@
+"""
+Pure-Python lexing of Coq code: sentences, comments and tokens. Splitting a
+proof here takes microseconds where a coq-lsp round trip takes tens of
+milliseconds; input the lexer cannot decide on (an unterminated comment or
+string, a sentence without its final `.`, `{|` opening a sentence) is left to
+coq-lsp.
+
+Comments nest and strings are lexed inside them, as in Coq; `(*` inside a
+string does not open a comment.
+
+`python utils_lexer.py --proj <proj>` checks the splitter against the sentences
+coq-lsp recorded in the datapoints of a project; tests/data/sentence_splits.json
+keeps the cases the splitter must get right without the dataset.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from functools import lru_cache
+
+BULLETS = '-+*'
+# runs of characters that cannot change the state, skipped at once
+CODE_RUN = re.compile(r'[^\s."(*{]+')
+COMMENT_RUN = re.compile(r'[^*("]+')
+SPACE_RUN = re.compile(r'\s+')
+# `(*` or `"` outside comments, and also `*)` inside them
+DELIMITER = re.compile(r'\(\*|"')
+COMMENT_DELIMITER = re.compile(r'\(\*|\*\)|"')
+TOKEN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>\(\*)
+  | (?P<string>"(?:[^"]|"")*"?)
+  | (?P<ident>[^\W\d][\w']*(?:\.[^\W\d][\w']*)*)
+  | (?P<number>\d[\d_]*)
+  | (?P<punct>[()\[\]{},;])
+  | (?P<symbol>[^\s\w"()\[\]{},;]+)
+""", re.VERBOSE)
+# `2: {`, `all: {`, `[goal]: {` open a subproof like a bare brace
+GOAL_SELECTOR = re.compile(r'(?:\d+(?:\s*[-,]\s*\d+)*|all|par|!|\[\s*[\w\']+\s*\])\s*:\s*$')
+
+
+class SentenceSplitter:
+    """
+    Split Coq code into sentences as it arrives. A sentence ends at a `.` or
+    `...` followed by whitespace, or is a bullet or brace; `..` in notations,
+    qualified names, comments and strings do not end a sentence.
+
+    With `fence`, only the first ```coq block of a response is split. The
+    splitter records in `ambiguous` whether some sentence may have been cut
+    differently than Coq would.
+    """
+    def __init__(self, fence: bool = False):
+        self.text = ''
+        self.fence = fence
+        self.pos = -1 if fence else 0  # scan position, -1 until the block has started
+        self.sentence = self.pos  # start of the current sentence
+        self.depth = 0  # comment nesting
+        self.in_string = False
+        self.started = False  # the current sentence has code outside comments
+        self.ambiguous = False
+        self.done = False
+
+    def feed(self, delta: str) -> list[str]:
+        self.text += delta
+        return self._scan(final=False)
+
+    def finish(self) -> list[str]:
+        sentences = self._scan(final=True)
+        if not self.done and self.pos >= 0:
+            if self.depth > 0 or self.in_string or self.started:
+                self.ambiguous = True
+            sentences += self._flush(len(self.text))
+        self.done = True
+        return sentences
+
+    def _flush(self, end: int) -> list[str]:
+        sentence = self.text[self.sentence:end]
+        self.sentence = end
+        self.started = False
+        return [sentence] if strip_comments(sentence).strip() else []
+
+    def _scan(self, final: bool) -> list[str]:
+        if self.done:
+            return []
+        text = self.text
+        if self.pos < 0:
+            fence = text.find('```coq')
+            newline = text.find('\n', fence) if fence >= 0 else -1
+            if newline < 0:
+                return []
+            self.pos = self.sentence = newline + 1
+
+        sentences = []
+        n = len(text)
+        i = self.pos
+        while i < n:
+            # wait for enough text to decide, unless the input has ended
+            if not final and i + 3 > n:
+                break
+            c = text[i]
+            if c == '`' and self.fence and text.startswith('```', i) and text[i - 1] == '\n':
+                if self.depth > 0 or self.in_string or self.started:
+                    self.ambiguous = True
+                sentences += self._flush(i)
+                self.done = True
+                break
+            if self.in_string:
+                if c == '"':
+                    if text.startswith('""', i):
+                        i += 2
+                        continue
+                    self.in_string = False
+                i += 1
+            elif c == '(' and text.startswith('(*', i):
+                self.depth += 1
+                i += 2
+            elif self.depth > 0:
+                if c == '*' and text.startswith('*)', i):
+                    self.depth -= 1
+                    i += 2
+                else:
+                    # strings in comments are lexed too, `"*)"` does not close one
+                    if c == '"':
+                        self.in_string = True
+                    match = COMMENT_RUN.match(text, i + 1)
+                    i = match.end() if match else i + 1
+            elif c == '"':
+                self.in_string = True
+                self.started = True
+                i += 1
+            elif c.isspace():
+                match = SPACE_RUN.match(text, i + 1)
+                i = match.end() if match else i + 1
+            elif not self.started and c in '{}':
+                if text.startswith('{|', i):
+                    self.ambiguous = True
+                sentences += self._flush(i + 1)
+                i += 1
+            elif self.started and c == '{' and GOAL_SELECTOR.match(strip_comments(text[self.sentence:i]).strip()):
+                sentences += self._flush(i + 1)
+                i += 1
+            elif not self.started and c in BULLETS:
+                j = i
+                while j < n and text[j] == c:
+                    j += 1
+                if j >= n and not final:
+                    break
+                if j >= n or text[j].isspace():
+                    sentences += self._flush(j)
+                else:
+                    # `-x`, `*)`: not a bullet, but no sentence starts like this either
+                    self.ambiguous = True
+                    self.started = True
+                i = j
+            elif c == '.':
+                j = i
+                while j < n and text[j] == '.':
+                    j += 1
+                if j >= n and not final:
+                    break
+                # `.` and `...` end a sentence, `..` is a notation token
+                if j - i != 2 and (j >= n or text[j].isspace()):
+                    sentences += self._flush(j)
+                else:
+                    self.started = True
+                i = j
+            else:
+                self.started = True
+                match = CODE_RUN.match(text, i + 1)
+                i = match.end() if match else i + 1
+        self.pos = i
+        return sentences
+
+
+def split_sentences(code: str) -> list[str] | None:
+    # the sentences of `code` with their leading whitespace, None when coq-lsp should decide
+    splitter = SentenceSplitter()
+    sentences = splitter.feed(code) + splitter.finish()
+    if splitter.ambiguous:
+        return None
+    return sentences
+
+
+def _skip_string(code: str, i: int) -> int:
+    # `i` is after the opening quote, `""` inside is two adjacent strings to the lexer
+    end = code.find('"', i)
+    return len(code) if end < 0 else end + 1
+
+
+def _skip_comment(code: str, i: int) -> int:
+    # `i` is after the opening `(*`, returns the end of its matching `*)`
+    depth = 1
+    while depth:
+        match = COMMENT_DELIMITER.search(code, i)
+        if match is None:
+            return len(code)
+        delimiter = match.group()
+        if delimiter == '"':
+            i = _skip_string(code, match.end())
+            continue
+        depth += 1 if delimiter == '(*' else -1
+        i = match.end()
+    return i
+
+
+@lru_cache(maxsize=4096)
+def strip_comments(code: str) -> str:
+    if '(*' not in code:
+        return code
+    result = []
+    start = i = 0
+    while True:
+        match = DELIMITER.search(code, i)
+        if match is None:
+            break
+        if match.group() == '"':
+            i = _skip_string(code, match.end())
+            continue
+        result.append(code[start:match.start()])
+        i = start = _skip_comment(code, match.end())
+    result.append(code[start:])
+    return ''.join(result)
+
+
+@lru_cache(maxsize=4096)
+def tokenize(code: str) -> tuple[tuple[str, str], ...]:
+    """
+    The (kind, text) tokens of `code` in one pass, without whitespace and
+    comments. Kinds are ident (possibly qualified), number, string, punct
+    (brackets, `,` and `;`) and symbol, a run of notation characters such as
+    `->`, `:=` or the final `.` of a sentence.
+    """
+    tokens = []
+    i = 0
+    n = len(code)
+    while i < n:
+        match = TOKEN.match(code, i)
+        kind = match.lastgroup
+        if kind == 'comment':
+            i = _skip_comment(code, match.end())
+            continue
+        if kind != 'space':
+            tokens.append((kind, match.group()))
+        i = match.end()
+    return tuple(tokens)
+
+
+def identifiers(code: str) -> list[str]:
+    # outside comments and strings
+    return [text for kind, text in tokenize(code) if kind == 'ident']
+
+
+def normalize(sentence: str) -> str:
+    return ' '.join(strip_comments(sentence).split())
+
+
+def check_proj(dataset: str, proj: str, coq_lsp: int = 0) -> dict[str, float]:
+    """
+    Split the statement and proof of every theorem in the datapoints of `proj`
+    and compare with the sentences coq-lsp recorded for it. With `coq_lsp`,
+    the first `coq_lsp` proofs are also parsed by coq-lsp for timing.
+    """
+    from utils_coq import parse_code
+
+    stats = {'proofs': 0, 'agree': 0, 'differ': 0, 'ambiguous': 0, 'sentences': 0, 'lexer_time': 0.0, 'coq_lsp_proofs': 0, 'coq_lsp_time': 0.0}
+    proj_path = os.path.join(dataset, proj)
+    for commit in sorted(os.listdir(proj_path)):
+        datapoint_path = os.path.join(proj_path, commit, 'datapoint')
+        if not os.path.isdir(datapoint_path):
+            continue
+        for file in sorted(os.listdir(datapoint_path)):
+            if not file.endswith('.json'):
+                continue
+            with open(os.path.join(datapoint_path, file)) as f:
+                data = json.load(f)
+            for proof in data['proofs']:
+                sentences = [proof['theorem']['text']] + [s['step']['text'] for s in proof['steps']]
+                expected = [normalize(s) for s in sentences if normalize(s)]
+                code = '\n'.join(s.strip() for s in sentences)
+
+                start = time.time()
+                split = split_sentences(code)
+                stats['lexer_time'] += time.time() - start
+                stats['proofs'] += 1
+                stats['sentences'] += len(expected)
+                if split is None:
+                    stats['ambiguous'] += 1
+                elif [normalize(s) for s in split] == expected:
+                    stats['agree'] += 1
+                else:
+                    stats['differ'] += 1
+                    if stats['differ'] <= 5:
+                        got = [normalize(s) for s in split]
+                        k = next((k for k, (a, b) in enumerate(zip(got, expected)) if a != b), min(len(got), len(expected)))
+                        print(f"{commit}/{file} {proof['theorem']['text'][:60]!r}: lexer {got[k:k + 2]} coq-lsp {expected[k:k + 2]}")
+
+                if stats['coq_lsp_proofs'] < coq_lsp:
+                    start = time.time()
+                    parse_code(code)
+                    stats['coq_lsp_time'] += time.time() - start
+                    stats['coq_lsp_proofs'] += 1
+    return stats
+
+
+if __name__ == '__main__':
+    from path import DATASET_NORMAL
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--proj', type=str, required=True)
+    parser.add_argument('--dataset', type=str, default=DATASET_NORMAL)
+    parser.add_argument('--coq_lsp', type=int, default=0, help='also time coq-lsp on this many proofs')
+    args = parser.parse_args()
+
+    stats = check_proj(args.dataset, args.proj, args.coq_lsp)
+    print(json.dumps(stats, indent=2))
+    if stats['proofs']:
+        print(f"lexer: {stats['lexer_time'] / stats['proofs'] * 1e6:.0f} us/proof")
+    if stats['coq_lsp_proofs']:
+        print(f"coq-lsp: {stats['coq_lsp_time'] / stats['coq_lsp_proofs'] * 1e6:.0f} us/proof")
+    sys.exit(1 if stats['differ'] else 0)
@@ -0,0 +1,127 @@
+import re
+from functools import lru_cache
+from typing import Any
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+class Packing:
+    max_tokens = 0  # per prompt, 0 for no limit
+    encoding = 'o200k_base'
+
+
+class Compaction:
+    max_tokens = 0  # conversation resent with each request, 0 for no limit
+    keep_last = 4  # latest messages, always sent verbatim
+    section_tokens = 64  # longer sections of older messages are elided
+
+
+_encoder = None
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_'.]*")
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    global _encoder
+    if tiktoken is None:
+        # about four characters per token for Coq code and English
+        return (len(text) + 3) // 4
+    if _encoder is None:
+        _encoder = tiktoken.get_encoding(Packing.encoding)
+    return len(_encoder.encode(text, disallowed_special=()))
+
+
+def relevance(item: str, query_ids: set[str]) -> float:
+    ids = set(IDENTIFIER.findall(item))
+    if not ids:
+        return 0.0
+    score = len(ids & query_ids) / len(ids)
+    # `Lemma name ...`, `Definition name ...`: the term itself is mentioned in the query
+    words = item.split()
+    if len(words) > 1 and words[1].rstrip(':') in query_ids:
+        score += 1.0
+    return score
+
+
+def pack(query: str, fixed: str, sections: dict[str, list[str]], separator: str = '\n\n') -> tuple[dict[str, list[str]], dict[str, Any]]:
+    """
+    Keep the items of `sections` (definitions, lemmas, ...) most relevant to
+    `query` such that they fit in `Packing.max_tokens` together with `fixed`,
+    the rest of the prompt. Items are kept whole and in their original order.
+    """
+    fixed_tokens = count_tokens(fixed)
+    costs = {name: [count_tokens(item + separator) for item in items] for name, items in sections.items()}
+    stats = {
+        'budget': Packing.max_tokens,
+        'fixed_tokens': fixed_tokens,
+        'kept': {name: len(items) for name, items in sections.items()},
+        'dropped': {name: 0 for name in sections},
+        'tokens': fixed_tokens + sum(sum(c) for c in costs.values()),
+    }
+    if not Packing.max_tokens or stats['tokens'] <= Packing.max_tokens:
+        return sections, stats
+
+    query_ids = set(IDENTIFIER.findall(query))
+    ranked = []
+    for order, (name, items) in enumerate(sections.items()):
+        for i, item in enumerate(items):
+            ranked.append((-relevance(item, query_ids), order, i, name))
+    ranked.sort()
+
+    remaining = Packing.max_tokens - fixed_tokens
+    keep = set()
+    for _, _, i, name in ranked:
+        if costs[name][i] <= remaining:
+            keep.add((name, i))
+            remaining -= costs[name][i]
+
+    packed = {name: [item for i, item in enumerate(items) if (name, i) in keep] for name, items in sections.items()}
+    stats['kept'] = {name: len(items) for name, items in packed.items()}
+    stats['dropped'] = {name: len(sections[name]) - len(packed[name]) for name in sections}
+    stats['tokens'] = Packing.max_tokens - remaining
+    print(f"Packed prompt into {stats['tokens']}/{Packing.max_tokens} tokens, dropped {stats['dropped']}")
+    return packed, stats
+
+
+def outline(message: str) -> str:
+    # headers and short sections stay, e.g. the wrong tactic and error message of a feedback
+    parts = []
+    for section in re.split(r'(?m)^(?=### )', message.strip()):
+        head, _, body = section.strip().partition('\n')
+        tokens = count_tokens(body)
+        if tokens <= Compaction.section_tokens:
+            parts.append(section.strip())
+        else:
+            parts.append(f'{head}\n(... {tokens} tokens omitted)')
+    return '\n\n'.join(parts)
+
+
+def compact(messages: list[dict], compacted: int = 0) -> tuple[list[dict], int, dict[str, Any]]:
+    """
+    Fit a conversation into `Compaction.max_tokens` by replacing older messages
+    with their outlines, oldest first. The first message (the task) and the
+    latest `Compaction.keep_last` messages are always sent verbatim.
+
+    Outlines are deterministic and a message once outlined stays outlined, so
+    that successive requests share their prefix, which providers cache.
+    `compacted` is the number of messages outlined by the previous request.
+    """
+    sizes = [count_tokens(m['content']) for m in messages]
+    stats = {'budget': Compaction.max_tokens, 'messages': len(messages), 'tokens_full': sum(sizes)}
+    end = max(1, len(messages) - Compaction.keep_last)
+    outlined = {}
+    for i in range(1, min(compacted + 1, end)):
+        outlined[i] = outline(messages[i]['content'])
+    total = sum(sizes) - sum(sizes[i] - count_tokens(text) for i, text in outlined.items())
+    i = len(outlined) + 1
+    while total > Compaction.max_tokens and i < end:
+        outlined[i] = outline(messages[i]['content'])
+        total -= sizes[i] - count_tokens(outlined[i])
+        i += 1
+
+    result = [{**m, 'content': outlined[i]} if i in outlined else m for i, m in enumerate(messages)]
+    stats.update({'outlined': len(outlined), 'tokens': total})
+    return result, len(outlined), stats